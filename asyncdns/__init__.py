@@ -3,10 +3,26 @@
 from timewheel import TimeWheel
 from pipeline import Pipeline
 from resolver import Resolver
-from utils import CountDownLatch, ResultCollector
-from proxy import SocksProxy
-from scene import Query, Result, Scene
+from utils import CountDownLatch, ResultCollector, Future, Batch
+from proxy import SocksProxy, SocksPool
+from scene import Query, Result, Finished, Scene, Scenario
+from names import NameCache
+from executor import InlineExecutor, ThreadPoolExecutor, BoundedExecutor
+from cache import DelegationCache, CnameCache, SharedCache, ServerStats
+from snapshot import Snapshot
+from prefetch import Prefetcher
+from tcp import TcpPool
+from shard import ShardedResolver
+from server import Forwarder
+from trace import Tracer, HistogramTracer
+from metrics import Metrics, MetricsServer
+from profiler import Profiler
 
 __all__ = ['TimeWheel', 'Pipeline', 'Resolver',
-           'CountDownLatch', 'ResultCollector',
-           'SocksProxy', 'Query', 'Result', 'Scene']
+           'CountDownLatch', 'ResultCollector', 'Future', 'Batch',
+           'SocksProxy', 'SocksPool', 'Query', 'Result', 'Finished', 'Scene', 'Scenario',
+           'NameCache', 'InlineExecutor', 'ThreadPoolExecutor', 'BoundedExecutor',
+           'DelegationCache', 'CnameCache', 'SharedCache', 'ServerStats',
+           'Snapshot', 'Prefetcher', 'TcpPool', 'ShardedResolver', 'Forwarder',
+           'Tracer', 'HistogramTracer', 'Metrics', 'MetricsServer',
+           'Profiler']
@@ -0,0 +1,601 @@
+#!/usr/bin/env python
+from __future__ import with_statement
+
+import os
+import stat
+import time
+import errno
+import random
+import zlib
+import mmap
+import struct
+import threading
+from collections import OrderedDict
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+import dns.name
+import dns.rrset
+import dns.rcode
+import dns.message
+import dns.rdatatype
+
+ROOT_HINTS = [
+    ('a.root-servers.net.', '198.41.0.4'),
+    ('b.root-servers.net.', '170.247.170.2'),
+    ('c.root-servers.net.', '192.33.4.12'),
+    ('d.root-servers.net.', '199.7.91.13'),
+    ('e.root-servers.net.', '192.203.230.10'),
+    ('f.root-servers.net.', '192.5.5.241'),
+    ('g.root-servers.net.', '192.112.36.4'),
+    ('h.root-servers.net.', '198.97.190.53'),
+    ('i.root-servers.net.', '192.36.148.17'),
+    ('j.root-servers.net.', '192.58.128.30'),
+    ('k.root-servers.net.', '193.0.14.129'),
+    ('l.root-servers.net.', '199.7.83.42'),
+    ('m.root-servers.net.', '202.12.27.33'),
+]
+
+class DelegationCache(object):
+    """
+
+    DelegationCache remembers the zone cuts and the nameserver addresses learned from the referrals
+
+    The root hints never expire, the other entries live for the TTL of the records they came from,
+    so the TLD and registrar nameservers are only asked once per TTL for a whole scan.
+
+    """
+    def __init__(self, hints=ROOT_HINTS):
+        self.lock = threading.Lock()
+        self.zones = {}
+        self.addresses = {}
+        self.cold_zones = {}
+        self.cold_addresses = {}
+        self.hits = 0
+        self.misses = 0
+
+        for name, address in hints:
+            name = dns.name.from_text(name)
+
+            self.zones.setdefault(dns.name.root, (None, []))[1].append(name)
+            self.addresses.setdefault(name, (None, []))[1].append(address)
+
+    def __len__(self):
+        return len(self.zones) + len(self.addresses)
+
+    @staticmethod
+    def _alive(entry, now):
+        return entry is not None and (entry[0] is None or entry[0] > now)
+
+    def stats(self):
+        return {
+            'zones': len(self.zones),
+            'addresses': len(self.addresses),
+            'cold': len(self.cold_zones) + len(self.cold_addresses),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+    def dump(self):
+        """
+        return the learned zones and addresses keyed by the lowercased names, the root hints excluded
+        """
+        with self.lock:
+            zones = dict(self.cold_zones)
+            addresses = dict(self.cold_addresses)
+
+            for name, (expires, nameservers) in self.zones.items():
+                if expires is not None:
+                    zones[str(name).lower()] = (expires, [str(nameserver) for nameserver in nameservers])
+
+            for name, (expires, values) in self.addresses.items():
+                if expires is not None:
+                    addresses[str(name).lower()] = (expires, list(values))
+
+        return zones, addresses
+
+    def restore(self, zones, addresses):
+        """
+        keep the dumped entries aside, they are only parsed when a lookup needs them
+        """
+        with self.lock:
+            self.cold_zones.update(zones)
+            self.cold_addresses.update(addresses)
+
+    def _zone(self, name):
+        entry = self.zones.get(name)
+
+        if entry is None and self.cold_zones:
+            cold = self.cold_zones.pop(name.to_text().lower(), None)
+
+            if cold is not None:
+                entry = self.zones[name] = (cold[0], [dns.name.from_text(nameserver) for nameserver in cold[1]])
+
+        return entry
+
+    def _address(self, name):
+        entry = self.addresses.get(name)
+
+        if entry is None and self.cold_addresses:
+            cold = self.cold_addresses.pop(name.to_text().lower(), None)
+
+            if cold is not None:
+                entry = self.addresses[name] = (cold[0], list(cold[1]))
+
+        return entry
+
+    def add_zone(self, zone, nameservers, ttl):
+        with self.lock:
+            self.zones[zone] = (time.time() + ttl, list(nameservers))
+
+    def add_address(self, name, addresses, ttl):
+        with self.lock:
+            self.addresses[name] = (time.time() + ttl, list(addresses))
+
+    def get_address(self, name):
+        with self.lock:
+            entry = self._address(name)
+
+            return entry[1] if self._alive(entry, time.time()) else None
+
+    def find(self, qname):
+        """
+        return the closest enclosing zone with its nameserver names and the known addresses of them
+        """
+        now = time.time()
+        name = qname
+
+        with self.lock:
+            while True:
+                entry = self._zone(name)
+
+                if self._alive(entry, now):
+                    addresses = []
+
+                    for nameserver in entry[1]:
+                        glue = self._address(nameserver)
+
+                        if self._alive(glue, now):
+                            addresses.extend(glue[1])
+
+                    if name == dns.name.root:
+                        self.misses += 1
+                    else:
+                        self.hits += 1
+
+                    return name, entry[1], addresses
+
+                if entry is not None:
+                    del self.zones[name]
+
+                if name == dns.name.root:
+                    self.misses += 1
+
+                    return name, [], []
+
+                name = name.parent()
+
+    def purge(self):
+        now = time.time()
+
+        with self.lock:
+            for table in [self.zones, self.addresses, self.cold_zones, self.cold_addresses]:
+                for name, entry in table.items():
+                    if not self._alive(entry, now):
+                        del table[name]
+
+class ServerStats(object):
+    """
+
+    ServerStats keeps the smoothed round trip time of the nameservers (like the SRTT of BIND),
+    so the iterative resolution asks the fastest nameservers of a zone first
+
+    """
+    ALPHA = 0.125
+    MAX_RTT = 10.0
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.servers = {}
+
+    def __len__(self):
+        return len(self.servers)
+
+    def stats(self):
+        with self.lock:
+            return dict([(nameserver, {'srtt': srtt, 'responses': responses, 'timeouts': timeouts})
+                         for nameserver, (srtt, responses, timeouts) in self.servers.items()])
+
+    def update(self, nameserver, rtt):
+        with self.lock:
+            entry = self.servers.get(nameserver)
+
+            if entry is None:
+                self.servers[nameserver] = [rtt, 1, 0]
+            else:
+                entry[0] += (rtt - entry[0]) * self.ALPHA
+                entry[1] += 1
+
+    def timeout(self, nameserver):
+        with self.lock:
+            entry = self.servers.setdefault(nameserver, [0.0, 0, 0])
+
+            entry[0] = min(max(entry[0] * 2, 1.0), self.MAX_RTT)
+            entry[2] += 1
+
+    def rtt(self, nameserver):
+        entry = self.servers.get(nameserver)
+
+        return entry[0] if entry else None
+
+    def choose(self, addresses, count, port=53):
+        """
+        choose the nameservers never asked before, then the fastest ones
+        """
+        addresses = list(addresses)
+
+        random.shuffle(addresses)
+
+        with self.lock:
+            addresses.sort(key=lambda address: self.servers.get((address, port), [0.0])[0])
+
+        return addresses[:count]
+
+    def dump(self):
+        with self.lock:
+            return dict([(nameserver, tuple(entry)) for nameserver, entry in self.servers.items()])
+
+    def restore(self, servers):
+        with self.lock:
+            for nameserver, entry in servers.items():
+                self.servers.setdefault(nameserver, list(entry))
+
+class CnameCache(object):
+    """
+
+    CnameCache remembers the CNAME links of the chains followed by the resolver for their TTL,
+    so the chains shared by many domains (like the CDN targets) are only resolved once
+
+    Beyond `capacity` links, the least recently used ones are evicted, so the hot chains stay.
+
+    """
+    def __init__(self, capacity=65536):
+        self.lock = threading.Lock()
+        self.capacity = capacity
+        # name -> (expires, rrset), from the least recently used
+        self.links = OrderedDict()
+        self.cold = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.links)
+
+    def stats(self):
+        return {
+            'links': len(self.links),
+            'cold': len(self.cold),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+    def dump(self):
+        """
+        return the links keyed by the lowercased names, as (expires, ttl, target) tuples
+        """
+        with self.lock:
+            links = dict(self.cold)
+
+            for name, (expires, rrset) in self.links.items():
+                links[str(name).lower()] = (expires, rrset.ttl, str(rrset[0].target))
+
+        return links
+
+    def restore(self, links):
+        with self.lock:
+            self.cold.update(links)
+
+    def _put(self, name, entry):
+        self.links.pop(name, None)
+        self.links[name] = entry
+
+        while len(self.links) > self.capacity:
+            self.links.popitem(last=False)
+
+    def _link(self, name):
+        entry = self.links.get(name)
+
+        if entry is None and self.cold:
+            cold = self.cold.pop(name.to_text().lower(), None)
+
+            if cold is not None:
+                entry = (cold[0], dns.rrset.from_text(name, cold[1], 'IN', 'CNAME', cold[2]))
+
+        if entry is not None:
+            self._put(name, entry)
+
+        return entry
+
+    def add(self, rrset):
+        with self.lock:
+            self._put(rrset.name, (time.time() + rrset.ttl, rrset))
+
+    def get(self, name):
+        with self.lock:
+            entry = self._link(name)
+
+            if entry is None:
+                self.misses += 1
+
+                return None
+
+            if entry[0] <= time.time():
+                del self.links[name]
+
+                self.misses += 1
+
+                return None
+
+            self.hits += 1
+
+            return entry[1]
+
+class SharedCache(object):
+    """
+
+    SharedCache is a TTL expiring answer cache in a memory mapped file, shared by the resolvers of all the processes
+
+    The file is a table of fixed size slots addressed by the crc32 of the question, probing a few slots
+    on collision. Each slot keeps the question and the wire format response with its expiry time.
+    The writers take an exclusive file lock, and bump a sequence number around the update,
+    so the readers never lock and just retry when they see a slot being written.
+
+    The expired answers are kept for `max_stale` seconds more, to be served stale when
+    the nameservers are unreachable (RFC 8767).
+
+    Since the answers are served as they are read, a new file is created private to the user,
+    and an existing one is refused unless it belongs to the user and nobody else can write it.
+
+    """
+    MAGIC = 'ASYNCDNS'
+    VERSION = 2
+    HEADER = struct.Struct(">8sIII")
+    HEADER_SIZE = 64
+    SLOT = struct.Struct(">IIdIHH")
+    PROBES = 8
+    RETRIES = 3
+    STALE_TTL = 30
+
+    def __init__(self, path, slots=65536, slot_size=1024, max_stale=86400):
+        self.path = path
+        self.max_stale = max_stale
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        self.stores = 0
+
+        self.fd = self._open(path)
+
+        try:
+            self._lock()
+
+            try:
+                header = os.read(self.fd, self.HEADER.size)
+
+                if len(header) < self.HEADER.size:
+                    os.ftruncate(self.fd, self.HEADER_SIZE + slots * slot_size)
+                    os.lseek(self.fd, 0, os.SEEK_SET)
+                    os.write(self.fd, self.HEADER.pack(self.MAGIC, self.VERSION, slots, slot_size))
+                else:
+                    magic, version, slots, slot_size = self.HEADER.unpack(header)
+
+                    if magic != self.MAGIC or version != self.VERSION:
+                        raise ValueError("%s is not an asyncdns cache file" % path)
+            finally:
+                self._unlock()
+        except:
+            os.close(self.fd)
+
+            raise
+
+        self.slots = slots
+        self.slot_size = slot_size
+        self.mmap = mmap.mmap(self.fd, self.HEADER_SIZE + slots * slot_size)
+
+    @staticmethod
+    def _open(path):
+        """
+        create the cache file exclusively with mode 0600, or open the existing one if it is safe to trust
+        """
+        while True:
+            try:
+                return os.open(path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0600)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+            try:
+                fd = os.open(path, os.O_RDWR | getattr(os, 'O_NOFOLLOW', 0))
+            except OSError, e:
+                if e.errno == errno.ENOENT:
+                    continue # removed meanwhile, create it again
+
+                raise
+
+            st = os.fstat(fd)
+
+            if not stat.S_ISREG(st.st_mode) or \
+               (hasattr(os, 'getuid') and st.st_uid != os.getuid()) or \
+               st.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+                os.close(fd)
+
+                raise ValueError("%s is not owned by the current user or is writable by others" % path)
+
+            return fd
+
+    def stats(self):
+        with self.lock:
+            return {
+                'slots': self.slots,
+                'hits': self.hits,
+                'misses': self.misses,
+                'stale_hits': self.stale_hits,
+                'stores': self.stores,
+            }
+
+    def flush(self):
+        self.mmap.flush()
+
+    def close(self):
+        self.mmap.close()
+        os.close(self.fd)
+
+    def _lock(self):
+        if fcntl:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX)
+
+    def _unlock(self):
+        if fcntl:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _key(qname, rdtype, rdclass):
+        return qname.canonicalize().to_wire() + struct.pack(">HH", rdtype, rdclass)
+
+    def _offsets(self, digest):
+        return [self.HEADER_SIZE + ((digest + i) % self.slots) * self.slot_size for i in range(self.PROBES)]
+
+    @staticmethod
+    def _ttl(response):
+        if response.answer:
+            return min([rrset.ttl for rrset in response.answer])
+
+        for rrset in response.authority:
+            if rrset.rdtype == dns.rdatatype.SOA:
+                return min(rrset.ttl, rrset[0].minimum)
+
+        return 0
+
+    def get(self, qname, rdtype, rdclass):
+        """
+        return the cached response of the question with the TTLs counting down, or None
+        """
+        entry = self.fetch(qname, rdtype, rdclass)
+
+        return entry[0] if entry else None
+
+    def fetch(self, qname, rdtype, rdclass, stale=False):
+        """
+        return the cached response with its remaining and original TTL, or None
+
+        With `stale`, only the expired responses kept for less than `max_stale` seconds are returned,
+        with a remaining TTL of zero or less and the record TTLs set to STALE_TTL.
+        """
+        key = self._key(qname, rdtype, rdclass)
+        digest = zlib.crc32(key) & 0xffffffff
+
+        for offset in self._offsets(digest):
+            for retry in range(self.RETRIES):
+                seq, slot_digest, expires, ttl, keylen, datalen = self.SLOT.unpack_from(self.mmap, offset)
+
+                if seq & 1:
+                    continue
+
+                if slot_digest != digest or keylen != len(key):
+                    break
+
+                start = offset + self.SLOT.size
+                data = self.mmap[start:start+keylen+datalen]
+
+                if self.SLOT.unpack_from(self.mmap, offset)[0] != seq:
+                    continue
+
+                if data[:keylen] != key:
+                    break
+
+                now = time.time()
+                remaining = int(expires - now)
+
+                if stale != (remaining <= 0) or (stale and expires + self.max_stale <= now):
+                    break
+
+                response = dns.message.from_wire(data[keylen:])
+
+                for rrset in response.answer + response.authority + response.additional:
+                    rrset.ttl = self.STALE_TTL if stale else min(rrset.ttl, remaining)
+
+                with self.lock:
+                    if stale:
+                        self.stale_hits += 1
+                    else:
+                        self.hits += 1
+
+                return response, remaining, ttl
+
+        if not stale:
+            with self.lock:
+                self.misses += 1
+
+        return None
+
+    def put(self, response):
+        """
+        cache a positive or negative response for its TTL, return False if it could not be cached
+        """
+        if not response.question or response.rcode() not in [dns.rcode.NOERROR, dns.rcode.NXDOMAIN]:
+            return False
+
+        ttl = self._ttl(response)
+
+        if ttl <= 0:
+            return False
+
+        question = response.question[0]
+        key = self._key(question.name, question.rdtype, question.rdclass)
+        data = response.to_wire()
+
+        if self.SLOT.size + len(key) + len(data) > self.slot_size:
+            return False
+
+        digest = zlib.crc32(key) & 0xffffffff
+        now = time.time()
+
+        with self.lock:
+            self._lock()
+
+            try:
+                victim = None
+
+                for offset in self._offsets(digest):
+                    seq, slot_digest, expires, slot_ttl, keylen, datalen = self.SLOT.unpack_from(self.mmap, offset)
+
+                    if slot_digest == digest and keylen == len(key):
+                        start = offset + self.SLOT.size
+
+                        if self.mmap[start:start+keylen] == key:
+                            victim = (offset, seq)
+
+                            break
+
+                    if victim is None or expires < victim[2]:
+                        victim = (offset, seq, expires)
+
+                offset, seq = victim[:2]
+
+                self.SLOT.pack_into(self.mmap, offset, seq + 1, 0, 0, 0, 0, 0)
+
+                start = offset + self.SLOT.size
+
+                self.mmap[start:start+len(key)+len(data)] = key + data
+
+                self.SLOT.pack_into(self.mmap, offset, (seq + 2) & 0xffffffff, digest, now + ttl, ttl, len(key), len(data))
+
+                self.stores += 1
+            finally:
+                self._unlock()
+
+        return True
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+from __future__ import with_statement
+
+import time
+import logging
+import threading
+import Queue
+
+import traceback
+
+class InlineExecutor(object):
+    """
+
+    InlineExecutor executes the callbacks on the submitting thread, which is the pipeline thread for the responses
+
+    """
+    logger = logging.getLogger("asyncdns.executor")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.submitted = 0
+        self.completed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    @property
+    def queued(self):
+        return 0
+
+    @property
+    def busy(self):
+        return False
+
+    def watch(self, wake):
+        """
+        register `wake` to be called when the executor is no longer busy, it never is
+        """
+        pass
+
+    def unwatch(self, wake):
+        pass
+
+    def stats(self):
+        with self.lock:
+            return {
+                'queued': self.queued,
+                'submitted': self.submitted,
+                'completed': self.completed,
+                'avg_wait': self.total_wait / self.completed if self.completed else 0.0,
+                'max_wait': self.max_wait,
+                'avg_time': self.total_time / self.completed if self.completed else 0.0,
+                'max_time': self.max_time,
+            }
+
+    def _execute(self, submitted, func, args):
+        started = time.time()
+
+        try:
+            func(*args)
+        except Exception, e:
+            self.logger.warn("fail to execute callback: %s", e)
+            self.logger.debug("exc: %s", traceback.format_exc())
+
+        finished = time.time()
+
+        with self.lock:
+            self.completed += 1
+            self.total_wait += started - submitted
+            self.max_wait = max(self.max_wait, started - submitted)
+            self.total_time += finished - started
+            self.max_time = max(self.max_time, finished - started)
+
+    def submit(self, func, *args):
+        with self.lock:
+            self.submitted += 1
+
+        self._execute(time.time(), func, args)
+
+    def shutdown(self):
+        pass
+
+class ThreadPoolExecutor(InlineExecutor):
+    """
+
+    ThreadPoolExecutor hands the callbacks off to a pool of worker threads,
+    so the pipeline thread only matches packets and never waits for the slow callbacks
+
+    """
+    def __init__(self, workers=4, maxsize=0):
+        InlineExecutor.__init__(self)
+
+        self.task_queue = Queue.Queue()
+        self.maxsize = maxsize
+        self.wakers = []
+        # set once a pipeline has found the executor busy, until a worker drains it below `maxsize`
+        self.throttled = False
+        self.workers = [threading.Thread(target=self.run, name="asyncdns.executor") for i in range(workers)]
+
+        for worker in self.workers:
+            worker.setDaemon(True)
+            worker.start()
+
+    @property
+    def queued(self):
+        return self.task_queue.qsize()
+
+    @property
+    def busy(self):
+        if self.maxsize > 0 and self.queued >= self.maxsize:
+            self.throttled = True
+
+            return True
+
+        return False
+
+    def watch(self, wake):
+        """
+        register `wake` to be called when the queue drops below `maxsize` after the executor was busy,
+        so a pipeline which stopped sending polls its channels again at once
+        """
+        with self.lock:
+            self.wakers.append(wake)
+
+    def unwatch(self, wake):
+        with self.lock:
+            if wake in self.wakers:
+                self.wakers.remove(wake)
+
+    def submit(self, func, *args):
+        with self.lock:
+            self.submitted += 1
+
+        self.task_queue.put_nowait((time.time(), func, args))
+
+    def shutdown(self):
+        for worker in self.workers:
+            self.task_queue.put_nowait(None)
+
+        for worker in self.workers:
+            worker.join()
+
+    def run(self):
+        while True:
+            task = self.task_queue.get()
+
+            if task is None:
+                break
+
+            if self.throttled and self.queued < self.maxsize:
+                self.throttled = False
+
+                with self.lock:
+                    wakers = list(self.wakers)
+
+                for wake in wakers:
+                    wake()
+
+            self._execute(*task)
+
+class BoundedExecutor(ThreadPoolExecutor):
+    """
+
+    BoundedExecutor is a ThreadPoolExecutor with backpressure
+
+    When more than `maxsize` callbacks are waiting, the pipeline stops sending new queries
+    until the workers catch up, while it keeps receiving the responses of the pending ones.
+    The bound only applies to the sends: `submit` never blocks, since it is called by the loop
+    thread for the responses, so the callbacks of the queries already sent are always queued.
+
+    """
+    def __init__(self, workers=4, maxsize=1024):
+        ThreadPoolExecutor.__init__(self, workers, maxsize)
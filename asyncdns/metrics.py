@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+from __future__ import with_statement
+
+import logging
+import threading
+import BaseHTTPServer
+
+from trace import Histogram
+
+class ServerMetrics(object):
+    """
+
+    ServerMetrics keeps the counters and the round trip time histogram of one nameserver
+
+    """
+    __slots__ = ['sent', 'send_errors', 'received', 'matched', 'unexpected', 'invalid', 'timeouts', 'rtt']
+
+    def __init__(self, buckets=Histogram.BUCKETS):
+        self.sent = 0
+        self.send_errors = 0
+        self.received = 0
+        self.matched = 0
+        self.unexpected = 0
+        self.invalid = 0
+        self.timeouts = 0
+        self.rtt = Histogram(buckets)
+
+class Metrics(object):
+    """
+
+    Metrics is the registry of the counters, histograms and gauges of a pipeline
+
+    The counters of each nameserver are updated in place by the pipeline as the queries go
+    through it, under its pending tasks lock, so nothing is summed when they are read.
+    A query is counted as sent before it goes out, the sends which fail are counted again as send errors.
+
+    The gauges are callables, evaluated only when the metrics are rendered
+    in the Prometheus text format, by `render` or a MetricsServer.
+    Each pipeline sharing the registry labels its gauges with its own `pipeline` index,
+    and unregisters them when it is closed.
+
+    """
+    COUNTERS = [
+        ('sent', 'queries_sent_total', "DNS queries sent to the nameserver, the failed sends included"),
+        ('send_errors', 'queries_send_errors_total', "DNS queries which failed to be sent to the nameserver"),
+        ('received', 'packets_received_total', "DNS packets received from the nameserver"),
+        ('matched', 'responses_matched_total', "DNS responses matched with a pending query"),
+        ('unexpected', 'responses_unexpected_total', "DNS responses dropped without a pending query"),
+        ('invalid', 'packets_invalid_total', "packets dropped as invalid DNS messages"),
+        ('timeouts', 'queries_timeout_total', "DNS queries timed out without a response"),
+    ]
+
+    def __init__(self, prefix='asyncdns', buckets=Histogram.BUCKETS):
+        self.prefix = prefix
+        self.buckets = buckets
+        self.servers = {}
+        self.gauges = []
+        self.pipelines = 0
+        self.lock = threading.Lock()
+
+    def server(self, nameserver):
+        """
+        return the metrics of the nameserver, created on its first query
+        """
+        metrics = self.servers.get(nameserver)
+
+        if metrics is None:
+            metrics = self.servers.setdefault(nameserver, ServerMetrics(self.buckets))
+
+        return metrics
+
+    def pipeline(self):
+        """
+        return the labels of a new pipeline, to tell its gauges from the ones of the other pipelines
+        """
+        with self.lock:
+            index = self.pipelines
+            self.pipelines += 1
+
+        return {'pipeline': index}
+
+    def gauge(self, name, help, func, **labels):
+        """
+        register a gauge whose value is returned by `func` when the metrics are rendered,
+        the gauges registered under the same name are rendered as one metric told apart by their labels
+        """
+        with self.lock:
+            self.gauges.append((name, help, func, labels))
+
+    def unregister(self, labels):
+        """
+        remove the gauges registered with the labels, so a closed pipeline is no longer rendered
+        """
+        with self.lock:
+            self.gauges = [gauge for gauge in self.gauges if gauge[3] != labels]
+
+    @staticmethod
+    def _format(labels):
+        if not labels:
+            return ''
+
+        return '{%s}' % ','.join(['%s="%s"' % (name, value) for name, value in labels])
+
+    @classmethod
+    def _labels(cls, nameserver, **extra):
+        return cls._format([('nameserver', nameserver[0]), ('port', nameserver[1])] + sorted(extra.items()))
+
+    @staticmethod
+    def _value(value):
+        if value == float('inf'):
+            return '+Inf'
+
+        return repr(float(value)) if isinstance(value, float) else str(value)
+
+    def render(self):
+        """
+        return the metrics in the Prometheus text exposition format
+        """
+        lines = []
+        servers = sorted(self.servers.items())
+
+        for attr, name, help in self.COUNTERS:
+            name = '%s_%s' % (self.prefix, name)
+
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s counter' % name)
+
+            for nameserver, metrics in servers:
+                lines.append('%s%s %d' % (name, self._labels(nameserver), getattr(metrics, attr)))
+
+        name = '%s_rtt_seconds' % self.prefix
+
+        lines.append('# HELP %s Round trip time of the DNS queries to the nameserver' % name)
+        lines.append('# TYPE %s histogram' % name)
+
+        for nameserver, metrics in servers:
+            for bound, count in metrics.rtt.cumulative():
+                lines.append('%s_bucket%s %d' % (name, self._labels(nameserver, le=self._value(bound)), count))
+
+            lines.append('%s_sum%s %s' % (name, self._labels(nameserver), self._value(metrics.rtt.sum)))
+            lines.append('%s_count%s %d' % (name, self._labels(nameserver), metrics.rtt.count))
+
+        with self.lock:
+            gauges = list(self.gauges)
+
+        names = []
+        series = {}
+
+        for name, help, func, labels in gauges:
+            if name not in series:
+                names.append((name, help))
+
+            series.setdefault(name, []).append((func, labels))
+
+        for name, help in names:
+            metric = '%s_%s' % (self.prefix, name)
+
+            lines.append('# HELP %s %s' % (metric, help))
+            lines.append('# TYPE %s gauge' % metric)
+
+            for func, labels in series[name]:
+                lines.append('%s%s %s' % (metric, self._format(sorted(labels.items())), self._value(func())))
+
+        return '\n'.join(lines) + '\n'
+
+class MetricsServer(threading.Thread):
+    """
+
+    MetricsServer serves the metrics on http://<host>:<port>/metrics for a Prometheus scraper
+
+    It listens on localhost by default, from a daemon thread of its own.
+
+    """
+    logger = logging.getLogger("asyncdns.metrics")
+
+    CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+    def __init__(self, metrics, host='127.0.0.1', port=0):
+        threading.Thread.__init__(self, name="asyncdns.metrics")
+
+        server = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+
+                    return
+
+                body = metrics.render()
+
+                self.send_response(200)
+                self.send_header('Content-Type', server.CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                server.logger.debug("%s %s", self.client_address[0], format % args)
+
+        self.metrics = metrics
+        self.httpd = BaseHTTPServer.HTTPServer((host, port), Handler)
+        self.host, self.port = self.httpd.server_address[:2]
+
+        self.setDaemon(True)
+        self.start()
+
+    def run(self):
+        self.httpd.serve_forever()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+from __future__ import with_statement
+
+import threading
+
+from collections import OrderedDict
+
+import dns.name
+
+class NameCache(object):
+    """
+
+    NameCache is a bounded intern table for the parsed domain names and their text forms
+
+    The same owner names, nameservers and mail exchanges recur across a scan,
+    so both the parsed dns.name.Name objects and the relativized strings are
+    interned and shared by the pipeline and resolver hot paths.
+
+    """
+    def __init__(self, capacity=65536):
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.names = OrderedDict()
+        self.texts = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.names) + len(self.texts)
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+
+        return float(self.hits) / total if total else 0.0
+
+    def stats(self):
+        return {
+            'names': len(self.names),
+            'texts': len(self.texts),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hit_rate,
+        }
+
+    def clear(self):
+        with self.lock:
+            self.names.clear()
+            self.texts.clear()
+            self.hits = self.misses = 0
+
+    def _lookup(self, table, key):
+        with self.lock:
+            value = table.get(key)
+
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+
+            return value
+
+    def _intern(self, table, key, value):
+        with self.lock:
+            value = table.setdefault(key, value)
+
+            while len(table) > self.capacity:
+                table.popitem(last=False)
+
+            return value
+
+    def from_text(self, text):
+        name = self._lookup(self.names, text)
+
+        if name is None:
+            name = dns.name.from_text(text, None)
+
+            if not name.is_absolute():
+                name = name.concatenate(dns.name.root)
+
+            name = self._intern(self.names, text, name)
+
+        return name
+
+    def to_text(self, name, relativize=True):
+        if not name.is_absolute():
+            return str(name)
+
+        key = (name.to_wire(), relativize)
+
+        text = self._lookup(self.texts, key)
+
+        if text is None:
+            if relativize:
+                text = str(name.choose_relativity(dns.name.root, True))
+            else:
+                text = str(name)
+
+            text = self._intern(self.texts, key, text)
+
+        return text
+
+shared = NameCache()
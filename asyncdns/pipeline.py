@@ -1,18 +1,29 @@
 #!/usr/bin/env python
 from __future__ import with_statement
 
+import os
 import sys
+import time
+import struct
 import logging
 import socket
 from errno import *
 import asyncore
 import threading
+import functools
 
 import traceback
 
 import Queue
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 import dns.name
+import dns.flags
+import dns.rcode
 import dns.rdatatype
 import dns.rdataclass
 import dns.message
@@ -20,37 +31,84 @@ import dns.resolver
 import dns.exception
 
 from timewheel import TimeWheel
+from utils import Future
+from executor import InlineExecutor
+from tcp import TcpPool
+from cache import ServerStats
+from proxy import SocksPool, SocksProtocolError
+from names import shared as shared_names
+from trace import RECEIVE, PARSE, MATCH, SEND, TIMEOUT, CALLBACK_START, CALLBACK_END
 
-class Pipeline(asyncore.dispatcher, threading.Thread):
-    logger = logging.getLogger("asyncdns.pipeline")
+class Waker(asyncore.file_dispatcher if fcntl else object):
+    """
 
-    def __init__(self, wheel=None, proxy=None, start=True):
-        asyncore.dispatcher.__init__(self)
-        threading.Thread.__init__(self, name="asyncdns.pipeline")
+    Waker interrupts the poll of the loop threads when the queries are queued by another thread
 
-        self.create_socket(socket.AF_INET, socket.SOCK_DGRAM)
+    The poll only watches the channels which had queries to send when it started,
+    so without a wake up the queries queued on an idle pipeline wait for the poll timeout.
 
-        if proxy:
-            proxy.wrap(self.socket)
+    """
+    def __init__(self, map=None):
+        reader, self.writer = os.pipe()
 
-        self.terminated = threading.Event()
-        self.task_queue = Queue.Queue()
+        asyncore.file_dispatcher.__init__(self, reader, map)
 
-        self.pending_tasks_lock = threading.Lock()
-        self.pending_tasks = {}
+        os.close(reader)
 
-        self.wheel = wheel
+        fcntl.fcntl(self.writer, fcntl.F_SETFL, fcntl.fcntl(self.writer, fcntl.F_GETFL, 0) | os.O_NONBLOCK)
 
-        if self.wheel is None:
-            self.wheel = TimeWheel()
+    def writable(self):
+        return False
 
-        self.setDaemon(True)
+    def handle_read(self):
+        try:
+            self.recv(4096)
+        except OSError:
+            # the pipe was drained by an earlier wake up
+            pass
 
-        if start:
-            self.start()
+    def wake(self):
+        try:
+            os.write(self.writer, 'x')
+        except OSError:
+            # the pipe is full, so the loop will be woken anyway
+            pass
 
-    def __len__(self):
-        return self.queued + self.pending
+    def close(self):
+        asyncore.file_dispatcher.close(self)
+
+        os.close(self.writer)
+
+class Channel(asyncore.dispatcher):
+    """
+
+    Channel is the UDP socket of a pipeline for one address family
+
+    Each channel queues its own queries and keeps its own pending table,
+    while the lock, the timers, the executor and the tcp pool are shared with the pipeline,
+    so all the channels are served by the same asyncore loop.
+
+    """
+    logger = logging.getLogger("asyncdns.pipeline")
+
+    MAX_PACKET_SIZE = 65535
+
+    def __init__(self, pipeline, family):
+        asyncore.dispatcher.__init__(self, map=pipeline.map)
+
+        self.create_socket(family, socket.SOCK_DGRAM)
+
+        self.pipeline = pipeline
+        self.relays = None
+        self.task_queue = Queue.Queue()
+        self.pending_tasks = {}
+        # the number of the pending tasks, kept under the pending tasks lock
+        self.pending_count = 0
+        self.buffer = bytearray(self.MAX_PACKET_SIZE)
+        self.view = memoryview(self.buffer)
+        # the queries to the socks relays are encapsulated in place, behind the cached header
+        self.send_buffer = bytearray(self.MAX_PACKET_SIZE)
+        self.send_view = memoryview(self.send_buffer)
 
     @property
     def queued(self):
@@ -58,14 +116,7 @@ class Pipeline(asyncore.dispatcher, threading.Thread):
 
     @property
     def pending(self):
-        return sum([len(tasks) for tasks in self.pending_tasks.values()])
-
-    @staticmethod
-    def system_nameservers():
-        return dns.resolver.get_default_resolver().nameservers
-
-    def isTerminated(self):
-        return self.terminated.isSet()
+        return self.pending_count
 
     def handle_connect(self):
         pass
@@ -74,71 +125,194 @@ class Pipeline(asyncore.dispatcher, threading.Thread):
         self.close()
 
     def handle_read(self):
-        packet, nameserver = self.recvfrom(65535)
+        packet, nameserver = self.recvfrom(self.MAX_PACKET_SIZE)
 
         if packet:
+            pipeline = self.pipeline
+            tracing = pipeline.tracer is not None
+
+            if tracing:
+                arrived = time.time()
+
             try:
                 response = dns.message.from_wire(packet)
             except dns.exception.FormError:
                 self.logger.warn("drop invalid DNS packet from %s:%d", *nameserver)
 
+                if pipeline.metrics is not None:
+                    with pipeline.pending_tasks_lock:
+                        server = pipeline.metrics.server(nameserver)
+                        server.received += 1
+                        server.invalid += 1
+
                 return
 
-            with self.pending_tasks_lock:
+            if tracing:
+                parsed = time.time()
+
+            matched = []
+
+            with pipeline.pending_tasks_lock:
+                server = None if pipeline.metrics is None else pipeline.metrics.server(nameserver)
+
+                if server is not None:
+                    server.received += 1
+
                 if nameserver not in self.pending_tasks:
                     self.logger.warn("drop unexpected DNS packet from %s:%d", *nameserver)
 
+                    if server is not None:
+                        server.unexpected += 1
+
                     return
 
                 tasks = self.pending_tasks[nameserver]
 
                 for request in tasks.keys():
                     if request.is_response(response):
-                        callback, timer = tasks[request]
-
-                        del tasks[request]
+                        callback, timer, expired, sent, relay, trace = tasks.pop(request)
 
                         timer.cancel()
 
-                        try:
-                            callback(nameserver, response)
-                        except Exception, e:
-                            self.logger.warn("fail to execute callback: %s", e)
-                            self.logger.debug("exc: %s", traceback.format_exc())
-                            self.logger.debug("res: %s", response)
+                        matched.append((request, callback, expired, sent, relay, trace))
+
+                self.pending_count -= len(matched)
+
+                received = time.time()
+
+                if server is not None:
+                    if not matched:
+                        server.unexpected += 1
+
+                    for request, callback, expired, sent, relay, trace in matched:
+                        server.matched += 1
+                        server.rtt.observe(received - sent)
+
+            for request, callback, expired, sent, relay, trace in matched:
+                if trace is not None:
+                    trace.mark(RECEIVE, arrived)
+                    trace.mark(PARSE, parsed)
+                    trace.mark(MATCH, received)
+
+                pipeline.servers.update(nameserver, received - sent)
+
+                if relay is not None:
+                    self.relays.update(relay, received - sent)
+
+                if request.edns >= 0 and response.rcode() == dns.rcode.FORMERR:
+                    self.logger.info("disable EDNS for %s:%d which does not support it", *nameserver)
+
+                    pipeline.no_edns[nameserver] = time.time()
+
+                    self.task_queue.put_nowait((pipeline._without_edns(request), expired, callback, nameserver, trace))
+                elif pipeline.tcp is not None and response.flags & dns.flags.TC:
+                    self.logger.info("retry the truncated response from %s:%d over tcp", *nameserver)
+
+                    if trace is not None:
+                        callback = functools.partial(pipeline._invoke_callback, callback, trace=trace)
+
+                    pipeline.tcp.query(request, expired, callback, nameserver)
+                else:
+                    pipeline.executor.submit(pipeline._invoke_callback, callback, nameserver, response, trace)
 
     def writable(self):
-        return not self.task_queue.empty()
+        # the queries wait in the queue until a proxy has associated a relay
+        if self.relays is not None and not self.relays.ready:
+            return False
 
-    def handle_write(self):
-        request, expired, callback, nameserver = self.task_queue.get_nowait()
+        return not self.task_queue.empty() and not self.pipeline.executor.busy
 
+    def handle_write(self):
         try:
-            packet = request.to_wire()
+            request, expired, callback, nameserver, trace = self.task_queue.get_nowait()
+        except Queue.Empty:
+            return
+
+        pipeline = self.pipeline
+        relay = None
+
+        if self.relays is not None:
+            relay = self.relays.choose()
 
-            if self.sendto(packet, nameserver):
-                with self.pending_tasks_lock:
-                    tasks = self.pending_tasks.setdefault(nameserver, {})
+            if relay is None:
+                self.task_queue.put_nowait((request, expired, callback, nameserver, trace))
 
-                    def ontimeout():
-                        del tasks[request]
+                return
+
+        with pipeline.pending_tasks_lock:
+            tasks = self.pending_tasks.setdefault(nameserver, {})
+
+            def ontimeout():
+                with pipeline.pending_tasks_lock:
+                    if tasks.pop(request, None) is None:
+                        return
+
+                    self.pending_count -= 1
+
+                    if pipeline.metrics is not None:
+                        pipeline.metrics.server(nameserver).timeouts += 1
+
+                pipeline.servers.timeout(nameserver)
+
+                if relay is not None:
+                    self.relays.timeout(relay)
 
-                        try:
-                            callback(nameserver, socket.timeout("dns query to %s was timeout after %d seconds" % (nameserver[0], expired)))
-                        except Exception, e:
-                            self.logger.warn("fail to execute callback: %s", e)
-                            self.logger.debug("exc: %s", traceback.format_exc())
-                            self.logger.debug("res: %s", request)
+                if trace is not None:
+                    trace.mark(TIMEOUT)
 
-                    timer = self.wheel.create(ontimeout, expired)
+                pipeline.executor.submit(pipeline._invoke_callback, callback, nameserver,
+                                         socket.timeout("dns query to %s was timeout after %d seconds" % (nameserver[0], expired)),
+                                         trace)
 
-                    tasks[request] = (callback, timer)
+            timer = pipeline.wheel.create(ontimeout, expired)
+
+            tasks[request] = (callback, timer, expired, time.time(), relay, trace)
+
+            self.pending_count += 1
+
+            if pipeline.metrics is not None:
+                pipeline.metrics.server(nameserver).sent += 1
+
+        try:
+            sent = self.sendto(request.to_wire(), nameserver, relay)
         except Exception, e:
             self.logger.warn("fail to send query, %s", e)
 
-    def sendto(self, data, address):
+            sent = e
+
+        if not sent or isinstance(sent, Exception):
+            with pipeline.pending_tasks_lock:
+                if tasks.pop(request, None) is not None:
+                    self.pending_count -= 1
+
+                    if pipeline.metrics is not None:
+                        pipeline.metrics.server(nameserver).send_errors += 1
+
+            timer.cancel()
+
+            if relay is not None:
+                self.relays.release(relay)
+
+            if isinstance(sent, Exception):
+                pipeline.executor.submit(pipeline._invoke_callback, callback, nameserver, sent, trace)
+            else:
+                self.task_queue.put_nowait((request, expired, callback, nameserver, trace))
+        elif trace is not None:
+            trace.mark(SEND)
+
+    def sendto(self, data, address, relay=None):
         try:
-            return self.socket.sendto(data, 0, address)
+            if relay is None:
+                return self.socket.sendto(data, 0, address)
+
+            relay_address = relay.address
+
+            if relay_address is None:
+                return 0
+
+            size = self.relays.proto.pack_packet(self.send_view, address[0], address[1], data)
+
+            return self.socket.sendto(self.send_view[:size], 0, relay_address)
         except socket.error, why:
             if why[0] == EWOULDBLOCK:
                 return 0
@@ -149,9 +323,26 @@ class Pipeline(asyncore.dispatcher, threading.Thread):
 
             return 0
 
-    def recvfrom(self, bufize):
+    def recvfrom(self, bufsize):
         try:
-            return self.socket.recvfrom(65535)
+            nbytes, address = self.socket.recvfrom_into(self.buffer, bufsize)
+
+            if self.relays is None:
+                return self.view[:nbytes].tobytes(), address[:2]
+
+            if not self.relays.relayed(address[:2]):
+                self.logger.debug("drop packet from %s:%d which is not a proxy relay", address[0], address[1])
+
+                return None, None
+
+            # the relayed datagram is decapsulated in the receive buffer, only its payload is copied out
+            host, port, offset = self.relays.proto.unpack_header(self.view[:nbytes])
+
+            return self.view[offset:nbytes].tobytes(), (host, port)
+        except (SocksProtocolError, struct.error), e:
+            self.logger.warn("drop invalid packet from the proxy relay %s:%d, %s", address[0], address[1], e)
+
+            return None, None
         except socket.error, why:
             if why[0] in [EWOULDBLOCK, EAGAIN]:
                 return None, None
@@ -160,10 +351,246 @@ class Pipeline(asyncore.dispatcher, threading.Thread):
 
                 raise
 
+class Pipeline(Channel, threading.Thread):
+    """
+
+    Pipeline multiplexes the DNS queries over one UDP socket per address family
+
+    The pipeline itself is the IPv4 channel, the queries to the IPv6 nameservers
+    are routed to a second channel when the host supports IPv6.
+
+    When a socks 5 proxy (or a list of them) is given, their UDP associations are negotiated
+    on the loop by a SocksPool, the queries are queued until a relay is ready and encapsulated
+    for the relay chosen by the pool, and the queries in flight through a dropped association
+    are moved to the other relays.
+
+    With a `tracer`, each query to a nameserver carries a trace which is marked at the stages
+    from its enqueue to the end of its callback, see asyncdns.trace. With a `metrics` registry,
+    the counters and round trip times of each nameserver are kept up to date as the queries go,
+    see asyncdns.metrics.
+
+    """
+    logger = logging.getLogger("asyncdns.pipeline")
+
+    DEFAULT_PAYLOAD = 1232
+    NO_EDNS_TTL = 3600
+
+    def __init__(self, wheel=None, proxy=None, start=True, names=None, executor=None, tcp=True,
+                 payload=DEFAULT_PAYLOAD, tracer=None, metrics=None):
+        # the channels, the tcp connections, the relays and the waker are only polled by this pipeline
+        self.map = {}
+
+        Channel.__init__(self, self, socket.AF_INET)
+        threading.Thread.__init__(self, name="asyncdns.pipeline")
+
+        self.proxy = proxy
+        self.tracer = tracer
+        self.metrics = metrics
+
+        if proxy:
+            # the relayed datagrams are only received on the interface facing the proxy
+            self.socket.bind(((proxy[0] if isinstance(proxy, (list, tuple)) else proxy).interface(), 0))
+
+        self.payload = payload
+        # the nameservers which answered FORMERR to EDNS, with the time they did
+        self.no_edns = {}
+        self.servers = ServerStats()
+
+        self.terminated = threading.Event()
+
+        self.pending_tasks_lock = threading.Lock()
+
+        self.waker = Waker(self.map) if fcntl else None
+
+        self.wheel = wheel
+
+        if self.wheel is None:
+            self.wheel = TimeWheel()
+
+        self.names = names
+
+        if self.names is None:
+            self.names = shared_names
+
+        self.executor = executor
+
+        if self.executor is None:
+            self.executor = InlineExecutor()
+
+        # the channels are not polled for writing while the executor is busy, until it wakes the loop
+        if self.waker is not None:
+            self.executor.watch(self.waker.wake)
+
+        if proxy and tcp:
+            self.logger.info("disable the tcp fallback when querying through the proxy")
+
+            tcp = None
+
+        self.tcp = TcpPool(self) if tcp is True else tcp
+
+        if self.tcp is False:
+            self.tcp = None
+
+        self.inet6 = None
+
+        if proxy:
+            self.logger.info("disable the IPv6 channel when querying through the proxy")
+        elif socket.has_ipv6:
+            try:
+                self.inet6 = Channel(self, socket.AF_INET6)
+            except socket.error, e:
+                self.logger.info("disable the IPv6 channel, %s", e)
+
+        if proxy:
+            self.relays = SocksPool(proxy, self.socket.getsockname(), self.wheel, self._ondisassociated, self.map)
+
+        self.labels = None
+
+        if metrics is not None:
+            self.labels = labels = metrics.pipeline()
+
+            metrics.gauge('queued', "DNS queries waiting to be sent", lambda: self.queued, **labels)
+            metrics.gauge('pending', "DNS queries waiting for a response", lambda: self.pending, **labels)
+            metrics.gauge('timers', "Timers armed on the time wheel", lambda: len(self.wheel), **labels)
+
+        self.setDaemon(True)
+
+        if start:
+            self.start()
+
+    def __len__(self):
+        return self.queued + self.pending
+
+    @property
+    def channels(self):
+        return [self] if self.inet6 is None else [self, self.inet6]
+
+    @property
+    def queued(self):
+        return sum([channel.task_queue.qsize() for channel in self.channels])
+
+    @property
+    def pending(self):
+        return sum([channel.pending_count for channel in self.channels])
+
+    def channel(self, nameserver):
+        """
+        return the channel of the nameserver address family, or None if it is unreachable
+        """
+        return self.inet6 if ':' in nameserver[0] else self
+
+    @staticmethod
+    def system_nameservers():
+        return dns.resolver.get_default_resolver().nameservers
+
+    def isTerminated(self):
+        return self.terminated.isSet()
+
+    def _ondisassociated(self, relay, error, associated):
+        if associated:
+            moved = []
+
+            # the queries in flight through the dropped relay are sent again through the others
+            with self.pending_tasks_lock:
+                for nameserver, tasks in self.pending_tasks.items():
+                    for request, task in tasks.items():
+                        if task[4] is relay:
+                            del tasks[request]
+
+                            self.pending_count -= 1
+
+                            moved.append((request, nameserver, task))
+
+            for request, nameserver, (callback, timer, expired, sent, relay, trace) in moved:
+                timer.cancel()
+
+                self.task_queue.put_nowait((request, expired, callback, nameserver, trace))
+        elif self.relays is None or not self.relays.ready:
+            # the queries queued while no relay ever came up are failed instead of waiting for the next one
+            while True:
+                try:
+                    request, expired, callback, nameserver, trace = self.task_queue.get_nowait()
+                except Queue.Empty:
+                    break
+
+                self.executor.submit(self._invoke_callback, callback, nameserver,
+                                     socket.error("fail to associate with proxy @ %s:%d, %s" % (relay.proxy.host, relay.proxy.port, error)),
+                                     trace)
+
+    def close(self):
+        self.terminated.set()
+
+        # the loop is woken up to stop, so its thread is gone once the pipeline is closed
+        if self.waker is not None:
+            self.waker.wake()
+
+        if self.isAlive() and threading.currentThread() is not self:
+            self.join()
+
+        if self.labels is not None:
+            self.metrics.unregister(self.labels)
+
+        if self.relays is not None:
+            self.relays.close()
+
+        if self.waker is not None:
+            self.executor.unwatch(self.waker.wake)
+            self.waker.close()
+
+        asyncore.dispatcher.close(self)
+
+        if self.inet6 is not None:
+            self.inet6.close()
+
+        if self.tcp is not None:
+            self.tcp.close()
+
+    def _edns_disabled(self, nameserver):
+        """
+        check whether EDNS is disabled for the nameserver, it is tried again after NO_EDNS_TTL seconds
+        """
+        disabled = self.no_edns.get(nameserver)
+
+        if disabled is None:
+            return False
+
+        if time.time() - disabled < self.NO_EDNS_TTL:
+            return True
+
+        self.logger.info("try EDNS again for %s:%d", *nameserver)
+
+        self.no_edns.pop(nameserver, None)
+
+        return False
+
+    @staticmethod
+    def _without_edns(request):
+        question = request.question[0]
+
+        plain = dns.message.make_query(question.name, question.rdtype, question.rdclass)
+        plain.id = request.id
+
+        return plain
+
+    def _invoke_callback(self, callback, nameserver, response, trace=None):
+        if trace is not None:
+            trace.mark(CALLBACK_START)
+
+        try:
+            callback(nameserver, response)
+        except Exception, e:
+            self.logger.warn("fail to execute callback: %s", e)
+            self.logger.debug("exc: %s", traceback.format_exc())
+            self.logger.debug("res: %s", response)
+
+        if trace is not None:
+            trace.mark(CALLBACK_END)
+            trace.finish()
+
     def query(self, qname, rdtype=dns.rdatatype.A, rdclass=dns.rdataclass.IN,
               expired=30, callback=None, nameservers=None, port=53):
         if isinstance(qname, (str, unicode)):
-            qname = dns.name.from_text(qname, None)
+            qname = self.names.from_text(qname)
         if isinstance(rdtype, str):
             rdtype = dns.rdatatype.from_text(rdtype)
         if isinstance(rdclass, str):
@@ -175,15 +602,51 @@ class Pipeline(asyncore.dispatcher, threading.Thread):
         if nameservers is None:
             nameservers = self.system_nameservers()
 
+        if callback is None:
+            return self.query_async(qname, rdtype, rdclass, expired, nameservers, port).result(expired)
+
         self.logger.info("query name servers %s for type %s and class %s record of domain %s in %d seconds",
                          ', '.join(nameservers),
                          dns.rdatatype.to_text(rdtype),
                          dns.rdataclass.to_text(rdclass),
                          qname, expired)
 
-        request = dns.message.make_query(qname, rdtype, rdclass)
+        if self.payload:
+            request = dns.message.make_query(qname, rdtype, rdclass, use_edns=0, payload=self.payload)
+        else:
+            request = dns.message.make_query(qname, rdtype, rdclass)
+
+        plain = None
+        tracer = self.tracer
+
+        for nameserver in nameservers:
+            nameserver = (nameserver, port)
+            channel = self.channel(nameserver)
+            trace = None if tracer is None else tracer.start(request, nameserver)
+
+            if channel is None:
+                self.executor.submit(self._invoke_callback, callback, nameserver,
+                                     socket.error("no channel to reach nameserver %s" % nameserver[0]), trace)
+            elif self.relays is not None and self.relays.rejected:
+                self.executor.submit(self._invoke_callback, callback, nameserver,
+                                     socket.error("the proxies rejected the association"), trace)
+            elif request.edns >= 0 and self._edns_disabled(nameserver):
+                if plain is None:
+                    plain = self._without_edns(request)
+
+                channel.task_queue.put_nowait((plain, expired, callback, nameserver, trace))
+            else:
+                channel.task_queue.put_nowait((request, expired, callback, nameserver, trace))
+
+        if self.waker is not None:
+            self.waker.wake()
 
-        found = None if callback else threading.Event()
+    def query_async(self, qname, rdtype=dns.rdatatype.A, rdclass=dns.rdataclass.IN,
+                    expired=30, nameservers=None, port=53):
+        if nameservers is None:
+            nameservers = self.system_nameservers()
+
+        future = Future()
         results_lock = threading.Lock()
         results = []
 
@@ -191,25 +654,21 @@ class Pipeline(asyncore.dispatcher, threading.Thread):
             with results_lock:
                 results.append((nameserver, response))
 
-                if not isinstance(response, Exception) or \
-                   len(results) == len(nameservers):
-                    found.set()
+                finished = len(results) == len(nameservers)
 
-        for nameserver in nameservers:
-            self.task_queue.put_nowait((request, expired, callback or collect_result, (nameserver, port)))
-
-        if callback is None:
-            found.wait(expired)
+            if not isinstance(response, Exception):
+                future.set_result((nameserver, response))
+            elif finished:
+                future.set_exception(response)
 
-            for nameserver, result in results:
-                if not isinstance(result, Exception):
-                    return nameserver, result
+        self.query(qname, rdtype, rdclass, expired, collect_result, nameservers, port)
 
-            raise results.pop()[1]
+        return future
 
     def run(self):
         try:
-            asyncore.loop(timeout=1, use_poll=True)
+            while self.map and not self.isTerminated():
+                asyncore.loop(timeout=1, use_poll=True, map=self.map, count=1)
         except Exception, e:
             self.logger.warn("fail to run asyncdns pipeline, %s", e)
 
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+from __future__ import with_statement
+
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+class Prefetcher(object):
+    """
+
+    Prefetcher refreshes the popular cached answers in the background before they expire
+
+    Each cache hit counts for its question, once a question got `min_hits` hits within `window` seconds,
+    a time wheel timer is armed to resolve it again when the cached answer enters the last `threshold`
+    of its TTL, so the callers of the hot names never wait for the upstream nameservers.
+
+    The hit counts are kept for the `max_tracked` most recently hit questions only,
+    so a long tail of names hit once in a while neither grows the table nor gets prefetched.
+
+    """
+    logger = logging.getLogger("asyncdns.prefetch")
+
+    def __init__(self, resolver, threshold=0.1, min_hits=2, window=60, max_tracked=65536):
+        self.resolver = resolver
+        self.threshold = threshold
+        self.min_hits = min_hits
+        self.window = window
+        self.max_tracked = max_tracked
+        self.lock = threading.Lock()
+        # question -> (start of the counting window, hits), from the least recently hit
+        self.popular = OrderedDict()
+        self.scheduled = {}
+        self.refreshed = set()
+        self.prefetched = 0
+        self.failed = 0
+        self.useful = 0
+
+    def __len__(self):
+        return len(self.scheduled)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'tracked': len(self.popular),
+                'scheduled': len(self.scheduled),
+                'prefetched': self.prefetched,
+                'failed': self.failed,
+                'useful': self.useful,
+            }
+
+    def touch(self, key, remaining, ttl, query):
+        """
+        count a cache hit of the question `key`, and schedule its refresh once it is popular enough
+
+        `query` is the (expired, nameservers, port, iterative, follow_cname) to resolve it again
+        """
+        with self.lock:
+            if key in self.refreshed:
+                self.refreshed.discard(key)
+
+                self.useful += 1
+
+            if key in self.scheduled:
+                return
+
+            now = time.time()
+            since, hits = self.popular.pop(key, (now, 0))
+
+            if now - since > self.window:
+                since, hits = now, 0
+
+            hits += 1
+
+            if hits < self.min_hits:
+                self.popular[key] = (since, hits)
+
+                if len(self.popular) > self.max_tracked:
+                    self.popular.popitem(last=False)
+
+                return
+
+            delay = max(remaining - int(ttl * self.threshold), 0)
+
+            self.scheduled[key] = self.resolver.wheel.create(lambda: self.refresh(key, query), delay)
+
+    def refresh(self, key, query):
+        qname, rdtype, rdclass = key
+        expired, nameservers, port, iterative, follow_cname = query
+
+        self.logger.debug("prefetch the %s record of domain %s", rdtype, qname)
+
+        def onfinish(done):
+            with self.lock:
+                self.scheduled.pop(key, None)
+
+                if done.error is not None:
+                    self.failed += 1
+                else:
+                    self.prefetched += 1
+
+            if done.error is not None:
+                self.logger.info("fail to prefetch domain %s, %s", qname, done.error)
+
+                return
+
+            if self.resolver.cache.put(done.value[1]):
+                with self.lock:
+                    self.refreshed.add(key)
+
+        try:
+            self.resolver._fetch(qname, rdtype, rdclass, expired, nameservers, port,
+                                 iterative, follow_cname).add_done_callback(onfinish)
+        except Exception, e:
+            self.logger.warn("fail to prefetch domain %s, %s", qname, e)
+
+            with self.lock:
+                self.scheduled.pop(key, None)
+                self.failed += 1
+
+    def cancel(self):
+        with self.lock:
+            timers, self.scheduled = self.scheduled.values(), {}
+
+        for timer in timers:
+            timer.cancel()
@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+from __future__ import with_statement
+
+import os
+import sys
+import time
+import signal
+import marshal
+import logging
+import tempfile
+import threading
+
+class Profiler(threading.Thread):
+    """
+
+    Profiler samples the stacks of the asyncdns threads for a window and writes them to disk
+
+    Every `interval` seconds, the current frames of the threads named in `threads` are taken
+    from sys._current_frames() and counted by stack, so the profiled threads run at full speed,
+    they only share the GIL with one more thread waking up now and then.
+
+    At the end of the window, the samples are written to `path` in the `collapsed` stack format
+    of the flame graph tools, one "thread;outer;...;inner count" line per stack,
+    or in the `pstats` format, to be loaded by pstats.Stats with the sample counts as the times.
+    The path must not exist yet, the profile is only readable by the user.
+
+    """
+    logger = logging.getLogger("asyncdns.profiler")
+
+    THREADS = ['asyncdns.pipeline', 'asyncdns.timewheel', 'asyncdns.dispatcher', 'asyncdns.executor']
+
+    FORMATS = ['collapsed', 'pstats']
+
+    def __init__(self, path, duration=10, interval=0.01, format='collapsed', threads=THREADS, start=True):
+        threading.Thread.__init__(self, name="asyncdns.profiler")
+
+        if format not in self.FORMATS:
+            raise ValueError("unknown profile format %s" % format)
+
+        self.path = path
+        self.duration = duration
+        self.interval = interval
+        self.format = format
+        self.threads = threads
+        self.samples = {}
+        self.count = 0
+        self.finished = threading.Event()
+        self.stopped = threading.Event()
+
+        self.setDaemon(True)
+
+        if start:
+            self.start()
+
+    def stop(self):
+        """
+        end the window early, the samples taken so far are still written
+        """
+        self.stopped.set()
+
+    def wait(self, timeout=None):
+        self.finished.wait(timeout)
+
+        return self.finished.isSet()
+
+    @staticmethod
+    def _stack(frame):
+        """
+        return the (file, line, function) of the frames from the outermost one
+        """
+        stack = []
+
+        while frame is not None:
+            code = frame.f_code
+
+            stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+
+            frame = frame.f_back
+
+        stack.reverse()
+
+        return tuple(stack)
+
+    def sample(self):
+        names = dict([(thread.ident, thread.name) for thread in threading.enumerate()
+                      if thread.name in self.threads])
+
+        for ident, frame in sys._current_frames().items():
+            name = names.get(ident)
+
+            if name is not None:
+                key = (name, self._stack(frame))
+
+                self.samples[key] = self.samples.get(key, 0) + 1
+
+        self.count += 1
+
+    def collapsed(self):
+        """
+        return the samples as the collapsed stacks, the threads of the same name are merged
+        """
+        stacks = {}
+
+        for (name, stack), count in self.samples.items():
+            line = ';'.join([name] + ["%s (%s:%d)" % (func, os.path.basename(filename), lineno)
+                                      for filename, lineno, func in stack])
+
+            stacks[line] = stacks.get(line, 0) + count
+
+        return ''.join(["%s %d\n" % (line, count) for line, count in sorted(stacks.items())])
+
+    def stats(self):
+        """
+        return the samples as a pstats dictionary, a sample counts `interval` seconds
+
+        A function is counted once per sample as a primitive call, its own time is the samples
+        where it is the innermost frame, its cumulative time the samples where it is on the stack.
+        """
+        stats = {}
+
+        for (name, stack), count in self.samples.items():
+            elapsed = count * self.interval
+            seen = set()
+
+            for index, func in enumerate(stack):
+                entry = stats.setdefault(func, [0, 0, 0.0, 0.0, {}])
+
+                innermost = index == len(stack) - 1
+
+                if innermost:
+                    entry[2] += elapsed
+
+                if func not in seen:
+                    seen.add(func)
+
+                    entry[0] += count
+                    entry[1] += count
+                    entry[3] += elapsed
+
+                if index > 0:
+                    caller = stack[index-1]
+                    nc, cc, tt, ct = entry[4].get(caller, (0, 0, 0.0, 0.0))
+
+                    entry[4][caller] = (nc + count, cc + count, tt + (elapsed if innermost else 0.0), ct + elapsed)
+
+        return dict([(func, tuple(entry)) for func, entry in stats.items()])
+
+    def dump(self):
+        # the file is created afresh with mode 0600, an existing file or symlink is never written through
+        fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_NOFOLLOW', 0), 0600)
+
+        with os.fdopen(fd, 'wb') as f:
+            if self.format == 'pstats':
+                marshal.dump(self.stats(), f)
+            else:
+                f.write(self.collapsed())
+
+    def run(self):
+        deadline = time.time() + self.duration
+
+        self.logger.info("profile threads %s for %s seconds", ', '.join(self.threads), self.duration)
+
+        try:
+            while not self.stopped.isSet() and time.time() < deadline:
+                self.sample()
+
+                self.stopped.wait(self.interval)
+
+            self.dump()
+
+            self.logger.info("wrote %d samples of %d stacks to %s", self.count, len(self.samples), self.path)
+        except Exception, e:
+            self.logger.warn("fail to profile threads, %s", e)
+        finally:
+            self.finished.set()
+
+def profile_path(format='collapsed', directory=None):
+    """
+    return a new asyncdns-<pid>-<time>.<format> path in the directory, or the temporary directory
+    """
+    return os.path.join(directory or tempfile.gettempdir(),
+                        "asyncdns-%d-%s.%s" % (os.getpid(), time.strftime("%Y%m%d%H%M%S"), format))
+
+def profile(path=None, duration=10, interval=0.01, format='collapsed', threads=Profiler.THREADS):
+    """
+    start profiling the threads for `duration` seconds, to `path` or a new file in the temporary directory
+    """
+    return Profiler(path or profile_path(format), duration, interval, format, threads)
+
+def install(signum=getattr(signal, 'SIGUSR2', None), duration=10, interval=0.01, format='collapsed',
+            threads=Profiler.THREADS, directory=None):
+    """
+    profile the threads for `duration` seconds each time the process receives the signal
+
+    The profiles are written to new files in `directory`, or the temporary directory.
+    A signal received while a profile is running is ignored. Like any signal handler,
+    it must be installed from the main thread.
+    """
+    running = [None]
+
+    def onsignal(signum, frame):
+        if running[0] is not None and running[0].isAlive():
+            Profiler.logger.info("ignore signal %d, the profiler is running", signum)
+
+            return
+
+        running[0] = profile(profile_path(format, directory), duration, interval, format, threads)
+
+    return signal.signal(signum, onsignal)
@@ -6,6 +6,12 @@ import logging
 import socket
 import errno
 import struct
+import asyncore
+import threading
+from collections import OrderedDict
+
+from cache import ServerStats
+from stream import StreamReader
 
 class SocksProtocolError(Exception):
     pass
@@ -45,6 +51,9 @@ class SocksProtocol(object):
     ADDR_TYPE_DOMAIN = 3
     ADDR_TYPE_IPV6 = 4
 
+    MAX_HEADERS = 4096
+    IPV4_HEADER = struct.Struct("!2xBBIH")
+
     REPLY_MESSAGE = [
         'succeeded',
         'general SOCKS server failure',
@@ -61,18 +70,27 @@ class SocksProtocol(object):
         if version not in [self.VER_SOCKS_5]:
             raise InvalidSocksVersion(version)
 
-        self.sock = sock
+        self.attach(sock)
         self.username = username
         self.passwd = passwd
         self.version = version
+        # the headers by destination and the hosts by IPv4 source, the least recently used are evicted
+        self.lock = threading.Lock()
+        self.headers = OrderedDict()
+        self.hosts = OrderedDict()
+
+    def attach(self, sock):
+        """
+        use the blocking control connection `sock` for the negotiation
+        """
+        self.sock = sock
+        self.reader = StreamReader(sock, 512)
 
     def recvall(self, bytes):
-        buf = ""
-
-        while len(buf) < bytes:
-            buf += self.sock.recv(bytes-len(buf))
-
-        return buf
+        try:
+            return self.reader.read(bytes)
+        except EOFError, e:
+            raise SocksProtocolError("proxy closed the connection, %s" % e)
 
     def make_connect(self, methods=[METHOD_NO_AUTH, METHOD_SIMPLE]):
         if methods in [[], None]:
@@ -84,7 +102,10 @@ class SocksProtocol(object):
         return buf
 
     def parse_connect(self):
-        version, method = struct.unpack("2B", self.recvall(2))
+        return self.unpack_connect(self.recvall(2))
+
+    def unpack_connect(self, buf):
+        version, method = struct.unpack("2B", buf)
 
         if version != self.version:
             raise InvalidSocksVersion(version)
@@ -116,13 +137,19 @@ class SocksProtocol(object):
                chr(len(passwd)) + passwd
 
     def parse_simple_auth(self):
-        version, reply_code = struct.unpack("2B", self.recvall(2))
+        try:
+            return self.unpack_simple_auth(self.recvall(2))
+        except AuthenticationError:
+            self.sock.close()
+            raise
+
+    def unpack_simple_auth(self, buf):
+        version, reply_code = struct.unpack("2B", buf)
 
         if version != self.AUTH_SIMPLE_VERSION:
             raise InvalidSocksVersion(version)
 
         if reply_code != 0:
-            self.sock.close()
             raise AuthenticationError(reply_code)
 
         return True
@@ -147,7 +174,31 @@ class SocksProtocol(object):
         return buf
 
     def parse_request(self):
-        version, reply_code, _, addr_type = struct.unpack("4B", self.recvall(4))
+        buf = self.recvall(5)
+        buf += self.recvall(self.request_size(buf) - len(buf))
+
+        return self.unpack_request(buf)
+
+    def request_size(self, buf):
+        """
+        return the size of the reply to a request starting with `buf`, or None if it is too short to tell
+        """
+        if len(buf) < 5:
+            return None
+
+        addr_type = ord(buf[3])
+
+        if addr_type == self.ADDR_TYPE_IPV4:
+            return 4 + 4 + 2
+        elif addr_type == self.ADDR_TYPE_DOMAIN:
+            return 4 + 1 + ord(buf[4]) + 2
+        elif addr_type == self.ADDR_TYPE_IPV6:
+            return 4 + 16 + 2
+        else:
+            return 4
+
+    def unpack_request(self, buf):
+        version, reply_code, _, addr_type = struct.unpack("4B", buf[:4])
 
         if version != self.version:
             raise InvalidSocksVersion(version)
@@ -160,13 +211,15 @@ class SocksProtocol(object):
             raise SocksProtocolError("unknown reply code: %d" % reply_code)
 
         if addr_type == self.ADDR_TYPE_IPV4:
-            host = socket.inet_ntoa(self.recvall(4))
+            host = socket.inet_ntoa(buf[4:8])
         elif addr_type == self.ADDR_TYPE_DOMAIN:
-            host = self.recvall(ord(self.recvall(1)))
+            host = buf[5:5+ord(buf[4])]
+        elif addr_type == self.ADDR_TYPE_IPV6:
+            host = socket.inet_ntop(socket.AF_INET6, buf[4:20])
         else:
             raise SocksProtocolError("unsupport address type: %d" % addr_type)
 
-        port = struct.unpack(">H", self.recvall(2))[0]
+        port = struct.unpack(">H", buf[-2:])[0]
 
         return host, port
 
@@ -181,43 +234,271 @@ class SocksProtocol(object):
 
         return proxy_host, proxy_port
 
-    def make_packet(self, host, port, data):
-        buf = "\x00\x00\x00"
+    def _cached(self, cache, key, build):
+        with self.lock:
+            value = cache.pop(key, None)
+
+            if value is None:
+                value = build(key)
+
+                while len(cache) >= self.MAX_HEADERS:
+                    cache.popitem(last=False)
+
+            cache[key] = value
+
+            return value
+
+    def _build_header(self, destination):
+        host, port = destination
 
         try:
-            buf += chr(self.ADDR_TYPE_IPV4) + socket.inet_aton(host)
+            header = "\x00\x00\x00" + chr(self.ADDR_TYPE_IPV4) + socket.inet_aton(host)
         except socket.error:
-            buf += chr(self.ADDR_TYPE_DOMAIN) + chr(len(host)) + host
+            header = "\x00\x00\x00" + chr(self.ADDR_TYPE_DOMAIN) + chr(len(host)) + host
 
-        buf += struct.pack(">H", port)
-        buf += data
+        return header + struct.pack(">H", port)
 
-        return buf
+    def make_header(self, host, port):
+        """
+        return the UDP request header to the destination, which is only built once per destination
+        """
+        return self._cached(self.headers, (host, port), self._build_header)
 
-    def parse_packet(self, buf):
-        _, fragment_num, addr_type = struct.unpack("H2B", buf[:4])
+    def make_packet(self, host, port, data):
+        return self.make_header(host, port) + data
 
-        pos = 4
+    def pack_packet(self, view, host, port, data):
+        """
+        write the UDP request header and the payload to `view`, a memoryview of a reusable send buffer,
+        so no new string is built for each datagram, the payload is still copied once behind the header
 
-        if addr_type == self.ADDR_TYPE_IPV4:
-            host = socket.inet_ntoa(buf[pos:pos+4])
-            pos += 4
+        return the size of the datagram, a ValueError is raised if it does not fit the buffer
+        """
+        header = self.make_header(host, port)
+        offset = len(header)
+        size = offset + len(data)
 
-        elif addr_type == self.ADDR_TYPE_DOMAIN:
-            len = ord(buf[pos])
-            pos += 1
+        view[:offset] = header
+        view[offset:size] = data
+
+        return size
+
+    def unpack_header(self, buf):
+        """
+        parse the UDP request header in front of a datagram without copying it,
+        `buf` may be a string, a bytearray or a memoryview of the receive buffer
+
+        return the source host and port, and the offset of the payload
+        """
+        # the IPv4 header is unpacked at once, and the text of the source addresses is cached
+        if len(buf) >= self.IPV4_HEADER.size:
+            fragment_num, addr_type, addr, port = self.IPV4_HEADER.unpack_from(buf)
 
-            host = buf[pos:pos+len]
-            pos += len
+            if fragment_num == 0 and addr_type == self.ADDR_TYPE_IPV4:
+                host = self._cached(self.hosts, addr, lambda addr: socket.inet_ntoa(struct.pack(">I", addr)))
+
+                return host, port, self.IPV4_HEADER.size
+
+        fragment_num, addr_type = struct.unpack_from("2B", buf, 2)
+
+        if fragment_num != 0:
+            raise SocksProtocolError("unsupport fragmented datagram: %d" % fragment_num)
+
+        if addr_type == self.ADDR_TYPE_IPV4:
+            host = "%d.%d.%d.%d" % struct.unpack_from("4B", buf, 4)
+            pos = 8
+        elif addr_type == self.ADDR_TYPE_DOMAIN:
+            size = struct.unpack_from("B", buf, 4)[0]
+            host = struct.unpack_from("%ds" % size, buf, 5)[0]
+            pos = 5 + size
+        elif addr_type == self.ADDR_TYPE_IPV6:
+            host = socket.inet_ntop(socket.AF_INET6, struct.unpack_from("16s", buf, 4)[0])
+            pos = 20
         else:
             raise SocksProtocolError("unsupport address type: %d" % addr_type)
 
-        port = struct.unpack(">H", buf[pos:pos+2])[0]
+        port = struct.unpack_from(">H", buf, pos)[0]
+
+        return host, port, pos + 2
 
-        pos += 2
+    def parse_packet(self, buf):
+        host, port, pos = self.unpack_header(buf)
 
         return host, port, buf[pos:]
 
+class SocksAssociation(asyncore.dispatcher):
+    """
+
+    SocksAssociation negotiates a UDP association with a socks 5 proxy on the asyncore loop
+
+    The method selection, the username/password authentication and the UDP associate request
+    are driven as a state machine by the events of the non-blocking control connection,
+    so no loop thread ever waits for the proxy. `onready` is called with the relay address
+    once the association is established, and `onclose` with the reason when the negotiation
+    fails, times out or the proxy drops the control connection, which ends the association.
+
+    """
+    logger = logging.getLogger("asyncdns.proxy")
+
+    STATE_CONNECTING = 'connecting'
+    STATE_METHOD = 'method'
+    STATE_AUTH = 'auth'
+    STATE_ASSOCIATE = 'associate'
+    STATE_READY = 'ready'
+    STATE_CLOSED = 'closed'
+
+    def __init__(self, proxy, address, wheel, onready, onclose, map=None):
+        asyncore.dispatcher.__init__(self, map=map)
+
+        self.proxy = proxy
+        self.proto = proxy.proto
+        self.address = address
+        self.onready = onready
+        self.onclose = onclose
+        # the negotiation may time out on the wheel thread while the loop finishes it
+        self.lock = threading.Lock()
+        self.state = self.STATE_CONNECTING
+        self.relay = None
+        self.inbuf = ''
+        self.outbuf = ''
+
+        self.logger.debug("connecting to proxy @ %s:%d", proxy.host, proxy.port)
+
+        self.timer = wheel.create(self.handle_timeout, proxy.timeout)
+
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+
+        try:
+            self.connect((proxy.host, proxy.port))
+        except socket.error:
+            self.timer.cancel()
+            self.close()
+            raise
+
+    @property
+    def ready(self):
+        return self.state == self.STATE_READY
+
+    def writable(self):
+        return not self.connected or bool(self.outbuf)
+
+    def handle_connect(self):
+        if self.state != self.STATE_CONNECTING:
+            return
+
+        self.logger.info("connected to proxy @ %s:%d", self.proxy.host, self.proxy.port)
+
+        self.state = self.STATE_METHOD
+        self.outbuf += self.proto.make_connect()
+
+    def handle_write(self):
+        if self.outbuf:
+            sent = self.send(self.outbuf)
+
+            self.outbuf = self.outbuf[sent:]
+
+    def handle_read(self):
+        data = self.recv(4096)
+
+        if not data:
+            return
+
+        with self.lock:
+            if self.state == self.STATE_CLOSED:
+                return
+
+            self.inbuf += data
+
+            if not self._advance():
+                return
+
+            self.timer.cancel()
+
+        self.logger.info("associated the UDP proxy @ %s:%d", *self.relay)
+
+        self.onready(self.relay)
+
+    def _advance(self):
+        """
+        consume the buffered replies, return True when the association has just been established
+        """
+        while True:
+            if self.state == self.STATE_METHOD:
+                if len(self.inbuf) < 2:
+                    return False
+
+                method = self.proto.unpack_connect(self.inbuf[:2])
+                self.inbuf = self.inbuf[2:]
+
+                if method == self.proto.METHOD_SIMPLE:
+                    self.state = self.STATE_AUTH
+                    self.outbuf += self.proto.make_simple_auth(self.proxy.username, self.proxy.passwd)
+                elif method == self.proto.METHOD_NO_AUTH:
+                    self._request()
+                else:
+                    raise NoAcceptableAuthMethod()
+            elif self.state == self.STATE_AUTH:
+                if len(self.inbuf) < 2:
+                    return False
+
+                self.proto.unpack_simple_auth(self.inbuf[:2])
+                self.inbuf = self.inbuf[2:]
+
+                self._request()
+            elif self.state == self.STATE_ASSOCIATE:
+                size = self.proto.request_size(self.inbuf)
+
+                if size is None or len(self.inbuf) < size:
+                    return False
+
+                host, port = self.proto.unpack_request(self.inbuf[:size])
+                self.inbuf = self.inbuf[size:]
+
+                # the proxy may leave the relay address unspecified when it is its own address
+                if host == '0.0.0.0':
+                    host = self.proxy.host
+
+                # the relay address is compared with the source of the relayed datagrams
+                self.relay = (socket.gethostbyname(host), port)
+                self.state = self.STATE_READY
+
+                return True
+            else:
+                self.inbuf = ''
+
+                return False
+
+    def _request(self):
+        self.state = self.STATE_ASSOCIATE
+        self.outbuf += self.proto.make_request(self.proto.CMD_UDP_ASSOCIATE, *self.address)
+
+    def handle_timeout(self):
+        if self.state not in [self.STATE_READY, self.STATE_CLOSED]:
+            self._finish(socket.timeout("proxy @ %s:%d did not associate in %d seconds" %
+                                        (self.proxy.host, self.proxy.port, self.proxy.timeout)))
+
+    def handle_error(self):
+        error = sys.exc_info()[1]
+
+        self.logger.warn("fail to negotiate with proxy @ %s:%d, %s", self.proxy.host, self.proxy.port, error)
+
+        self._finish(error)
+
+    def handle_close(self):
+        self._finish(socket.error("proxy @ %s:%d closed the association" % (self.proxy.host, self.proxy.port)))
+
+    def _finish(self, error):
+        with self.lock:
+            if self.state == self.STATE_CLOSED:
+                return
+
+            self.state = self.STATE_CLOSED
+
+        self.timer.cancel()
+        self.close()
+
+        self.onclose(error)
+
 class SocksProxy(object):
     """
 
@@ -235,14 +516,16 @@ class SocksProxy(object):
 
     def __init__(self, host, port, username='', passwd='',
                  version=SocksProtocol.VER_SOCKS_5, timeout=5):
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sock.settimeout(timeout)
+        # the blocking control connection is only opened by `connect`, a SocksPool talks to the proxy on its own
+        self.sock = None
+        self.connected = False
 
-        self.proto = SocksProtocol(self.sock, username, passwd, version)
+        self.proto = SocksProtocol(None, username, passwd, version)
         self.host = host
         self.port = port
         self.username = username
         self.passwd = passwd
+        self.timeout = timeout
 
     def __enter__(self):
         if self.connect():
@@ -256,6 +539,11 @@ class SocksProxy(object):
     def connect(self):
         self.logger.debug("connecting to proxy @ %s:%d", self.host, self.port)
 
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+
+        self.proto.attach(self.sock)
+
         errcode = self.sock.connect_ex((self.host, self.port))
 
         self.connected = 0 == errcode
@@ -263,18 +551,38 @@ class SocksProxy(object):
         if not self.connected:
             self.logger.warn("fail to connect proxy @ %s:%d, %d %s",
                              self.host, self.port, errcode, errno.errorcode[errcode])
+
+            self.close()
         else:
             self.logger.info("connected to proxy @ %s:%d", self.host, self.port)
 
         return self.connected
 
     def close(self):
-        if self.connected:
+        if self.sock is not None:
             self.sock.close()
 
+            self.sock = None
+            self.connected = False
+
+            self.proto.attach(None)
+
     def open(self):
         return self.proto.connect()
 
+    def interface(self):
+        """
+        return the local address of the interface which routes to the proxy
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+        try:
+            sock.connect((self.host, self.port))
+
+            return sock.getsockname()[0]
+        finally:
+            sock.close()
+
     def wrapped_sendto(self, proxy, sendto):
         def wrapped(data, flags, addr=None):
             if addr is None:
@@ -302,7 +610,7 @@ class SocksProxy(object):
         return wrapped
 
     def wrap(self, sock):
-        sock.bind(('0.0.0.0', 0))
+        sock.bind((self.interface(), 0))
 
         host, port = sock.getsockname()
 
@@ -311,6 +619,195 @@ class SocksProxy(object):
         sock.sendto = self.wrapped_sendto(addr, sock.sendto)
         sock.recvfrom = self.wrapped_recvfrom(addr, sock.recvfrom)
 
+class SocksRelay(object):
+    """
+
+    SocksRelay is a slot of a SocksPool, which holds one association at a time with its proxy and the counters
+
+    """
+    def __init__(self, index, proxy):
+        self.index = index
+        self.proxy = proxy
+        self.association = None
+        self.address = None
+        self.timer = None
+        self.delay = None
+        self.rejected = False
+        self.inflight = 0
+        self.sent = 0
+        self.associations = 0
+        self.failures = 0
+
+    @property
+    def ready(self):
+        return self.address is not None
+
+class SocksPool(object):
+    """
+
+    SocksPool keeps the UDP associations of a pipeline with one or more socks 5 proxies
+
+    Each proxy of the list gets its own association, so a proxy listed several times is
+    relayed over several associations. The queries go to the ready relays never measured
+    first, then are spread by the expected delay, the queries in flight times the smoothed
+    round trip time, and a dropped association is negotiated again while the other relays
+    carry the traffic.
+
+    A proxy which keeps failing is tried again after a delay doubled up to MAX_REASSOCIATE_DELAY,
+    and a proxy which rejects the authentication is not tried again.
+
+    """
+    logger = logging.getLogger("asyncdns.proxy")
+
+    REASSOCIATE_DELAY = 1
+    MAX_REASSOCIATE_DELAY = 60
+
+    def __init__(self, proxies, address, wheel, onclose=None, map=None):
+        if isinstance(proxies, SocksProxy):
+            proxies = [proxies]
+
+        self.address = address
+        self.wheel = wheel
+        self.onclose = onclose
+        self.map = map
+        self.lock = threading.Lock()
+        self.rtts = ServerStats()
+        self.relays = [SocksRelay(i, proxy) for i, proxy in enumerate(proxies)]
+        self.proto = self.relays[0].proxy.proto
+        self.closed = False
+
+        for relay in self.relays:
+            self._associate(relay)
+
+    def __len__(self):
+        return len([relay for relay in self.relays if relay.ready])
+
+    @property
+    def ready(self):
+        return any([relay.ready for relay in self.relays])
+
+    @property
+    def rejected(self):
+        return all([relay.rejected for relay in self.relays])
+
+    def relayed(self, address):
+        """
+        check whether the address is the relay of a current association
+        """
+        return any([relay.address == address for relay in self.relays])
+
+    def stats(self):
+        rtts = self.rtts.stats()
+
+        with self.lock:
+            return [dict(rtts.get(relay.index, {'srtt': None, 'responses': 0, 'timeouts': 0}),
+                         proxy="%s:%d" % (relay.proxy.host, relay.proxy.port),
+                         relay=relay.address,
+                         inflight=relay.inflight,
+                         sent=relay.sent,
+                         associations=relay.associations,
+                         failures=relay.failures) for relay in self.relays]
+
+    def _associate(self, relay):
+        relay.timer = None
+
+        if self.closed:
+            return
+
+        try:
+            relay.association = SocksAssociation(relay.proxy, self.address, self.wheel,
+                                                 lambda address: self._onready(relay, address),
+                                                 lambda error: self._onclose(relay, error), self.map)
+        except socket.error, e:
+            self._onclose(relay, e)
+
+    def _onready(self, relay, address):
+        with self.lock:
+            relay.address = address
+            relay.delay = None
+            relay.associations += 1
+
+    def _onclose(self, relay, error):
+        rejected = isinstance(error, (AuthenticationError, NoAcceptableAuthMethod))
+
+        with self.lock:
+            associated = relay.ready
+
+            relay.address = None
+            relay.association = None
+            relay.inflight = 0
+            relay.rejected = rejected
+
+            if not associated:
+                relay.failures += 1
+
+            if relay.delay is None:
+                relay.delay = self.REASSOCIATE_DELAY
+            else:
+                relay.delay = min(relay.delay * 2, self.MAX_REASSOCIATE_DELAY)
+
+            if not self.closed and not rejected:
+                relay.timer = self.wheel.create(lambda: self._associate(relay), relay.delay)
+
+        if self.closed:
+            pass
+        elif rejected:
+            self.logger.warn("give up proxy @ %s:%d which rejected the association, %s",
+                             relay.proxy.host, relay.proxy.port, error)
+        else:
+            self.logger.warn("lost the association with proxy @ %s:%d, %s, retry in %d seconds",
+                             relay.proxy.host, relay.proxy.port, error, relay.delay)
+
+        if self.onclose is not None:
+            self.onclose(relay, error, associated)
+
+    def choose(self):
+        """
+        choose the ready relay with the least expected delay and count a query in flight on it, or None if none is ready
+        """
+        with self.lock:
+            relays = [relay for relay in self.relays if relay.ready]
+
+            if not relays:
+                return None
+
+            def delay(relay):
+                rtt = self.rtts.rtt(relay.index)
+
+                return (rtt is not None, (relay.inflight + 1) * (rtt or 0.0), relay.inflight)
+
+            relay = min(relays, key=delay)
+
+            relay.inflight += 1
+            relay.sent += 1
+
+            return relay
+
+    def release(self, relay):
+        with self.lock:
+            relay.inflight = max(relay.inflight - 1, 0)
+
+    def update(self, relay, rtt):
+        self.release(relay)
+        self.rtts.update(relay.index, rtt)
+
+    def timeout(self, relay):
+        self.release(relay)
+        self.rtts.timeout(relay.index)
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+
+            relays = list(self.relays)
+
+        for relay in relays:
+            if relay.timer is not None:
+                relay.timer.cancel()
+
+            if relay.association is not None:
+                relay.association.handle_close()
+
 if __name__=='__main__':
     logging.basicConfig(level=logging.DEBUG if "-v" in sys.argv else logging.WARN,
                         format='%(asctime)s %(levelname)s %(message)s')
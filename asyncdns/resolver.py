@@ -1,14 +1,28 @@
 #!/usr/bin/env python
+from __future__ import with_statement
+
 import sys
+import time
+import socket
 import logging
 import threading
+import itertools
+import Queue
 
 import traceback
 
+import dns.rcode
+import dns.message
 import dns.rdatatype
 import dns.rdataclass
+import dns.resolver
 
 from pipeline import Pipeline
+from utils import Future
+from scene import Query, Result, Scenario
+from cache import DelegationCache, CnameCache
+from prefetch import Prefetcher
+from names import shared as shared_names
 
 def normalize(s):
     for encoding in ['utf-8', 'latin1', 'cp1252', 'gbk']:
@@ -22,30 +36,64 @@ def normalize(s):
 class Resolver(Pipeline):
     logger = logging.getLogger("asyncdns.resolver")
 
-    def __init__(self, wheel=None, proxy=None, start=True):
-        Pipeline.__init__(self, wheel, proxy, start)
+    MAX_REFERRALS = 16
+    MAX_DEPTH = 4
+    FANOUT = 2
+    # the grace period of lookup_many after the expiry of a domain, before it is given up as timed out
+    LOOKUP_MARGIN = 5
+
+    def __init__(self, wheel=None, proxy=None, start=True, names=None, executor=None,
+                 delegations=None, cnames=None, tcp=True, payload=Pipeline.DEFAULT_PAYLOAD, cache=None,
+                 prefetch=0, stale=0, tracer=None, metrics=None):
+        # the time wheel only fires on whole seconds
+        if stale and (not isinstance(stale, (int, long)) or stale < 1):
+            raise ValueError("stale delay must be a whole number of seconds, got %r" % stale)
+
+        Pipeline.__init__(self, wheel, proxy, start, names, executor, tcp, payload, tracer, metrics)
+
+        self.cache = cache
+        self.prefetcher = Prefetcher(self, prefetch) if cache is not None and prefetch else None
+        self.stale = stale
+        self.stale_lock = threading.Lock()
+        self.stale_served = 0
+
+        self.delegations = delegations
+
+        if self.delegations is None:
+            self.delegations = DelegationCache()
+
+        self.cnames = cnames
+
+        if self.cnames is None:
+            self.cnames = CnameCache()
+
+    def close(self):
+        if self.prefetcher is not None:
+            self.prefetcher.cancel()
+
+        Pipeline.close(self)
 
     @staticmethod
-    def _to_relativity(qname):
-        return str(qname.choose_relativity(dns.name.root, True))
+    def _to_relativity(qname, names=shared_names):
+        return names.to_text(qname)
 
     @staticmethod
-    def _extract_value(rrset):
+    def _extract_value(rrset, names=shared_names):
         if rrset.rdtype in [dns.rdatatype.A, dns.rdatatype.AAAA]:
             return [rdata.address for rdata in rrset]
         elif rrset.rdtype in [dns.rdatatype.MX]:
-            return [(str(rdata.exchange), rdata.preference) for rdata in rrset]
+            return [(names.to_text(rdata.exchange, False), rdata.preference) for rdata in rrset]
         elif rrset.rdtype in [dns.rdatatype.NS, dns.rdatatype.CNAME, dns.rdatatype.PTR]:
-            return [Resolver._to_relativity(rdata.target) for rdata in rrset]
+            return [names.to_text(rdata.target) for rdata in rrset]
         elif rrset.rdtype in [dns.rdatatype.SOA]:
-            return [(Resolver._to_relativity(rdata.mname), Resolver._to_relativity(rdata.rname),
+            return [(names.to_text(rdata.mname), names.to_text(rdata.rname),
                      rdata.serial, rdata.refresh,
                      rdata.retry, rdata.expire,
                      rdata.minimum) for rdata in rrset]
         elif rrset.rdtype in [dns.rdatatype.WKS]:
             return [(rdata.address, rdata.protocol, rdata.bitmap) for rdata in rrset]
         elif rrset.rdtype in [dns.rdatatype.SRV]:
-            return [(str(rdata.target), rdata.port,
+            return [(names.to_text(rdata.target, False), rdata.port,
                      rdata.priority, rdata.weight) for rdata in rrset]
         elif rrset.rdtype in [dns.rdatatype.HINFO]:
             return [(rdata.cpu, rdata.os) for rdata in rrset]
@@ -64,35 +112,535 @@ class Resolver(Pipeline):
             self.logger.debug("exc: %s", traceback.format_exc())
             self.logger.debug("res: %s", response)
 
+    def _collect(self, results, response):
+        for section in [response.answer, response.authority, response.additional]:
+            for rrset in section:
+                domain = self._to_relativity(rrset.name, self.names)
+                rdtypename = dns.rdatatype.to_text(rrset.rdtype)
+
+                values = results.setdefault(domain, {}).setdefault(rdtypename, [])
+                values.extend(list(filter(lambda v: v not in values, Resolver._extract_value(rrset, self.names))))
+
+        return results
+
+    @staticmethod
+    def _copy(results):
+        return dict([(domain, dict([(rdtypename, list(values)) for rdtypename, values in records.items()]))
+                     for domain, records in results.items()])
+
+    def _referral(self, zone, qname, response):
+        if response.answer or response.rcode() != dns.rcode.NOERROR:
+            return None
+
+        for rrset in response.authority:
+            if rrset.rdtype != dns.rdatatype.NS or rrset.name == zone or \
+               not rrset.name.is_subdomain(zone) or not qname.is_subdomain(rrset.name):
+                continue
+
+            nsnames = [rdata.target for rdata in rrset]
+            glues = {}
+
+            self.delegations.add_zone(rrset.name, nsnames, rrset.ttl)
+
+            for glue in response.additional:
+                if glue.rdtype == dns.rdatatype.A and glue.name in nsnames:
+                    glues.setdefault(glue.name, (glue.ttl, []))[1].extend([rdata.address for rdata in glue])
+
+            addresses = []
+
+            for name, (ttl, glue) in glues.items():
+                self.delegations.add_address(name, glue, ttl)
+
+                addresses.extend(glue)
+
+            return rrset.name, nsnames, addresses
+
+        return None
+
+    def _iterate(self, qname, rdtype, rdclass, expired, port, depth=0):
+        if isinstance(qname, (str, unicode)):
+            qname = self.names.from_text(qname)
+        if isinstance(rdtype, str):
+            rdtype = dns.rdatatype.from_text(rdtype)
+        if isinstance(rdclass, str):
+            rdclass = dns.rdataclass.from_text(rdclass)
+
+        zone, nsnames, addresses = self.delegations.find(qname)
+
+        for i in range(self.MAX_REFERRALS):
+            for nsname in nsnames:
+                if addresses or depth >= self.MAX_DEPTH:
+                    break
+
+                if nsname.is_subdomain(zone):
+                    continue
+
+                addresses = self.delegations.get_address(nsname)
+
+                if addresses:
+                    break
+
+                try:
+                    nameserver, response = yield self._iterate(nsname, dns.rdatatype.A, rdclass,
+                                                               expired, port, depth + 1)
+                except Exception, e:
+                    self.logger.debug("fail to resolve nameserver %s of zone %s, %s", nsname, zone, e)
+
+                    continue
+
+                for rrset in response.answer:
+                    if rrset.rdtype == dns.rdatatype.A:
+                        addresses = [rdata.address for rdata in rrset]
+
+                        self.delegations.add_address(nsname, addresses, rrset.ttl)
+
+            if not addresses:
+                raise dns.resolver.NoNameservers("no nameserver address for zone %s" % zone)
+
+            remaining = list(addresses)
+
+            # the other nameservers of the zone cut are tried in turn when the chosen ones fail
+            while True:
+                nameservers = self.servers.choose(remaining, self.FANOUT, port)
+                remaining = [address for address in remaining if address not in nameservers]
+
+                self.logger.info("query zone %s nameservers %s for domain %s", zone, ', '.join(nameservers), qname)
+
+                try:
+                    nameserver, response = yield Query(qname, rdtype, rdclass, nameservers=nameservers,
+                                                       port=port, expired=expired, raw=True)
+                except Exception, e:
+                    if not remaining:
+                        raise
+
+                    self.logger.info("fail to query zone %s nameservers %s, %s", zone, ', '.join(nameservers), e)
+
+                    continue
+
+                if response.rcode() in [dns.rcode.SERVFAIL, dns.rcode.REFUSED] and remaining:
+                    continue
+
+                break
+
+            referral = self._referral(zone, qname, response)
+
+            if referral is None:
+                yield Result((nameserver, response))
+
+            zone, nsnames, addresses = referral
+
+        raise dns.resolver.NoNameservers("too many referrals for domain %s" % qname)
+
+    @staticmethod
+    def _follow(response, target, rdtype):
+        links = []
+
+        while True:
+            for rrset in response.answer:
+                if rrset.name == target and rrset.rdtype == rdtype:
+                    return links, True
+
+            for rrset in response.answer:
+                if rrset.name == target and rrset.rdtype == dns.rdatatype.CNAME and rrset not in links:
+                    links.append(rrset)
+                    target = rrset[0].target
+
+                    break
+            else:
+                return links, False
+
+    def _chase(self, qname, rdtype, rdclass, expired, nameservers, port, iterative, limit):
+        if isinstance(qname, (str, unicode)):
+            qname = self.names.from_text(qname)
+        if isinstance(rdtype, str):
+            rdtype = dns.rdatatype.from_text(rdtype)
+
+        chase = rdtype not in [dns.rdatatype.CNAME, dns.rdatatype.ANY]
+        target = qname
+        seen = set([qname])
+        answer = []
+        nameserver = response = None
+
+        while True:
+            link = self.cnames.get(target) if chase else None
+
+            if link is None:
+                nameserver, response = yield self._resolve(target, rdtype, rdclass, expired,
+                                                           nameservers, port, iterative)
+
+                links, found = self._follow(response, target, rdtype)
+
+                for rrset in links:
+                    self.cnames.add(rrset)
+
+                if not chase or found or not links or response.rcode() != dns.rcode.NOERROR:
+                    break
+            else:
+                links = [link]
+
+            looped = False
+
+            for rrset in links:
+                if rrset not in answer:
+                    answer.append(rrset)
+
+                target = rrset[0].target
+
+                if target in seen:
+                    looped = True
+
+                    break
+
+                seen.add(target)
+
+            if looped:
+                self.logger.warn("found CNAME loop of domain %s at %s", qname, target)
+
+                break
+
+            if len(seen) - 1 > limit:
+                self.logger.info("stop following CNAME of domain %s after %d links", qname, limit)
+
+                break
+
+        if response is None:
+            response = dns.message.make_response(dns.message.make_query(qname, rdtype, rdclass))
+
+        for rrset in response.answer:
+            if rrset not in answer:
+                answer.append(rrset)
+
+        response.answer = answer
+
+        yield Result((nameserver, response))
+
+    def _resolve(self, qname, rdtype, rdclass, expired, nameservers, port, iterative, follow_cname=0):
+        if self.cache is None:
+            return self._fetch(qname, rdtype, rdclass, expired, nameservers, port, iterative, follow_cname)
+
+        if isinstance(qname, (str, unicode)):
+            qname = self.names.from_text(qname)
+        if isinstance(rdtype, str):
+            rdtype = dns.rdatatype.from_text(rdtype)
+        if isinstance(rdclass, str):
+            rdclass = dns.rdataclass.from_text(rdclass)
+
+        entry = self.cache.fetch(qname, rdtype, rdclass)
+
+        if entry is not None:
+            response, remaining, ttl = entry
+
+            if self.prefetcher is not None:
+                self.prefetcher.touch((qname, rdtype, rdclass), remaining, ttl,
+                                      (expired, nameservers, port, iterative, follow_cname))
+
+            future = Future()
+            future.set_result((None, response))
+
+            return future
+
+        def onfinish(done):
+            if done.error is None:
+                try:
+                    self.cache.put(done.value[1])
+                except Exception, e:
+                    self.logger.warn("fail to cache the response of domain %s: %s", qname, e)
+
+        # take the stale response before the query goes out, a quick answer cached meanwhile is not stale
+        entry = self.cache.fetch(qname, rdtype, rdclass, stale=True) if self.stale else None
+
+        future = self._fetch(qname, rdtype, rdclass, expired, nameservers, port, iterative, follow_cname)
+        future.add_done_callback(onfinish)
+
+        if entry is not None:
+            return self._serve_stale(future, entry[0])
+
+        return future
+
+    def _serve_stale(self, upstream, response):
+        """
+        return the upstream answer if it comes within `stale` seconds, or the stale response (RFC 8767)
+
+        The stale response is also served at once if the upstream fails or answers SERVFAIL or REFUSED,
+        while a slow upstream keeps going in the background and refreshes the cache when it answers.
+        The stale response is completed on the executor, the done callbacks never run on the time wheel.
+        """
+        future = Future()
+
+        def serve():
+            if future.set_result((None, response)):
+                with self.stale_lock:
+                    self.stale_served += 1
+
+        timer = self.wheel.create(lambda: self.executor.submit(serve), self.stale)
+
+        def onfinish(done):
+            timer.cancel()
+
+            if done.error is not None or done.value[1].rcode() in [dns.rcode.SERVFAIL, dns.rcode.REFUSED]:
+                serve()
+            else:
+                future.set_result(done.value)
+
+        upstream.add_done_callback(onfinish)
+
+        return future
+
+    def _fetch(self, qname, rdtype, rdclass, expired, nameservers, port, iterative, follow_cname):
+        if follow_cname:
+            return Scenario(self._chase(qname, rdtype, rdclass, expired, nameservers, port,
+                                        iterative, follow_cname), expired).play(self)
+
+        if iterative:
+            return Scenario(self._iterate(qname, rdtype, rdclass, expired, port), expired).play(self)
+
+        return self.query_async(qname, rdtype, rdclass, expired, nameservers, port)
+
     def lookup(self, qname, rdtype, rdclass, expired=30,
-               callback=None, nameservers=None, port=53):
+               callback=None, nameservers=None, port=53, iterative=False, follow_cname=0):
+        """
+        return the results of the question, or hand them to `callback` as they come
+
+        Without a callback, the lookup waits `expired` seconds at most and raises socket.timeout
+        when no nameserver answered in time, whether it goes to the nameservers, through the cache
+        or along the iterative walk, while the other failures are logged and give empty results.
+        """
+        if iterative or follow_cname or self.cache is not None:
+            future = self.lookup_async(qname, rdtype, rdclass, expired, nameservers, port,
+                                       iterative, follow_cname)
+
+            if callback:
+                def onfinish(done):
+                    if done.error is not None:
+                        self._execute_callback(callback, None, qname, done.error)
+                    else:
+                        self._execute_callback(callback, done.value[0], qname, done.value[1])
+
+                future.add_done_callback(onfinish)
+
+                return
+
+            # the expiry bounds the whole walk, a timeout is raised rather than taken for an empty answer
+            try:
+                return future.result(expired)[1]
+            except socket.timeout:
+                raise
+            except Exception, e:
+                self.logger.warn("fail to resolve domain %s, %s", qname, e)
+
+                return {}
+
+        if nameservers is None:
+            nameservers = self.system_nameservers()
+
         results = {}
+        results_lock = threading.Lock()
+        state = {'remaining': len(nameservers), 'error': None}
         finished = None if callback else threading.Event()
 
         def onfinish(nameserver, response):
             onerror = isinstance(response, Exception)
+            collected = response
 
-            if not onerror:
-                for section in [response.answer, response.authority, response.additional]:
-                    for rrset in section:
-                        domain = self._to_relativity(rrset.name)
-                        rdtypename = dns.rdatatype.to_text(rrset.rdtype)
+            with results_lock:
+                if onerror:
+                    state['error'] = response
+                else:
+                    self._collect(results, response)
 
-                        values = results.setdefault(domain, {}).setdefault(rdtypename, [])
-                        values.extend(list(filter(lambda v: v not in values, Resolver._extract_value(rrset))))
+                    # the callback may run on an executor thread while the next response is collected
+                    if callback:
+                        collected = self._copy(results)
+
+                state['remaining'] -= 1
+
+                # the first answer ends the wait, or the last failure when no nameserver answered
+                done = not onerror or state['remaining'] == 0
 
             if callback:
-                self._execute_callback(callback, nameserver, qname, response if onerror else results)
-            else:
+                self._execute_callback(callback, nameserver, qname, collected)
+            elif done:
                 finished.set()
 
         self.query(qname, rdtype, rdclass, expired, onfinish, nameservers, port)
 
         if callback is None:
-            finished.wait(expired)
+            if not finished.wait(expired):
+                raise socket.timeout("lookup of domain %s was timeout after %d seconds" % (qname, expired))
+
+            with results_lock:
+                error = None if results else state['error']
+
+            if isinstance(error, socket.timeout):
+                raise error
+            elif error is not None:
+                self.logger.warn("fail to lookup domain %s, %s", qname, error)
 
             return results
 
+    def resolve_async(self, qname, rdtype, rdclass, expired=30, nameservers=None, port=53,
+                      iterative=False, follow_cname=0):
+        """
+        return a future of the (nameserver, response) of the question, through the cache if any
+        """
+        return self._resolve(qname, rdtype, rdclass, expired, nameservers, port, iterative, follow_cname)
+
+    def lookup_async(self, qname, rdtype, rdclass, expired=30, nameservers=None, port=53,
+                     iterative=False, follow_cname=0):
+        future = Future()
+
+        def onfinish(done):
+            try:
+                nameserver, response = done.result()
+            except Exception, e:
+                future.set_exception(e)
+            else:
+                future.set_result((nameserver, self._collect({}, response)))
+
+        self._resolve(qname, rdtype, rdclass, expired, nameservers, port,
+                      iterative, follow_cname).add_done_callback(onfinish)
+
+        return future
+
+    def lookup_many(self, qnames, rdtypes=(dns.rdatatype.A,), rdclass=dns.rdataclass.IN,
+                    expired=30, concurrency=20, nameservers=None, port=53, iterative=False, follow_cname=0):
+        """
+
+        lookup_many pulls the domains lazily from an iterable (a generator, a list or an opened file),
+        keeps at most `concurrency` queries in flight and yields (qname, results) in completion order
+
+        All the record types of a domain are queried in one pass and merged into one results dict,
+        or the last exception if none of the nameservers answered. A domain still unanswered
+        `LOOKUP_MARGIN` seconds after its expiry is given up and yielded with a socket.timeout.
+
+        """
+        if nameservers is None:
+            nameservers = self.system_nameservers()
+
+        qnames = iter(qnames)
+        finished = Queue.Queue()
+        results_lock = threading.Lock()
+        resolving = iterative or follow_cname or self.cache is not None
+        queries = len(rdtypes)
+        keys = itertools.count()
+        outstanding = {}
+        inflight = 0
+
+        def submit(qname):
+            state = {'key': keys.next(), 'qname': qname, 'remaining': queries * (1 if resolving else len(nameservers)),
+                     'succeeded': False, 'error': None, 'abandoned': False,
+                     'deadline': time.time() + expired + self.LOOKUP_MARGIN}
+            results = {}
+
+            outstanding[state['key']] = state
+
+            def onfinish(nameserver, response, count=1):
+                with results_lock:
+                    if state['abandoned']:
+                        return
+
+                    if isinstance(response, Exception):
+                        state['error'] = response
+                    else:
+                        state['succeeded'] = True
+
+                        self._collect(results, response)
+
+                    state['remaining'] -= count
+
+                    if state['remaining'] == 0:
+                        finished.put_nowait((state['key'], results if state['succeeded'] else state['error']))
+
+            def onresolved(done):
+                if done.error is not None:
+                    onfinish(None, done.error)
+                else:
+                    onfinish(*done.value)
+
+            for rdtype in rdtypes:
+                try:
+                    if resolving:
+                        self._resolve(qname, rdtype, rdclass, expired, nameservers, port,
+                                      iterative, follow_cname).add_done_callback(onresolved)
+                    else:
+                        self.query(qname, rdtype, rdclass, expired, onfinish, nameservers, port)
+                except Exception, e:
+                    self.logger.warn("fail to query domain %s: %s", qname, e)
+
+                    # the record types already queried still count, the failed one finishes at once
+                    onfinish(None, e, 1 if resolving else len(nameservers))
+
+        while True:
+            while inflight == 0 or inflight + queries <= concurrency:
+                try:
+                    qname = qnames.next()
+                except StopIteration:
+                    break
+
+                if isinstance(qname, (str, unicode)):
+                    qname = qname.strip()
+
+                    if not qname:
+                        continue
+
+                inflight += queries
+
+                submit(qname)
+
+            if inflight == 0:
+                break
+
+            timeout = min([state['deadline'] for state in outstanding.values()]) - time.time()
+
+            try:
+                key, results = finished.get(timeout=max(timeout, 0))
+            except Queue.Empty:
+                now = time.time()
+
+                with results_lock:
+                    overdue = [state for state in outstanding.values() if state['deadline'] <= now]
+
+                    for state in overdue:
+                        state['abandoned'] = True
+
+                        del outstanding[state['key']]
+
+                for state in overdue:
+                    inflight -= queries
+
+                    yield state['qname'], socket.timeout("lookup of domain %s was timeout after %d seconds" %
+                                                         (state['qname'], expired))
+
+                continue
+
+            state = outstanding.pop(key, None)
+
+            # given up just before it finished
+            if state is None:
+                continue
+
+            inflight -= queries
+
+            yield state['qname'], results
+
+    def lookupScene(self, scene, callback=None, expired=30):
+        if not isinstance(scene, Scenario):
+            scene = Scenario(scene, expired)
+
+        future = scene.play(self)
+
+        if callback:
+            def onfinish(done):
+                try:
+                    callback(done.error if done.error is not None else done.value)
+                except Exception, e:
+                    self.logger.warn("fail to execute callback for scene: %s", e)
+                    self.logger.debug("exc: %s", traceback.format_exc())
+
+            future.add_done_callback(onfinish)
+
+        return future
+
     def lookupAddress(self, qname, *args, **kwds):
         return self.lookup(qname, dns.rdatatype.A, dns.rdataclass.IN, *args, **kwds)
 
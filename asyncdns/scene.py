@@ -1,17 +1,30 @@
 #!/usr/bin/env python
+from __future__ import with_statement
+
+import logging
+import threading
+import types
 
 import dns.name
 import dns.rdatatype
 import dns.rdataclass
 
+from utils import Future
+
 class Query(object):
     def __init__(self, qname, rdtype=dns.rdatatype.A, rdclass=dns.rdataclass.IN,
-                 nameservers=None, port=53):
+                 nameservers=None, port=53, expired=None, raw=False):
         self.qname = qname
         self.rdtype = rdtype
         self.rdclass = rdclass
         self.nameservers = nameservers
         self.port = port
+        self.expired = expired
+        self.raw = raw
+
+    def __repr__(self):
+        return "<Query %s %s>" % (self.qname, dns.rdatatype.to_text(self.rdtype)
+                                  if isinstance(self.rdtype, int) else self.rdtype)
 
 class Result(object):
     def __init__(self, result=None):
@@ -19,9 +32,135 @@ class Result(object):
 
 Finished = Result()
 
+class Scenario(object):
+    """
+
+    Scenario drives a scene generator over a shared resolver
+
+    The generator yields a Query (or a nested scene, a Future, or a list of them to run in parallel)
+    and is resumed with its result when it completes, or the exception is thrown into it.
+    It finishes by yielding a Result, or returning. No thread is held while a query is in flight,
+    so thousands of scenes could be multiplexed over one pipeline.
+
+    """
+    logger = logging.getLogger("asyncdns.scene")
+
+    def __init__(self, generator, expired=30):
+        self.generator = generator
+        self.expired = expired
+        self.future = Future()
+        self.resolver = None
+
+    def play(self, resolver):
+        self.resolver = resolver
+
+        self._step(self.generator.next)
+
+        return self.future
+
+    def _start(self, step):
+        if isinstance(step, Query):
+            expired = step.expired or self.expired
+
+            if step.raw:
+                return self.resolver.query_async(step.qname, step.rdtype, step.rdclass, expired,
+                                                 step.nameservers, step.port)
+            else:
+                return self.resolver.lookup_async(step.qname, step.rdtype, step.rdclass, expired,
+                                                  step.nameservers, step.port)
+        elif isinstance(step, Scenario):
+            return step.play(self.resolver)
+        elif isinstance(step, types.GeneratorType):
+            return Scenario(step, self.expired).play(self.resolver)
+        elif isinstance(step, Future):
+            return step
+        elif isinstance(step, (list, tuple)):
+            return self._gather([self._start(s) for s in step])
+        else:
+            raise TypeError("scene yields an unknown step: %r" % step)
+
+    def _gather(self, futures):
+        future = Future()
+        lock = threading.Lock()
+        remaining = [len(futures)]
+
+        def onfinish(done):
+            with lock:
+                remaining[0] -= 1
+
+                if remaining[0] > 0:
+                    return
+
+            future.set_result([f.error if f.error is not None else f.value for f in futures])
+
+        if not futures:
+            future.set_result([])
+
+        for f in futures:
+            f.add_done_callback(onfinish)
+
+        return future
+
+    def _step(self, advance, *args):
+        while True:
+            try:
+                step = advance(*args)
+            except StopIteration:
+                self.future.set_result(None)
+
+                return
+            except Exception, e:
+                self.logger.debug("scene was aborted, %s", e)
+
+                self.future.set_exception(e)
+
+                return
+
+            if isinstance(step, Result):
+                self.generator.close()
+                self.future.set_result(step.result)
+
+                return
+
+            try:
+                future = self._start(step)
+            except Exception, e:
+                advance, args = self.generator.throw, (e,)
+
+                continue
+
+            if not future.done():
+                future.add_done_callback(self._resume)
+
+                return
+
+            advance, args = self._advance(future)
+
+    def _advance(self, future):
+        if future.error is not None:
+            return self.generator.throw, (future.error,)
+
+        return self.generator.send, (future.value,)
+
+    def _resume(self, future):
+        advance, args = self._advance(future)
+
+        self._step(advance, *args)
+
 class Scene(object):
-    def __init__(self):
-        pass
+    """
+
+    Scene decorates a generator function, whose calls return a Scenario for Resolver.lookupScene
+
+    """
+    def __init__(self, expired=30):
+        self.expired = expired
 
     def __call__(self, func):
-        pass
+        def wrapper(*args, **kwds):
+            return Scenario(func(*args, **kwds), self.expired)
+
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+
+        return wrapper
@@ -0,0 +1,382 @@
+#!/usr/bin/env python
+from __future__ import with_statement
+
+import struct
+import socket
+import logging
+import asyncore
+import threading
+from errno import *
+from collections import deque
+
+import dns.rcode
+import dns.flags
+import dns.opcode
+import dns.message
+import dns.exception
+
+from utils import Future
+from stream import StreamReader, DISCONNECTED
+
+class UdpListener(asyncore.dispatcher):
+    logger = logging.getLogger("asyncdns.server")
+
+    def __init__(self, forwarder, host, port):
+        asyncore.dispatcher.__init__(self, map=forwarder.resolver.map)
+
+        self.forwarder = forwarder
+
+        self.create_socket(socket.AF_INET6 if ':' in host else socket.AF_INET, socket.SOCK_DGRAM)
+        self.set_reuse_addr()
+        self.bind((host, port))
+
+    def writable(self):
+        return False
+
+    def handle_connect(self):
+        pass
+
+    def handle_read(self):
+        try:
+            packet, client = self.socket.recvfrom(65535)
+        except socket.error, why:
+            if why[0] in [EWOULDBLOCK, EAGAIN]:
+                return
+
+            raise
+
+        try:
+            request = dns.message.from_wire(packet)
+        except dns.exception.DNSException, e:
+            self.logger.warn("drop invalid DNS query from %s:%d, %s", client[0], client[1], e)
+
+            return
+
+        def reply(packet):
+            try:
+                self.socket.sendto(packet, client)
+            except socket.error, e:
+                self.logger.warn("fail to reply to %s:%d, %s", client[0], client[1], e)
+
+        max_size = max(request.payload, 512) if request.edns >= 0 else 512
+
+        self.forwarder.handle_query(request, reply, max_size)
+
+class TcpClient(asyncore.dispatcher):
+    logger = logging.getLogger("asyncdns.server")
+
+    def __init__(self, forwarder, sock, client):
+        asyncore.dispatcher.__init__(self, sock, forwarder.resolver.map)
+
+        self.forwarder = forwarder
+        self.client = client
+        self.reader = StreamReader(self.socket)
+        # the replies are queued by the resolver threads and only sent by the loop
+        self.outbuf = deque()
+        self.unsent = ''
+
+    def writable(self):
+        return bool(self.unsent or self.outbuf)
+
+    def reply(self, packet):
+        self.outbuf.append(struct.pack(">H", len(packet)) + packet)
+
+    def handle_write(self):
+        chunks = [self.unsent]
+
+        while self.outbuf:
+            chunks.append(self.outbuf.popleft())
+
+        data = ''.join(chunks)
+
+        sent = self.send(data)
+
+        self.unsent = data[sent:]
+
+    def handle_read(self):
+        requests = []
+
+        try:
+            received = self.reader.fill()
+        except socket.error, why:
+            if why[0] in DISCONNECTED:
+                received = 0
+            else:
+                raise
+
+        if not received:
+            self.handle_close()
+
+            return
+
+        for packet in self.reader.frames():
+            try:
+                requests.append(dns.message.from_wire(packet))
+            except dns.exception.DNSException, e:
+                self.logger.warn("drop invalid DNS query from %s:%d over tcp, %s", self.client[0], self.client[1], e)
+
+        for request in requests:
+            self.forwarder.handle_query(request, self.reply, 65535)
+
+    def handle_close(self):
+        self.close()
+
+        self.forwarder.clients.discard(self)
+
+class TcpListener(asyncore.dispatcher):
+    logger = logging.getLogger("asyncdns.server")
+
+    def __init__(self, forwarder, host, port):
+        asyncore.dispatcher.__init__(self, map=forwarder.resolver.map)
+
+        self.forwarder = forwarder
+
+        self.create_socket(socket.AF_INET6 if ':' in host else socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind((host, port))
+        self.listen(64)
+
+    def handle_accept(self):
+        pair = self.accept()
+
+        if pair is None:
+            return
+
+        sock, client = pair
+
+        self.forwarder.clients.add(TcpClient(self.forwarder, sock, client))
+
+class Forwarder(object):
+    """
+
+    Forwarder is a local caching DNS server, which answers the client queries through a resolver
+
+    The listeners join the asyncore loop of the resolver pipeline. The concurrent client queries for the
+    same question are coalesced into one upstream query (or cache lookup), whose answer, authority and
+    additional sections are relayed to each client under its own header, question and OPT record.
+
+    """
+    logger = logging.getLogger("asyncdns.server")
+
+    PAYLOAD = 1232
+
+    def __init__(self, resolver, host='127.0.0.1', port=53, nameservers=None, upstream_port=53,
+                 expired=5, tcp=True):
+        self.resolver = resolver
+        self.nameservers = nameservers
+        self.upstream_port = upstream_port
+        self.expired = expired
+        self.lock = threading.Lock()
+        self.inflight = {}
+        self.clients = set()
+        self.queries = 0
+        self.coalesced = 0
+        self.answered = 0
+        self.failed = 0
+
+        self.udp = UdpListener(self, host, port)
+        self.host, self.port = self.udp.socket.getsockname()[:2]
+        self.tcp = TcpListener(self, self.host, self.port) if tcp else None
+
+    def stats(self):
+        with self.lock:
+            return {
+                'queries': self.queries,
+                'coalesced': self.coalesced,
+                'answered': self.answered,
+                'failed': self.failed,
+                'inflight': len(self.inflight),
+                'clients': len(self.clients),
+            }
+
+    @staticmethod
+    def _error(request, rcode):
+        response = dns.message.make_response(request)
+        response.set_rcode(rcode)
+
+        return response.to_wire()
+
+    @staticmethod
+    def _truncated(request):
+        response = dns.message.make_response(request)
+        response.flags |= dns.flags.TC
+
+        return response.to_wire()
+
+    @classmethod
+    def _render(cls, request, response, max_size):
+        """
+        render the sections of the upstream response as the reply to the client request
+
+        The id, question, RD and CD flags and EDNS of the reply follow the client request,
+        so the upstream OPT record never reaches a client which did not send one (RFC 6891).
+        """
+        reply = dns.message.make_response(request, recursion_available=True, our_payload=cls.PAYLOAD)
+        reply.flags |= request.flags & dns.flags.CD
+
+        if request.flags & dns.flags.AD or request.ednsflags & dns.flags.DO:
+            reply.flags |= response.flags & dns.flags.AD
+
+        rcode = response.rcode()
+
+        # the extended rcodes need an OPT record
+        reply.set_rcode(rcode if rcode <= 0xF or request.edns >= 0 else dns.rcode.SERVFAIL)
+
+        reply.answer = response.answer
+        reply.authority = response.authority
+        reply.additional = response.additional
+
+        return reply.to_wire(max_size=max_size)
+
+    def handle_query(self, request, reply, max_size):
+        if request.opcode() != dns.opcode.QUERY or len(request.question) != 1:
+            reply(self._error(request, dns.rcode.NOTIMP if request.question else dns.rcode.FORMERR))
+
+            return
+
+        question = request.question[0]
+        key = (question.name.canonicalize(), question.rdtype, question.rdclass)
+
+        with self.lock:
+            self.queries += 1
+
+            waiters = self.inflight.get(key)
+
+            if waiters is not None:
+                waiters.append((request, reply, max_size))
+
+                self.coalesced += 1
+
+                return
+
+            self.inflight[key] = [(request, reply, max_size)]
+
+        try:
+            future = self.resolver.resolve_async(question.name, question.rdtype, question.rdclass, self.expired,
+                                                 self.nameservers, self.upstream_port)
+        except Exception, e:
+            future = Future()
+            future.set_exception(e)
+
+        future.add_done_callback(lambda done: self._answer(key, done))
+
+    def _answer(self, key, done):
+        with self.lock:
+            waiters = self.inflight.pop(key, [])
+
+            if done.error is not None:
+                self.failed += len(waiters)
+            else:
+                self.answered += len(waiters)
+
+        if done.error is not None:
+            self.logger.info("fail to resolve %s, %s", key[0], done.error)
+
+            for request, reply, max_size in waiters:
+                reply(self._error(request, dns.rcode.SERVFAIL))
+
+            return
+
+        for request, reply, max_size in waiters:
+            try:
+                packet = self._render(request, done.value[1], max_size)
+            except dns.exception.TooBig:
+                packet = self._truncated(request)
+            except Exception, e:
+                self.logger.warn("fail to render the response of %s, %s", key[0], e)
+
+                packet = self._error(request, dns.rcode.SERVFAIL)
+
+            reply(packet)
+
+    def close(self):
+        self.udp.close()
+
+        if self.tcp is not None:
+            self.tcp.close()
+
+        for client in list(self.clients):
+            client.close()
+
+        self.clients.clear()
+
+def parse_cmdline():
+    from optparse import OptionParser
+
+    parser = OptionParser(usage="usage: %prog [options]")
+
+    parser.add_option("-H", "--host", default="127.0.0.1",
+                      metavar="HOST", help="Address to listen on (default: %default)")
+    parser.add_option("-p", "--port", default=5353, type="int",
+                      metavar="PORT", help="Port to listen on (default: %default)")
+    parser.add_option("-n", "--nameserver", dest="nameservers", action="append",
+                      metavar="HOST", help="Upstream nameserver (default: the system nameservers)")
+    parser.add_option("--upstream-port", default=53, type="int",
+                      metavar="PORT", help="Port of the upstream nameservers (default: %default)")
+    parser.add_option("-t", "--timeout", default=5, type="int",
+                      metavar="SECS", help="Timeout of the upstream queries (default: %default)")
+    parser.add_option("--cache", default=None,
+                      metavar="FILE", help="Shared answer cache file, private to the user (default: no cache)")
+    parser.add_option("--prefetch", default=0.1, type="float",
+                      metavar="RATIO", help="Prefetch the popular answers in the last part of their TTL (default: %default)")
+    parser.add_option("--stale", default=1, type="int",
+                      metavar="SECS", help="Serve the stale answers after this delay, 0 to disable (default: %default)")
+    parser.add_option("--no-tcp", action="store_false", dest="tcp", default=True,
+                      help="Do not listen on TCP")
+    parser.add_option("--metrics", default=0, type="int",
+                      metavar="PORT", help="Serve the Prometheus metrics on localhost at this port, 0 to disable (default: %default)")
+    parser.add_option("--profile", default=None, choices=["collapsed", "pstats"],
+                      metavar="FORMAT", help="Profile the threads for 10 seconds on SIGUSR2, as collapsed stacks or pstats")
+    parser.add_option("-v", "--verbose", action="store_const",
+                      const=logging.INFO, dest="log_level", default=logging.WARN)
+
+    return parser.parse_args()
+
+if __name__=='__main__':
+    from timewheel import TimeWheel
+    from resolver import Resolver
+    from cache import SharedCache
+    from metrics import Metrics, MetricsServer
+    from profiler import install
+
+    opts, args = parse_cmdline()
+
+    logging.basicConfig(level=opts.log_level,
+                        format='%(asctime)s %(levelname)s %(message)s')
+
+    wheel = TimeWheel()
+    metrics = Metrics() if opts.metrics else None
+    resolver = Resolver(wheel, cache=SharedCache(opts.cache) if opts.cache else None, prefetch=opts.prefetch, stale=opts.stale,
+                        metrics=metrics)
+    forwarder = Forwarder(resolver, opts.host, opts.port, opts.nameservers, opts.upstream_port,
+                          opts.timeout, opts.tcp)
+
+    print "INFO: listening on %s:%d" % (forwarder.host, forwarder.port)
+
+    if opts.profile:
+        install(format=opts.profile)
+
+    exporter = None
+
+    if metrics is not None:
+        metrics.gauge('forwarder_inflight', "Client questions waiting for an upstream answer",
+                      lambda: len(forwarder.inflight))
+
+        exporter = MetricsServer(metrics, port=opts.metrics)
+
+        print "INFO: serving metrics on http://%s:%d/metrics" % (exporter.host, exporter.port)
+
+    try:
+        while resolver.isAlive():
+            resolver.join(1)
+    except KeyboardInterrupt:
+        pass
+
+    print "INFO: %s" % forwarder.stats()
+
+    if exporter is not None:
+        exporter.close()
+
+    forwarder.close()
+    resolver.close()
+    wheel.terminate()
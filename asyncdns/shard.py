@@ -0,0 +1,382 @@
+#!/usr/bin/env python
+from __future__ import with_statement
+
+import os
+import gc
+import time
+import zlib
+import socket
+import logging
+import asyncore
+import threading
+import itertools
+import multiprocessing
+import Queue
+import cPickle
+
+import dns.rdatatype
+import dns.rdataclass
+
+from timewheel import TimeWheel
+from resolver import Resolver
+from utils import Future
+
+PICKLE_PROTOCOL = 2
+
+def _merge(results, partial):
+    for name, records in partial.items():
+        results.setdefault(name, {}).update(records)
+
+    return results
+
+def _portable(error):
+    try:
+        cPickle.dumps(error, PICKLE_PROTOCOL)
+
+        return error
+    except Exception:
+        return socket.error(str(error))
+
+def _close_inherited():
+    """
+    close the sockets of the dispatchers inherited from the parent, which keeps using its own copies
+    """
+    # the pipelines poll their own socket maps, so the dispatchers are found wherever they are registered
+    for dispatcher in [obj for obj in gc.get_objects() if isinstance(obj, asyncore.dispatcher)]:
+        if dispatcher.socket is not None:
+            try:
+                dispatcher.socket.close()
+            except (socket.error, OSError):
+                pass
+
+    asyncore.socket_map.clear()
+
+def run_worker(conn, options, batch_size=256):
+    """
+    serve the lookups received from the front end with a resolver of its own, until the pipe is closed
+    """
+    _close_inherited()
+
+    logger = logging.getLogger("asyncdns.shard")
+
+    wheel = TimeWheel()
+    resolver = Resolver(wheel, **options)
+    replies = Queue.Queue()
+
+    def flush():
+        while True:
+            reply = replies.get()
+
+            if reply is None:
+                break
+
+            batch = [reply]
+
+            while len(batch) < batch_size:
+                try:
+                    reply = replies.get_nowait()
+                except Queue.Empty:
+                    break
+
+                if reply is None:
+                    replies.put_nowait(None)
+
+                    break
+
+                batch.append(reply)
+
+            conn.send_bytes(cPickle.dumps(batch, PICKLE_PROTOCOL))
+
+    sender = threading.Thread(target=flush, name="asyncdns.shard")
+    sender.setDaemon(True)
+    sender.start()
+
+    def lookup(seq, qname, rdtypes, rdclass, expired, nameservers, port, iterative, follow_cname):
+        lock = threading.Lock()
+        state = {'remaining': len(rdtypes), 'nameserver': None, 'results': None, 'error': None}
+
+        def onfinish(done):
+            with lock:
+                if done.error is not None:
+                    state['error'] = done.error
+                else:
+                    state['nameserver'], results = done.value
+                    state['results'] = _merge(state['results'] or {}, results)
+
+                state['remaining'] -= 1
+
+                if state['remaining'] > 0:
+                    return
+
+            if state['results'] is not None:
+                replies.put_nowait((seq, state['nameserver'], state['results'], None))
+            else:
+                replies.put_nowait((seq, None, None, _portable(state['error'])))
+
+        for rdtype in rdtypes:
+            try:
+                future = resolver.lookup_async(qname, rdtype, rdclass, expired, nameservers, port,
+                                               iterative, follow_cname)
+            except Exception, e:
+                future = Future()
+                future.set_exception(e)
+
+            future.add_done_callback(onfinish)
+
+    try:
+        while True:
+            try:
+                request = cPickle.loads(conn.recv_bytes())
+            except EOFError:
+                break
+
+            if request is None:
+                break
+
+            lookup(*request)
+    except Exception, e:
+        logger.warn("shard %d was aborted, %s", os.getpid(), e)
+    finally:
+        replies.put_nowait(None)
+        sender.join()
+
+        resolver.close()
+        wheel.terminate()
+
+        conn.close()
+
+class Shard(object):
+    """
+
+    Shard is the front end side of a worker process, which owns the pipe to it and the futures of its lookups
+
+    """
+    logger = logging.getLogger("asyncdns.shard")
+
+    def __init__(self, index, options):
+        self.index = index
+        self.lock = threading.Lock()
+        self.futures = {}
+        self.seq = 0
+        self.submitted = 0
+        self.completed = 0
+
+        self.conn, child = multiprocessing.Pipe()
+
+        self.process = multiprocessing.Process(target=run_worker, args=(child, options),
+                                               name="asyncdns.shard.%d" % index)
+        self.process.daemon = True
+        self.process.start()
+
+        child.close()
+
+        self.reader = threading.Thread(target=self.run, name="asyncdns.shard")
+        self.reader.setDaemon(True)
+
+    def start(self):
+        self.reader.start()
+
+    def __len__(self):
+        return len(self.futures)
+
+    def stats(self):
+        return {
+            'pid': self.process.pid,
+            'pending': len(self),
+            'submitted': self.submitted,
+            'completed': self.completed,
+        }
+
+    def submit(self, qname, rdtypes, rdclass, expired, nameservers, port, iterative, follow_cname):
+        future = Future()
+
+        with self.lock:
+            self.seq += 1
+            self.submitted += 1
+            self.futures[self.seq] = future
+
+            self.conn.send_bytes(cPickle.dumps((self.seq, qname, rdtypes, rdclass, expired,
+                                                nameservers, port, iterative, follow_cname), PICKLE_PROTOCOL))
+
+        return future
+
+    def run(self):
+        while True:
+            try:
+                replies = cPickle.loads(self.conn.recv_bytes())
+            except (EOFError, IOError):
+                break
+
+            for seq, nameserver, results, error in replies:
+                with self.lock:
+                    future = self.futures.pop(seq, None)
+                    self.completed += 1
+
+                if future is None:
+                    continue
+
+                if error is not None:
+                    future.set_exception(error)
+                else:
+                    future.set_result((nameserver, results))
+
+        with self.lock:
+            futures, self.futures = self.futures.values(), {}
+
+        for future in futures:
+            future.set_exception(socket.error("shard %d was terminated" % self.index))
+
+    def close(self):
+        with self.lock:
+            try:
+                self.conn.send_bytes(cPickle.dumps(None, PICKLE_PROTOCOL))
+            except IOError:
+                pass
+
+        self.reader.join()
+        self.process.join()
+
+        self.conn.close()
+
+class ShardedResolver(object):
+    """
+
+    ShardedResolver spreads the lookups over worker processes, each with its own resolver, sockets and time wheel
+
+    A domain is always resolved by the same shard, chosen by the crc32 of its lowercased name,
+    so the shard-local caches stay effective. The requests and the batched results are
+    exchanged as binary pickles over a pipe per shard, the parsing and the result extraction
+    run in the workers and scale with the cores instead of one GIL.
+
+    The workers are forked, so the sharded resolver must be created before any other asyncdns
+    thread runs, otherwise a worker could inherit a lock held by a thread it does not have.
+
+    """
+    logger = logging.getLogger("asyncdns.shard")
+
+    def __init__(self, shards=None, **options):
+        if shards is None:
+            shards = multiprocessing.cpu_count()
+
+        threads = [thread.getName() for thread in threading.enumerate() if thread.getName().startswith("asyncdns.")]
+
+        if threads:
+            raise RuntimeError("fork the shards before any asyncdns thread, found %s" % ', '.join(sorted(set(threads))))
+
+        self.shards = [Shard(i, options) for i in range(shards)]
+
+        # the readers are only started once all the workers are forked
+        for shard in self.shards:
+            shard.start()
+
+    def __len__(self):
+        return sum([len(shard) for shard in self.shards])
+
+    def stats(self):
+        return [shard.stats() for shard in self.shards]
+
+    def shard(self, qname):
+        key = str(qname).lower().rstrip('.')
+
+        return self.shards[(zlib.crc32(key) & 0xffffffff) % len(self.shards)]
+
+    def lookup_async(self, qname, rdtype=dns.rdatatype.A, rdclass=dns.rdataclass.IN, expired=30,
+                     nameservers=None, port=53, iterative=False, follow_cname=0):
+        if isinstance(rdtype, str):
+            rdtype = dns.rdatatype.from_text(rdtype)
+
+        return self.shard(qname).submit(str(qname), [rdtype], rdclass, expired,
+                                        nameservers, port, iterative, follow_cname)
+
+    def lookup(self, qname, rdtype=dns.rdatatype.A, rdclass=dns.rdataclass.IN, expired=30,
+               nameservers=None, port=53, iterative=False, follow_cname=0):
+        try:
+            nameserver, results = self.lookup_async(qname, rdtype, rdclass, expired, nameservers, port,
+                                                    iterative, follow_cname).result(expired)
+
+            return results
+        except Exception, e:
+            self.logger.warn("fail to lookup domain %s: %s", qname, e)
+
+            return {}
+
+    def lookup_many(self, qnames, rdtypes=(dns.rdatatype.A,), rdclass=dns.rdataclass.IN,
+                    expired=30, concurrency=100, nameservers=None, port=53, iterative=False, follow_cname=0):
+        """
+
+        lookup_many works like Resolver.lookup_many, except that `concurrency` counts the domains in flight
+        over all the shards, and all the record types of a domain are resolved by one shard in one round trip
+
+        """
+        qnames = iter(qnames)
+        finished = Queue.Queue()
+        keys = itertools.count()
+        outstanding = {}
+        inflight = 0
+
+        def onfinish(key):
+            def callback(done):
+                finished.put_nowait((key, done.error if done.error is not None else done.value[1]))
+
+            return callback
+
+        while True:
+            while inflight < concurrency:
+                try:
+                    qname = qnames.next()
+                except StopIteration:
+                    break
+
+                qname = str(qname).strip()
+
+                if not qname:
+                    continue
+
+                inflight += 1
+
+                key = keys.next()
+                outstanding[key] = (qname, time.time() + expired + Resolver.LOOKUP_MARGIN)
+
+                try:
+                    future = self.shard(qname).submit(qname, rdtypes, rdclass, expired, nameservers, port,
+                                                      iterative, follow_cname)
+                except Exception, e:
+                    self.logger.warn("fail to query domain %s: %s", qname, e)
+
+                    finished.put_nowait((key, e))
+                else:
+                    future.add_done_callback(onfinish(key))
+
+            if inflight == 0:
+                break
+
+            timeout = min([deadline for qname, deadline in outstanding.values()]) - time.time()
+
+            try:
+                key, results = finished.get(timeout=max(timeout, 0))
+            except Queue.Empty:
+                now = time.time()
+
+                for key, (qname, deadline) in outstanding.items():
+                    if deadline <= now:
+                        del outstanding[key]
+
+                        inflight -= 1
+
+                        yield qname, socket.timeout("lookup of domain %s was timeout after %d seconds" % (qname, expired))
+
+                continue
+
+            # a late result of a domain already given up is dropped
+            if key not in outstanding:
+                continue
+
+            qname, deadline = outstanding.pop(key)
+
+            inflight -= 1
+
+            yield qname, results
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
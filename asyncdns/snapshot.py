@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+from __future__ import with_statement
+
+import os
+import time
+import logging
+import marshal
+import threading
+
+class Snapshot(object):
+    """
+
+    Snapshot saves what a resolver learned to a file, and restores it after a restart
+
+    The delegations, the CNAME links and the nameserver round trip times are dumped as plain
+    tuples with marshal, which loads millions of entries in a fraction of a second. The restored
+    entries are only parsed when a lookup needs them, and dropped if they have expired by then.
+    The answers of a SharedCache are already kept in its file, which is flushed with each snapshot.
+
+    The periodic saves run on a thread of their own, the time wheel only starts them,
+    so its query timeouts are not held up while a large state is dumped.
+
+    """
+    logger = logging.getLogger("asyncdns.snapshot")
+
+    MAGIC = 'ASYNCDNS-SNAPSHOT-1\n'
+
+    def __init__(self, resolver, path, interval=300):
+        self.resolver = resolver
+        self.path = path
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.timer = None
+        self.saver = None
+        self.saved = None
+
+    def load(self):
+        """
+        restore the snapshot if it exists, return False if there was none
+        """
+        try:
+            with open(self.path, 'rb') as f:
+                if f.read(len(self.MAGIC)) != self.MAGIC:
+                    self.logger.warn("ignore the invalid snapshot %s", self.path)
+
+                    return False
+
+                state = marshal.load(f)
+        except IOError:
+            return False
+        except (EOFError, ValueError, TypeError), e:
+            self.logger.warn("ignore the broken snapshot %s, %s", self.path, e)
+
+            return False
+
+        self.resolver.delegations.restore(*state['delegations'])
+        self.resolver.cnames.restore(state['cnames'])
+        self.resolver.servers.restore(state['servers'])
+
+        self.logger.info("restored the snapshot %s saved at %s", self.path, time.ctime(state['time']))
+
+        return True
+
+    def save(self):
+        state = {
+            'time': time.time(),
+            'delegations': self.resolver.delegations.dump(),
+            'cnames': self.resolver.cnames.dump(),
+            'servers': self.resolver.servers.dump(),
+        }
+
+        with self.lock:
+            temp = self.path + '.tmp'
+
+            with open(temp, 'wb') as f:
+                f.write(self.MAGIC)
+
+                marshal.dump(state, f, 2)
+
+            os.rename(temp, self.path)
+
+            if self.resolver.cache is not None and hasattr(self.resolver.cache, 'flush'):
+                self.resolver.cache.flush()
+
+            self.saved = state['time']
+
+    def start(self):
+        """
+        load the snapshot and save it every `interval` seconds on the resolver time wheel
+        """
+        self.load()
+
+        self._schedule()
+
+        return self
+
+    def _schedule(self):
+        self.timer = self.resolver.wheel.create(self._tick, self.interval)
+
+    def _save(self):
+        try:
+            self.save()
+        except Exception, e:
+            self.logger.warn("fail to save the snapshot %s, %s", self.path, e)
+
+    def _tick(self):
+        if self.saver is not None and self.saver.isAlive():
+            self.logger.info("skip the snapshot %s, the previous save is still running", self.path)
+        else:
+            self.saver = threading.Thread(target=self._save, name="asyncdns.snapshot")
+            self.saver.setDaemon(True)
+            self.saver.start()
+
+        if self.timer is not None:
+            self._schedule()
+
+    def close(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+        if self.saver is not None:
+            self.saver.join()
+
+        self.save()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+from __future__ import with_statement
+
+import struct
+from errno import ECONNRESET, ENOTCONN, ESHUTDOWN, ECONNABORTED, EPIPE, EBADF
+
+# the errors of a receive on a connection which has been closed or reset by the peer
+DISCONNECTED = [ECONNRESET, ENOTCONN, ESHUTDOWN, ECONNABORTED, EPIPE, EBADF]
+
+class StreamReader(object):
+    """
+
+    StreamReader receives a stream socket into a preallocated buffer
+
+    The exact reads of the socks negotiation and the length prefixed DNS messages over TCP
+    are cut out of the buffer by offsets, so a message split over many segments is copied once,
+    instead of growing and reslicing a string for each segment. The unread bytes are moved to
+    the front only when the buffer runs out of room, and it only grows for a bigger message.
+
+    """
+    LENGTH = struct.Struct(">H")
+
+    # room for the largest DNS message with its length prefix
+    DEFAULT_SIZE = 65535 + 2
+
+    def __init__(self, sock, size=DEFAULT_SIZE):
+        self.sock = sock
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+
+    def __len__(self):
+        return self.end - self.start
+
+    def _reserve(self, size):
+        """
+        make room for `size` unread bytes from the current position
+        """
+        if self.start + size <= len(self.buffer):
+            return
+
+        unread = self.end - self.start
+
+        if size > len(self.buffer):
+            buf = bytearray(max(size, len(self.buffer) * 2))
+            buf[:unread] = self.view[self.start:self.end]
+
+            self.buffer = buf
+            self.view = memoryview(buf)
+        else:
+            self.buffer[:unread] = self.buffer[self.start:self.end]
+
+        self.start, self.end = 0, unread
+
+    def _consume(self, size):
+        data = self.view[self.start:self.start+size].tobytes()
+
+        self.start += size
+
+        if self.start == self.end:
+            self.start = self.end = 0
+
+        return data
+
+    def fill(self):
+        """
+        receive what is available into the free room, return the number of bytes or 0 when the peer has closed
+        """
+        if self.end == len(self.buffer):
+            self._reserve(len(self.buffer) - self.start + 1)
+
+        nbytes = self.sock.recv_into(self.view[self.end:], len(self.buffer) - self.end)
+
+        self.end += nbytes
+
+        return nbytes
+
+    def read(self, size):
+        """
+        read exactly `size` bytes from a blocking socket, raise EOFError if the peer closes first
+        """
+        self._reserve(size)
+
+        while self.end - self.start < size:
+            if not self.fill():
+                raise EOFError("connection was closed after %d of %d bytes" % (self.end - self.start, size))
+
+        return self._consume(size)
+
+    def frames(self):
+        """
+        cut the complete 2 bytes length prefixed messages out of the received bytes
+        """
+        frames = []
+
+        while self.end - self.start >= 2:
+            size = self.LENGTH.unpack_from(self.buffer, self.start)[0]
+
+            if self.end - self.start < size + 2:
+                self._reserve(size + 2)
+
+                break
+
+            self.start += 2
+
+            frames.append(self._consume(size))
+
+        return frames
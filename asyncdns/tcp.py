@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+from __future__ import with_statement
+
+import logging
+import socket
+import struct
+import random
+import asyncore
+import threading
+
+import dns.message
+import dns.exception
+
+from stream import StreamReader, DISCONNECTED
+
+class TcpConnection(asyncore.dispatcher):
+    """
+
+    TcpConnection is a persistent, non-blocking DNS over TCP connection to a nameserver
+
+    The queries are pipelined on the connection with a connection unique message id,
+    and the responses are matched by id in whatever order they come back (RFC 7766).
+
+    """
+    logger = logging.getLogger("asyncdns.tcp")
+
+    def __init__(self, pool, nameserver):
+        asyncore.dispatcher.__init__(self, map=pool.pipeline.map)
+
+        self.pool = pool
+        self.nameserver = nameserver
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.outbuf = []
+        self.idle_timer = None
+
+        self.create_socket(socket.AF_INET6 if ':' in nameserver[0] else socket.AF_INET, socket.SOCK_STREAM)
+        self.reader = StreamReader(self.socket)
+        self.connect(nameserver)
+
+    def __len__(self):
+        return len(self.pending)
+
+    def query(self, request, expired, callback, retried=False):
+        with self.lock:
+            qid = request.id
+
+            while qid in self.pending:
+                qid = random.randint(0, 65535)
+
+            def ontimeout():
+                with self.lock:
+                    if self.pending.pop(qid, None) is None:
+                        return
+
+                    self._check_idle()
+
+                self.pool.dispatch(callback, self.nameserver,
+                                   socket.timeout("dns query to %s over tcp was timeout after %d seconds" % (self.nameserver[0], expired)))
+
+            timer = self.pool.wheel.create(ontimeout, expired)
+
+            self.pending[qid] = (request, expired, callback, timer, retried)
+
+            if self.idle_timer:
+                self.idle_timer.cancel()
+                self.idle_timer = None
+
+            packet = struct.pack(">H", qid) + request.to_wire()[2:]
+
+            self.outbuf.append(struct.pack(">H", len(packet)) + packet)
+
+    def _check_idle(self):
+        if not self.pending and self.idle_timer is None and self.pool.idle:
+            self.idle_timer = self.pool.wheel.create(self.handle_idle, self.pool.idle)
+
+    def handle_idle(self):
+        with self.lock:
+            if self.pending:
+                return
+
+        self.logger.info("close the idle tcp connection to %s:%d", *self.nameserver)
+
+        self.handle_close()
+
+    def handle_connect(self):
+        self.logger.info("connected to %s:%d over tcp", *self.nameserver)
+
+    def writable(self):
+        return not self.connected or bool(self.outbuf)
+
+    def handle_write(self):
+        with self.lock:
+            data, self.outbuf = ''.join(self.outbuf), []
+
+        sent = self.send(data)
+
+        if sent < len(data):
+            with self.lock:
+                self.outbuf.insert(0, data[sent:])
+
+    def handle_read(self):
+        try:
+            received = self.reader.fill()
+        except socket.error, why:
+            if why[0] in DISCONNECTED:
+                received = 0
+            else:
+                raise
+
+        if not received:
+            self.handle_close()
+
+            return
+
+        responses = self._parse()
+
+        for request, callback, response in responses:
+            self.pool.dispatch(callback, self.nameserver, response)
+
+    def _parse(self):
+        responses = []
+
+        for packet in self.reader.frames():
+            try:
+                response = dns.message.from_wire(packet)
+            except dns.exception.DNSException:
+                self.logger.warn("drop invalid DNS packet from %s:%d over tcp", *self.nameserver)
+
+                continue
+
+            with self.lock:
+                task = self.pending.get(response.id)
+
+                if task is None or task[0].question != response.question:
+                    self.logger.warn("drop unexpected DNS packet from %s:%d over tcp", *self.nameserver)
+
+                    continue
+
+                del self.pending[response.id]
+
+                self._check_idle()
+
+            request, expired, callback, timer, retried = task
+
+            timer.cancel()
+
+            response.id = request.id
+
+            responses.append((request, callback, response))
+
+        return responses
+
+    def handle_error(self):
+        self.logger.warn("fail to talk to %s:%d over tcp", *self.nameserver)
+
+        self.handle_close()
+
+    def handle_close(self):
+        self.close()
+
+        self.pool.remove(self)
+
+        with self.lock:
+            pending, self.pending = self.pending.values(), {}
+
+            if self.idle_timer:
+                self.idle_timer.cancel()
+
+        for request, expired, callback, timer, retried in pending:
+            timer.cancel()
+
+            if retried:
+                self.pool.dispatch(callback, self.nameserver,
+                                   socket.error("tcp connection to %s was closed" % self.nameserver[0]))
+            else:
+                self.pool.query(request, expired, callback, self.nameserver, True)
+
+class TcpPool(object):
+    """
+
+    TcpPool keeps a few persistent TCP connections per nameserver, for the queries which need TCP
+
+    """
+    logger = logging.getLogger("asyncdns.tcp")
+
+    def __init__(self, pipeline, max_connections=2, max_pending=64, idle=30):
+        self.pipeline = pipeline
+        self.wheel = pipeline.wheel
+        self.max_connections = max_connections
+        self.max_pending = max_pending
+        self.idle = idle
+        self.lock = threading.Lock()
+        self.connections = {}
+        self.closed = False
+        self.queries = 0
+        self.connects = 0
+
+    def __len__(self):
+        return sum([len(conns) for conns in self.connections.values()])
+
+    @property
+    def pending(self):
+        return sum([len(conn) for conns in self.connections.values() for conn in conns])
+
+    def stats(self):
+        return {
+            'connections': len(self),
+            'pending': self.pending,
+            'queries': self.queries,
+            'connects': self.connects,
+        }
+
+    def dispatch(self, callback, nameserver, response):
+        self.pipeline.executor.submit(self.pipeline._invoke_callback, callback, nameserver, response)
+
+    def remove(self, conn):
+        with self.lock:
+            conns = self.connections.get(conn.nameserver, [])
+
+            if conn in conns:
+                conns.remove(conn)
+
+    def query(self, request, expired, callback, nameserver, retried=False):
+        if self.closed:
+            self.dispatch(callback, nameserver, socket.error("tcp pool was closed"))
+
+            return
+
+        with self.lock:
+            conns = self.connections.setdefault(nameserver, [])
+
+            conn = min(conns, key=len) if conns else None
+
+            if conn is None or (len(conn) >= self.max_pending and len(conns) < self.max_connections):
+                self.logger.info("connecting to %s:%d over tcp", *nameserver)
+
+                conn = TcpConnection(self, nameserver)
+
+                conns.append(conn)
+
+                self.connects += 1
+
+            self.queries += 1
+
+        conn.query(request, expired, callback, retried)
+
+    def close(self):
+        self.closed = True
+
+        with self.lock:
+            conns = [conn for conns in self.connections.values() for conn in conns]
+
+        for conn in conns:
+            conn.handle_close()
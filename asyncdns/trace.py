@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+from __future__ import with_statement
+
+import time
+import bisect
+import random
+import threading
+
+ENQUEUE = 'enqueue'
+SEND = 'send'
+RECEIVE = 'receive'
+PARSE = 'parse'
+MATCH = 'match'
+CALLBACK_START = 'callback_start'
+CALLBACK_END = 'callback_end'
+TIMEOUT = 'timeout'
+
+STAGES = [ENQUEUE, SEND, RECEIVE, PARSE, MATCH, CALLBACK_START, CALLBACK_END, TIMEOUT]
+
+# the spans between the stages, a query which timed out goes from the send to the timeout instead of the match
+SPANS = [
+    ('queue', ENQUEUE, SEND),
+    ('wire', SEND, RECEIVE),
+    ('parse', RECEIVE, PARSE),
+    ('match', PARSE, MATCH),
+    ('dispatch', MATCH, CALLBACK_START),
+    ('wait', SEND, TIMEOUT),
+    ('dispatch', TIMEOUT, CALLBACK_START),
+    ('callback', CALLBACK_START, CALLBACK_END),
+    ('total', ENQUEUE, CALLBACK_END),
+]
+
+class Trace(object):
+    """
+
+    Trace keeps the timestamps of the stages reached by a query to one nameserver
+
+    """
+    __slots__ = ['tracer', 'qname', 'rdtype', 'nameserver', 'stamps']
+
+    def __init__(self, tracer, request, nameserver):
+        question = request.question[0]
+
+        self.tracer = tracer
+        self.qname = question.name
+        self.rdtype = question.rdtype
+        self.nameserver = nameserver
+        self.stamps = {ENQUEUE: time.time()}
+
+    def __repr__(self):
+        return "<Trace %s @ %s:%d %s>" % (self.qname, self.nameserver[0], self.nameserver[1], self.durations())
+
+    def mark(self, stage, when=None):
+        self.stamps[stage] = time.time() if when is None else when
+
+    def durations(self):
+        """
+        return the seconds spent in each span whose both stages were reached
+        """
+        stamps = self.stamps
+
+        return dict([(name, stamps[end] - stamps[begin]) for name, begin, end in SPANS
+                     if begin in stamps and end in stamps])
+
+    def finish(self):
+        self.tracer.finish(self)
+
+class Tracer(object):
+    """
+
+    Tracer is the hook of a pipeline to follow its queries through the stages
+
+    The pipeline asks the tracer to start a Trace for each query it queues to a nameserver,
+    the trace is carried with the query and marked at each stage, and handed to `finish`
+    once the callback has returned. Without a tracer the pipeline carries None instead.
+
+    With a `sample` ratio below 1, only that share of the queries is traced,
+    so the tracing can be left on in production.
+
+    """
+    def __init__(self, sample=1.0):
+        self.sample = sample
+
+    def start(self, request, nameserver):
+        """
+        return a new trace of the query, or None when it is not sampled
+        """
+        if self.sample < 1.0 and random.random() >= self.sample:
+            return None
+
+        return Trace(self, request, nameserver)
+
+    def finish(self, trace):
+        """
+        called on the executor after the callback of the traced query, override it to consume the trace
+        """
+        pass
+
+class Histogram(object):
+    """
+
+    Histogram counts the observed values in fixed buckets, whose upper bounds are inclusive
+
+    """
+    BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def percentile(self, ratio):
+        """
+        return the upper bound of the bucket holding the `ratio` percentile, or None without values
+        """
+        if not self.count:
+            return None
+
+        rank = ratio * self.count
+        total = 0
+
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+
+            if total >= rank:
+                return bound
+
+        return float('inf')
+
+    def cumulative(self):
+        """
+        return the (upper bound, number of values below it) pairs, ending with infinity
+        """
+        total = 0
+        result = []
+
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+
+            result.append((bound, total))
+
+        return result
+
+class HistogramTracer(Tracer):
+    """
+
+    HistogramTracer breaks the latency of the traced queries down into a histogram per span
+
+    """
+    def __init__(self, sample=1.0, buckets=Histogram.BUCKETS):
+        Tracer.__init__(self, sample)
+
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.spans = {}
+
+    def finish(self, trace):
+        with self.lock:
+            for name, duration in trace.durations().items():
+                histogram = self.spans.get(name)
+
+                if histogram is None:
+                    histogram = self.spans[name] = Histogram(self.buckets)
+
+                histogram.observe(duration)
+
+    def histograms(self):
+        """
+        return a copy of the histograms by span name
+        """
+        with self.lock:
+            result = {}
+
+            for name, histogram in self.spans.items():
+                copy = result[name] = Histogram(histogram.buckets)
+                copy.counts = list(histogram.counts)
+                copy.count = histogram.count
+                copy.sum = histogram.sum
+
+            return result
+
+    def stats(self):
+        """
+        return the count, mean, p50 and p99 of each span
+        """
+        return dict([(name, {
+            'count': histogram.count,
+            'mean': histogram.sum / histogram.count,
+            'p50': histogram.percentile(0.5),
+            'p99': histogram.percentile(0.99),
+        }) for name, histogram in self.histograms().items()])
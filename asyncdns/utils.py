@@ -1,7 +1,11 @@
 #!/usr/bin/env python
 from __future__ import with_statement
 
+import time
+import socket
+import logging
 import threading
+import Queue
 
 class CountDownLatch(object):
     def __init__(self, count=1):
@@ -15,23 +19,214 @@ class CountDownLatch(object):
             if self.count <= 0:
                 self.lock.notifyAll()
 
-    def await(self):
+    def await(self, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+
         with self.lock:
             while self.count > 0:
-                self.lock.wait(0.5)
+                if deadline is None:
+                    self.lock.wait()
+                else:
+                    remaining = deadline - time.time()
+
+                    if remaining <= 0:
+                        break
+
+                    self.lock.wait(remaining)
+
+            return self.count <= 0
 
 class ResultCollector(dict):
+    """
+
+    ResultCollector gathers the responses of a group of lookups by domain and nameserver
+
+    Each call of `results` streams from a completion queue of its own, starting with
+    the responses collected so far and fed until it ends, so a caller which only awaits
+    the collector does not keep every response twice, and `results` may be called again.
+
+    """
     def __init__(self, count):
         self.latch = CountDownLatch(count)
+        self.count = count
+        self.lock = threading.Lock()
+        self.streams = []
 
     def onfinish(self, nameserver, qname, response):
-        if isinstance(response, Exception):
-            self.setdefault('errors', []).append((nameserver, qname, response))
-        else:
-            self.setdefault(qname, {}).setdefault(nameserver, []).append(response)
+        with self.lock:
+            if isinstance(response, Exception):
+                self.setdefault('errors', []).append((nameserver, qname, response))
+            else:
+                self.setdefault(qname, {}).setdefault(nameserver, []).append(response)
+
+            for stream in self.streams:
+                stream.put_nowait((nameserver, qname, response))
 
         self.latch.countDown()
 
-    def await(self):
-        self.latch.await()
+    def await(self, timeout=None):
+        return self.latch.await(timeout)
+
+    def _stream(self):
+        stream = Queue.Queue()
+
+        with self.lock:
+            for qname, responses in self.items():
+                if qname == 'errors':
+                    for error in responses:
+                        stream.put_nowait(error)
+                else:
+                    for nameserver, values in responses.items():
+                        for response in values:
+                            stream.put_nowait((nameserver, qname, response))
+
+            self.streams.append(stream)
+
+        return stream
+
+    def results(self, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+
+        stream = self._stream()
+
+        try:
+            for i in range(self.count):
+                try:
+                    if deadline is None:
+                        yield stream.get()
+                    else:
+                        yield stream.get(timeout=max(0, deadline - time.time()))
+                except Queue.Empty:
+                    raise socket.timeout("results were not finished after %s seconds" % timeout)
+        finally:
+            with self.lock:
+                self.streams.remove(stream)
+
+class Batch(object):
+    """
+
+    Batch is a future style handle for a group of queries, which hands back the futures as they complete
+
+    """
+    def __init__(self, futures=None):
+        self.completed = Queue.Queue()
+        self.futures = []
+
+        for future in futures or []:
+            self.add(future)
+
+    def __len__(self):
+        return len(self.futures)
+
+    def add(self, future):
+        self.futures.append(future)
+
+        future.add_done_callback(self.completed.put_nowait)
+
+        return future
+
+    def done(self):
+        return all([future.done() for future in self.futures])
+
+    def wait(self, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+
+        for future in self.futures:
+            if not future.wait(None if deadline is None else max(0, deadline - time.time())):
+                return False
+
+        return True
+
+    def as_completed(self, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+
+        for i in range(len(self.futures)):
+            try:
+                if deadline is None:
+                    yield self.completed.get()
+                else:
+                    yield self.completed.get(timeout=max(0, deadline - time.time()))
+            except Queue.Empty:
+                raise socket.timeout("batch was not finished after %s seconds" % timeout)
+
+class Future(object):
+    """
+
+    Future is a placeholder for the result of an asynchronous query
+
+    The done callbacks are executed on the thread which completes the future,
+    so a caller running its own event loop never needs a thread hop.
+
+    """
+    logger = logging.getLogger("asyncdns.future")
+
+    def __init__(self):
+        self.lock = threading.Condition()
+        self.finished = False
+        self.value = None
+        self.error = None
+        self.callbacks = []
+
+    def done(self):
+        return self.finished
+
+    def _finish(self, value, error):
+        with self.lock:
+            if self.finished:
+                return False
+
+            self.value = value
+            self.error = error
+            self.finished = True
+
+            self.lock.notifyAll()
+
+            callbacks, self.callbacks = self.callbacks, []
+
+        for callback in callbacks:
+            self._execute_callback(callback)
+
+        return True
+
+    def _execute_callback(self, callback):
+        try:
+            callback(self)
+        except Exception, e:
+            self.logger.warn("fail to execute done callback: %s", e)
+
+    def set_result(self, value):
+        return self._finish(value, None)
+
+    def set_exception(self, error):
+        return self._finish(None, error)
+
+    def add_done_callback(self, callback):
+        with self.lock:
+            if not self.finished:
+                self.callbacks.append(callback)
+
+                return
+
+        self._execute_callback(callback)
+
+    def wait(self, timeout=None):
+        with self.lock:
+            if not self.finished:
+                self.lock.wait(timeout)
+
+            return self.finished
+
+    def exception(self, timeout=None):
+        if not self.wait(timeout):
+            raise socket.timeout("future was not finished after %s seconds" % timeout)
+
+        return self.error
+
+    def result(self, timeout=None):
+        if not self.wait(timeout):
+            raise socket.timeout("future was not finished after %s seconds" % timeout)
+
+        if self.error is not None:
+            raise self.error
 
+        return self.value
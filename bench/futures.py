@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+#
+# Compare the blocking Pipeline.query driven by a pool of caller threads
+# with the future based Pipeline.query_async on the same workload
+#
+from __future__ import with_statement
+
+import sys
+import os.path
+import time
+import logging
+import threading
+import Queue
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import asyncdns
+
+from responder import Responder
+
+def parse_cmdline():
+    from optparse import OptionParser
+
+    parser = OptionParser(usage="usage: %prog [options]")
+
+    parser.add_option("-n", "--queries", default=2000, type="int",
+                      metavar="NUM", help="Number of queries to send (default: %default)")
+    parser.add_option("-c", "--concurrency", default=50, type="int",
+                      metavar="NUM", help="Number of queries in flight (default: %default)")
+    parser.add_option("-l", "--latency", default=0.01, type="float",
+                      metavar="SECS", help="Latency of the stand-in server (default: %default)")
+    parser.add_option("-v", "--verbose", action="store_const",
+                      const=logging.INFO, dest="log_level", default=logging.WARN)
+
+    return parser.parse_args()
+
+def bench_threads(pipeline, domains, concurrency, nameservers, port):
+    tasks = Queue.Queue()
+
+    for domain in domains:
+        tasks.put_nowait(domain)
+
+    def worker():
+        while True:
+            try:
+                domain = tasks.get_nowait()
+            except Queue.Empty:
+                break
+
+            pipeline.query(domain, expired=5, nameservers=nameservers, port=port)
+
+    workers = [threading.Thread(target=worker) for i in range(concurrency)]
+
+    [worker.start() for worker in workers]
+    [worker.join() for worker in workers]
+
+def bench_futures(pipeline, domains, concurrency, nameservers, port):
+    window = threading.Semaphore(concurrency)
+    futures = []
+
+    for domain in domains:
+        window.acquire()
+
+        future = pipeline.query_async(domain, expired=5, nameservers=nameservers, port=port)
+        future.add_done_callback(lambda future: window.release())
+
+        futures.append(future)
+
+    for future in futures:
+        future.wait()
+
+if __name__=='__main__':
+    opts, args = parse_cmdline()
+
+    logging.basicConfig(level=opts.log_level,
+                        format='%(asctime)s %(levelname)s %(message)s')
+
+    responder = Responder(latency=opts.latency)
+    pipeline = asyncdns.Pipeline()
+
+    for name, bench in [('threads', bench_threads), ('futures', bench_futures)]:
+        domains = ["%s%d.bench" % (name, i) for i in range(opts.queries)]
+
+        start = time.time()
+
+        bench(pipeline, domains, opts.concurrency, [responder.host], responder.port)
+
+        elapsed = time.time() - start
+
+        print "%-8s %d queries in %.3f seconds, %.1f qps" % (name, opts.queries, elapsed, opts.queries / elapsed)
+
+    responder.terminate()
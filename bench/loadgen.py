@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+#
+# A query generator for load testing a DNS server, like the asyncdns forwarder:
+#
+#   python -m asyncdns.server -p 5353 -n 127.0.0.1 --upstream-port 5354 &
+#   python bench/responder.py 5354 &
+#   python bench/loadgen.py -p 5353
+#
+from __future__ import with_statement
+
+import sys
+import time
+import random
+import select
+import socket
+import struct
+import logging
+
+import dns.message
+import dns.rdatatype
+
+def parse_cmdline():
+    from optparse import OptionParser
+
+    parser = OptionParser(usage="usage: %prog [options]")
+
+    parser.add_option("-s", "--server", default="127.0.0.1",
+                      metavar="HOST", help="Server to query (default: %default)")
+    parser.add_option("-p", "--port", default=5353, type="int",
+                      metavar="PORT", help="Port of the server (default: %default)")
+    parser.add_option("-n", "--queries", default=10000, type="int",
+                      metavar="NUM", help="Number of queries to send (default: %default)")
+    parser.add_option("-c", "--concurrency", default=100, type="int",
+                      metavar="NUM", help="Number of queries in flight (default: %default)")
+    parser.add_option("-d", "--domains", default=1000, type="int",
+                      metavar="NUM", help="Number of distinct domains to query (default: %default)")
+    parser.add_option("-t", "--timeout", default=2.0, type="float",
+                      metavar="SECS", help="Timeout of a query (default: %default)")
+    parser.add_option("-v", "--verbose", action="store_const",
+                      const=logging.INFO, dest="log_level", default=logging.WARN)
+
+    return parser.parse_args()
+
+def percentile(values, ratio):
+    return values[min(int(len(values) * ratio), len(values) - 1)] if values else 0.0
+
+def generate(server, queries, concurrency, domains, timeout):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+
+    # the queries differ only by their names, so each one is rendered once and patched with a message id
+    packets = [dns.message.make_query("host%d.bench" % i, dns.rdatatype.A).to_wire()[2:] for i in range(domains)]
+
+    inflight = {}
+    latencies = []
+    errors = 0
+    timeouts = 0
+    sent = 0
+    qid = 0
+
+    started = time.time()
+
+    while sent < queries or inflight:
+        while sent < queries and len(inflight) < concurrency:
+            qid = (qid + 1) & 0xffff
+
+            while qid in inflight:
+                qid = (qid + 1) & 0xffff
+
+            sock.sendto(struct.pack(">H", qid) + random.choice(packets), server)
+
+            inflight[qid] = time.time()
+            sent += 1
+
+        readable, _, _ = select.select([sock], [], [], 0.1)
+
+        now = time.time()
+
+        if readable:
+            packet = sock.recv(65535)
+            qid = struct.unpack(">H", packet[:2])[0]
+            start = inflight.pop(qid, None)
+
+            if start is not None:
+                latencies.append(now - start)
+
+                if ord(packet[3]) & 0x0f:
+                    errors += 1
+
+        for expired in [qid for qid, start in inflight.items() if now - start > timeout]:
+            del inflight[expired]
+
+            timeouts += 1
+
+    elapsed = time.time() - started
+
+    latencies.sort()
+
+    return {
+        'queries': queries,
+        'elapsed': elapsed,
+        'qps': queries / elapsed,
+        'p50': percentile(latencies, 0.5),
+        'p99': percentile(latencies, 0.99),
+        'errors': errors,
+        'timeouts': timeouts,
+    }
+
+if __name__=='__main__':
+    opts, args = parse_cmdline()
+
+    logging.basicConfig(level=opts.log_level,
+                        format='%(asctime)s %(levelname)s %(message)s')
+
+    result = generate((opts.server, opts.port), opts.queries, opts.concurrency, opts.domains, opts.timeout)
+
+    print "%(queries)d queries in %(elapsed).3f seconds, %(qps).1f qps, p50 %(p50).4fs, p99 %(p99).4fs, " \
+          "%(errors)d errors, %(timeouts)d timeouts" % result
@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+#
+# A local stand-in DNS server for the benchmarks, which answers the A queries
+# under the bench zone with a synthesized address after a configurable latency,
+# over UDP and optionally TCP, and can lose or truncate a share of the UDP responses
+#
+from __future__ import with_statement
+
+import sys
+import time
+import heapq
+import random
+import socket
+import select
+import struct
+import logging
+import threading
+
+import dns.rcode
+import dns.flags
+import dns.rrset
+import dns.message
+import dns.rdatatype
+
+class Responder(threading.Thread):
+    logger = logging.getLogger("bench.responder")
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, reuse_port=False,
+                 tcp=False, loss=0.0, truncate=0.0, zone=0):
+        threading.Thread.__init__(self, name="bench.responder")
+
+        self.latency = latency
+        self.loss = loss
+        self.truncate = truncate
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+
+        if reuse_port:
+            # let several responder processes share the port, the kernel spreads the clients over them
+            self.sock.setsockopt(socket.SOL_SOCKET, getattr(socket, 'SO_REUSEPORT', 15), 1)
+
+        self.sock.bind((host, port))
+        self.host, self.port = self.sock.getsockname()
+
+        self.listener = None
+
+        if tcp:
+            self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.listener.bind((self.host, self.port))
+            self.listener.listen(64)
+
+        # a zone of `zone` names host0.bench, host1.bench ..., the other names do not exist,
+        # or every name exists when the zone size is 0
+        self.zone = set(["host%d.bench." % i for i in range(zone)]) if zone else None
+
+        self.terminated = threading.Event()
+        self.delayed = []
+        self.clients = {}
+        self.received = 0
+        self.dropped = 0
+        self.truncated = 0
+
+        self.setDaemon(True)
+        self.start()
+
+    def terminate(self):
+        self.terminated.set()
+        self.join()
+        self.sock.close()
+
+        if self.listener is not None:
+            self.listener.close()
+
+        for conn in self.clients.keys():
+            conn.close()
+
+    def respond(self, request, tcp=False):
+        response = dns.message.make_response(request)
+        question = request.question[0]
+
+        if self.zone is not None and question.name.to_text().lower() not in self.zone:
+            response.set_rcode(dns.rcode.NXDOMAIN)
+        elif not tcp and self.truncate and random.random() < self.truncate:
+            response.flags |= dns.flags.TC
+
+            self.truncated += 1
+        elif question.rdtype == dns.rdatatype.A:
+            address = "10.%d.%d.%d" % ((hash(question.name) >> 16) & 0xff,
+                                        (hash(question.name) >> 8) & 0xff,
+                                        hash(question.name) & 0xff)
+
+            response.answer.append(dns.rrset.from_text(question.name, 300, 'IN', 'A', address))
+
+        return response.to_wire(max_size=65535) if tcp else response.to_wire()
+
+    def handle_query(self, packet, addr, conn=None):
+        self.received += 1
+
+        if conn is None and self.loss and random.random() < self.loss:
+            self.dropped += 1
+
+            return
+
+        try:
+            packet = self.respond(dns.message.from_wire(packet), conn is not None)
+        except Exception, e:
+            self.logger.warn("drop invalid request from %s:%d, %s", addr[0], addr[1], e)
+
+            return
+
+        heapq.heappush(self.delayed, (time.time() + self.latency, packet, addr, conn))
+
+    def handle_client(self, conn):
+        try:
+            data = conn.recv(65535)
+        except socket.error:
+            data = ''
+
+        if not data:
+            conn.close()
+
+            del self.clients[conn]
+
+            return
+
+        buf = self.clients[conn] + data
+
+        while len(buf) >= 2 and len(buf) >= struct.unpack(">H", buf[:2])[0] + 2:
+            size = struct.unpack(">H", buf[:2])[0]
+
+            self.handle_query(buf[2:size+2], conn.getpeername(), conn)
+
+            buf = buf[size+2:]
+
+        self.clients[conn] = buf
+
+    def run(self):
+        while not self.terminated.isSet():
+            timeout = 0.1
+
+            if self.delayed:
+                timeout = max(0, min(timeout, self.delayed[0][0] - time.time()))
+
+            socks = [self.sock] + self.clients.keys()
+
+            if self.listener is not None:
+                socks.append(self.listener)
+
+            readable, _, _ = select.select(socks, [], [], timeout)
+
+            for sock in readable:
+                if sock is self.sock:
+                    packet, addr = self.sock.recvfrom(65535)
+
+                    self.handle_query(packet, addr)
+                elif sock is self.listener:
+                    conn, addr = self.listener.accept()
+
+                    self.clients[conn] = ''
+                else:
+                    self.handle_client(sock)
+
+            now = time.time()
+
+            while self.delayed and self.delayed[0][0] <= now:
+                _, packet, addr, conn = heapq.heappop(self.delayed)
+
+                try:
+                    if conn is None:
+                        self.sock.sendto(packet, addr)
+                    else:
+                        conn.sendall(struct.pack(">H", len(packet)) + packet)
+                except socket.error, e:
+                    self.logger.warn("fail to respond to %s:%d, %s", addr[0], addr[1], e)
+
+def parse_cmdline():
+    from optparse import OptionParser
+
+    parser = OptionParser(usage="usage: %prog [options] [port]")
+
+    parser.add_option("-p", "--port", default=5353, type="int",
+                      metavar="PORT", help="Port to listen on (default: %default)")
+    parser.add_option("-l", "--latency", default=0.0, type="float",
+                      metavar="SECS", help="Latency of the responses (default: %default)")
+    parser.add_option("--loss", default=0.0, type="float",
+                      metavar="RATIO", help="Share of the UDP queries left unanswered (default: %default)")
+    parser.add_option("--truncate", default=0.0, type="float",
+                      metavar="RATIO", help="Share of the UDP responses truncated (default: %default)")
+    parser.add_option("-z", "--zone", default=0, type="int",
+                      metavar="NUM", help="Number of names in the zone, 0 for any name (default: %default)")
+    parser.add_option("--tcp", action="store_true", default=False,
+                      help="Answer over TCP too")
+    parser.add_option("-v", "--verbose", action="store_const",
+                      const=logging.DEBUG, dest="log_level", default=logging.WARN)
+
+    return parser.parse_args()
+
+if __name__=='__main__':
+    opts, args = parse_cmdline()
+
+    logging.basicConfig(level=opts.log_level,
+                        format='%(asctime)s %(levelname)s %(message)s')
+
+    responder = Responder(port=int(args[0]) if args else opts.port, latency=opts.latency,
+                          tcp=opts.tcp, loss=opts.loss, truncate=opts.truncate, zone=opts.zone)
+
+    print "INFO: listening on %s:%d" % (responder.host, responder.port)
+
+    responder.join()
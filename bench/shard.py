@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+#
+# Measure how the ShardedResolver scales with the number of worker processes
+#
+from __future__ import with_statement
+
+import sys
+import os.path
+import time
+import logging
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import asyncdns
+
+from responder import Responder
+
+def parse_cmdline():
+    from optparse import OptionParser
+
+    parser = OptionParser(usage="usage: %prog [options]")
+
+    parser.add_option("-n", "--queries", default=20000, type="int",
+                      metavar="NUM", help="Number of queries to send (default: %default)")
+    parser.add_option("-c", "--concurrency", default=500, type="int",
+                      metavar="NUM", help="Number of queries in flight (default: %default)")
+    parser.add_option("-s", "--shards", default=multiprocessing.cpu_count(), type="int",
+                      metavar="NUM", help="Maximum number of shards (default: %default)")
+    parser.add_option("-p", "--port", default=5454, type="int",
+                      metavar="PORT", help="Port of the stand-in servers (default: %default)")
+    parser.add_option("-l", "--latency", default=0.0, type="float",
+                      metavar="SECS", help="Latency of the stand-in servers (default: %default)")
+    parser.add_option("-v", "--verbose", action="store_const",
+                      const=logging.INFO, dest="log_level", default=logging.WARN)
+
+    return parser.parse_args()
+
+def serve(port, latency):
+    Responder(port=port, latency=latency, reuse_port=True).join()
+
+if __name__=='__main__':
+    opts, args = parse_cmdline()
+
+    logging.basicConfig(level=opts.log_level,
+                        format='%(asctime)s %(levelname)s %(message)s')
+
+    # one stand-in server process per shard, sharing the port, so the servers are not the bottleneck
+    responders = [multiprocessing.Process(target=serve, args=(opts.port, opts.latency)) for i in range(opts.shards)]
+
+    for responder in responders:
+        responder.daemon = True
+        responder.start()
+
+    time.sleep(0.5)
+
+    shards = 1
+    baseline = None
+
+    while shards <= opts.shards:
+        resolver = asyncdns.ShardedResolver(shards)
+
+        domains = ("shard%d-%d.bench" % (shards, i) for i in range(opts.queries))
+        finished = 0
+
+        start = time.time()
+
+        for domain, results in resolver.lookup_many(domains, expired=5, concurrency=opts.concurrency,
+                                                    nameservers=['127.0.0.1'], port=opts.port):
+            finished += 1
+
+        elapsed = time.time() - start
+        qps = finished / elapsed
+
+        if baseline is None:
+            baseline = qps
+
+        print "%2d shards %d queries in %.3f seconds, %.1f qps, %.2fx" % (shards, finished, elapsed, qps, qps / baseline)
+
+        resolver.close()
+
+        shards *= 2
+
+    for responder in responders:
+        responder.terminate()
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+#
+# Measure the cost of relaying the queries through a socks 5 proxy,
+# the per packet encapsulation and the end to end rate versus direct UDP
+#
+from __future__ import with_statement
+
+import sys
+import os.path
+import time
+import socket
+import select
+import struct
+import logging
+import threading
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import dns.message
+
+import asyncdns
+from asyncdns.proxy import SocksProtocol
+
+from responder import Responder
+
+def parse_cmdline():
+    from optparse import OptionParser
+
+    parser = OptionParser(usage="usage: %prog [options]")
+
+    parser.add_option("-n", "--queries", default=5000, type="int",
+                      metavar="NUM", help="Number of queries to send (default: %default)")
+    parser.add_option("-c", "--concurrency", default=100, type="int",
+                      metavar="NUM", help="Number of queries in flight (default: %default)")
+    parser.add_option("-p", "--packets", default=200000, type="int",
+                      metavar="NUM", help="Number of packets to encapsulate (default: %default)")
+    parser.add_option("-l", "--latency", default=0.0, type="float",
+                      metavar="SECS", help="Latency of the stand-in server (default: %default)")
+    parser.add_option("-v", "--verbose", action="store_const",
+                      const=logging.INFO, dest="log_level", default=logging.WARN)
+
+    return parser.parse_args()
+
+def serve_proxy(ports):
+    """
+    a minimal socks 5 proxy without authentication, which relays the UDP datagrams of its associations
+    """
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(5)
+
+    relay = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    relay.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+    relay.bind(('127.0.0.1', 0))
+
+    ports.put(listener.getsockname()[1])
+
+    proto = SocksProtocol(None)
+    controls = []
+    client = None
+    targets = set()
+
+    while True:
+        readable, _, _ = select.select([listener, relay] + controls, [], [])
+
+        for sock in readable:
+            if sock is listener:
+                conn, addr = listener.accept()
+
+                negotiation = SocksProtocol(conn)
+                negotiation.recvall(ord(negotiation.recvall(2)[1]))
+                conn.sendall("\x05\x00")
+                negotiation.recvall(4 + 4 + 2)
+                conn.sendall("\x05\x00\x00\x01" + socket.inet_aton('127.0.0.1') + struct.pack(">H", relay.getsockname()[1]))
+
+                controls.append(conn)
+            elif sock is relay:
+                packet, addr = relay.recvfrom(65535)
+
+                if addr in targets:
+                    relay.sendto(proto.make_packet(addr[0], addr[1], packet), client)
+                else:
+                    client = addr
+
+                    host, port, data = proto.parse_packet(packet)
+
+                    targets.add((host, port))
+                    relay.sendto(data, (host, port))
+            elif not sock.recv(1):
+                controls.remove(sock)
+
+def bench_packets(count):
+    proto = SocksProtocol(None)
+    payload = dns.message.make_query('www.example.com', 'A').to_wire()
+
+    start = time.time()
+
+    for i in xrange(count):
+        proto.make_packet('127.0.0.1', 53, payload)
+
+    encapsulated = time.time() - start
+
+    buf = bytearray(proto.make_packet('127.0.0.1', 53, payload))
+    view = memoryview(buf)
+    size = len(buf)
+
+    start = time.time()
+
+    for i in xrange(count):
+        host, port, offset = proto.unpack_header(view[:size])
+        view[offset:size].tobytes()
+
+    decapsulated = time.time() - start
+
+    print "encapsulate %.3f us/packet, decapsulate %.3f us/packet" % (encapsulated * 1000000 / count,
+                                                                     decapsulated * 1000000 / count)
+
+def bench_queries(pipeline, domains, concurrency, nameservers, port):
+    window = threading.Semaphore(concurrency)
+    futures = []
+
+    for domain in domains:
+        window.acquire()
+
+        future = pipeline.query_async(domain, expired=5, nameservers=nameservers, port=port)
+        future.add_done_callback(lambda future: window.release())
+
+        futures.append(future)
+
+    return len([future for future in futures if future.wait() and future.error is None])
+
+if __name__=='__main__':
+    opts, args = parse_cmdline()
+
+    logging.basicConfig(level=opts.log_level,
+                        format='%(asctime)s %(levelname)s %(message)s')
+
+    bench_packets(opts.packets)
+
+    # the proxy runs in its own process, so its relaying does not compete with the pipeline for the GIL
+    ports = multiprocessing.Queue()
+    proxy = multiprocessing.Process(target=serve_proxy, args=(ports,))
+    proxy.daemon = True
+    proxy.start()
+
+    proxy_port = ports.get()
+
+    responder = Responder(latency=opts.latency)
+    wheel = asyncdns.TimeWheel()
+
+    for name, proxies in [('direct', None), ('socks', asyncdns.SocksProxy('127.0.0.1', proxy_port))]:
+        pipeline = asyncdns.Pipeline(wheel, proxies)
+
+        domains = ["%s%d.bench" % (name, i) for i in range(opts.queries)]
+
+        start = time.time()
+
+        answered = bench_queries(pipeline, domains, opts.concurrency, [responder.host], responder.port)
+
+        elapsed = time.time() - start
+
+        print "%-8s %d/%d queries in %.3f seconds, %.1f qps" % (name, answered, opts.queries, elapsed, answered / elapsed)
+
+        pipeline.close()
+
+    wheel.terminate()
+    responder.terminate()
+    proxy.terminate()
@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+#
+# Drive the Pipeline, the Resolver and the TimeWheel at increasing concurrency
+# against a local stand-in server, and report the rate, the latency percentiles,
+# the CPU time per query and the memory as JSON, to compare the releases:
+#
+#   python bench/suite.py -c 1,10,100,1000 --loss 0.01 -o results.json
+#
+from __future__ import with_statement
+
+import sys
+import os
+import os.path
+import time
+import json
+import platform
+import logging
+import threading
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import dns.rdatatype
+import dns.rdataclass
+
+import asyncdns
+
+from responder import Responder
+
+logger = logging.getLogger("bench.suite")
+
+def parse_cmdline():
+    from optparse import OptionParser
+
+    parser = OptionParser(usage="usage: %prog [options]")
+
+    parser.add_option("-n", "--queries", default=5000, type="int",
+                      metavar="NUM", help="Number of queries per run (default: %default)")
+    parser.add_option("-c", "--concurrency", default="1,10,100,1000",
+                      metavar="LIST", help="Comma separated concurrency levels (default: %default)")
+    parser.add_option("-b", "--bench", default="pipeline,resolver,timewheel",
+                      metavar="LIST", help="Comma separated benchmarks to run (default: %default)")
+    parser.add_option("-t", "--timeout", default=2, type="int",
+                      metavar="SECS", help="Timeout of a query (default: %default)")
+    parser.add_option("-l", "--latency", default=0.0, type="float",
+                      metavar="SECS", help="Latency of the stand-in server (default: %default)")
+    parser.add_option("--loss", default=0.0, type="float",
+                      metavar="RATIO", help="Share of the queries the stand-in server loses (default: %default)")
+    parser.add_option("--truncate", default=0.0, type="float",
+                      metavar="RATIO", help="Share of the responses truncated, retried over TCP (default: %default)")
+    parser.add_option("-z", "--zone", default=0, type="int",
+                      metavar="NUM", help="Number of names in the zone, 0 for any name (default: %default)")
+    parser.add_option("--in-process", action="store_true", default=False,
+                      help="Run the stand-in server in a thread, its CPU time is then counted too")
+    parser.add_option("-o", "--output", default=None,
+                      metavar="FILE", help="Write the JSON results to the file (default: stdout)")
+    parser.add_option("-v", "--verbose", action="store_const",
+                      const=logging.INFO, dest="log_level", default=logging.WARN)
+
+    return parser.parse_args()
+
+def percentile(values, ratio):
+    return values[min(int(len(values) * ratio), len(values) - 1)] if values else 0.0
+
+def rss():
+    """
+    return the resident set size of the process in KB
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+
+    import resource
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def serve(ports, options):
+    responder = Responder(**options)
+
+    ports.put(responder.port)
+
+    responder.join()
+
+def measure(name, concurrency, queries, run):
+    cpu = sum(os.times()[:2])
+    start = time.time()
+
+    latencies, errors = run()
+
+    elapsed = time.time() - start
+    cpu = sum(os.times()[:2]) - cpu
+
+    latencies.sort()
+
+    return {
+        'bench': name,
+        'concurrency': concurrency,
+        'queries': queries,
+        'elapsed': elapsed,
+        'qps': queries / elapsed,
+        'p50': percentile(latencies, 0.5),
+        'p99': percentile(latencies, 0.99),
+        'errors': errors,
+        'cpu_per_query': cpu / queries,
+        'rss_kb': rss(),
+    }
+
+def drive(submit, domains, concurrency):
+    """
+    keep `concurrency` queries in flight, return their latencies and the number of the failed ones
+    """
+    window = threading.Semaphore(concurrency)
+    lock = threading.Lock()
+    latencies = []
+    failed = [0]
+
+    for domain in domains:
+        window.acquire()
+
+        def onfinish(future, start=time.time()):
+            with lock:
+                if future.error is not None:
+                    failed[0] += 1
+                else:
+                    latencies.append(time.time() - start)
+
+            window.release()
+
+        submit(domain).add_done_callback(onfinish)
+
+    for i in range(concurrency):
+        window.acquire()
+
+    return latencies, failed[0]
+
+def bench_pipeline(wheel, server, concurrency, queries, timeout):
+    pipeline = asyncdns.Pipeline(wheel)
+
+    try:
+        return drive(lambda domain: pipeline.query_async(domain, expired=timeout, nameservers=[server[0]], port=server[1]),
+                     ["host%d.bench" % i for i in range(queries)], concurrency)
+    finally:
+        pipeline.close()
+
+def bench_resolver(wheel, server, concurrency, queries, timeout):
+    resolver = asyncdns.Resolver(wheel)
+
+    try:
+        return drive(lambda domain: resolver.lookup_async(domain, dns.rdatatype.A, dns.rdataclass.IN, timeout,
+                                                          [server[0]], server[1]),
+                     ["host%d.bench" % i for i in range(queries)], concurrency)
+    finally:
+        resolver.close()
+
+def bench_timewheel(wheel, server, concurrency, queries, timeout):
+    """
+    arm and cancel the timers with `concurrency` of them outstanding, like the timeouts of the queries in flight
+    """
+    latencies = []
+    timers = []
+
+    for i in range(queries):
+        start = time.time()
+
+        timers.append(wheel.create(lambda: None, timeout))
+
+        if len(timers) >= concurrency:
+            timers.pop(0).cancel()
+
+        latencies.append(time.time() - start)
+
+    for timer in timers:
+        timer.cancel()
+
+    return latencies, 0
+
+BENCHES = {
+    'pipeline': bench_pipeline,
+    'resolver': bench_resolver,
+    'timewheel': bench_timewheel,
+}
+
+def version():
+    try:
+        import pkg_resources
+
+        return pkg_resources.get_distribution('asyncdns').version
+    except Exception:
+        return None
+
+if __name__=='__main__':
+    opts, args = parse_cmdline()
+
+    logging.basicConfig(level=logging.WARN,
+                        format='%(asctime)s %(levelname)s %(message)s')
+
+    logger.setLevel(opts.log_level)
+
+    options = {'latency': opts.latency, 'tcp': True, 'loss': opts.loss, 'truncate': opts.truncate, 'zone': opts.zone}
+
+    if opts.in_process:
+        responder = Responder(**options)
+        server = (responder.host, responder.port)
+    else:
+        # the stand-in server runs in its own process, so its CPU time is not counted for the queries
+        ports = multiprocessing.Queue()
+        responder = multiprocessing.Process(target=serve, args=(ports, options))
+        responder.daemon = True
+        responder.start()
+
+        server = ('127.0.0.1', ports.get())
+
+    wheel = asyncdns.TimeWheel()
+    results = []
+
+    for name in opts.bench.split(','):
+        for concurrency in [int(level) for level in opts.concurrency.split(',')]:
+            result = measure(name, concurrency, opts.queries,
+                             lambda: BENCHES[name](wheel, server, concurrency, opts.queries, opts.timeout))
+
+            logger.info("%(bench)s x %(concurrency)d: %(qps).1f qps, p50 %(p50).4fs, p99 %(p99).4fs", result)
+
+            results.append(result)
+
+    wheel.terminate()
+    responder.terminate()
+
+    report = json.dumps({
+        'asyncdns': version(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': multiprocessing.cpu_count(),
+        'time': time.time(),
+        'options': dict(options, queries=opts.queries, timeout=opts.timeout, in_process=opts.in_process),
+        'results': results,
+    }, indent=2, sort_keys=True)
+
+    if opts.output:
+        with open(opts.output, 'w') as f:
+            f.write(report)
+    else:
+        print report
@@ -86,6 +86,7 @@ class Updater(object):
     logger = logging.getLogger("updater")
 
     def __init__(self, max_currency=20):
+        self.concurrency = max_currency
         self.lock = threading.Semaphore(max_currency)
 
     def connect(self, host, port, dbname):
@@ -196,7 +197,8 @@ class Updater(object):
 
     def run(self, resolver, nameservers, timeout):
         self.queryLocalNameserver(resolver, nameservers, timeout)
-        #self.queryAuthoritativeNameserver(resolver, timeout)
+        #self.queryAuthoritativeNameservers(resolver, timeout)
+        #self.walkDelegations(resolver, timeout)
 
     def queryLocalNameserver(self, resolver, nameservers, timeout):
         cursor = self.db.domains.find({
@@ -213,39 +215,45 @@ class Updater(object):
         if nameservers is None:
             nameservers = DEFAULT_DNS_SERVERS
 
-        latch = asyncdns.CountDownLatch(cursor.count()*len(nameservers))
-
-        def onfinish(nameserver, domain, results):
-            self.lock.release()
+        domains = (record['domain'] for record in cursor)
 
+        for domain, results in resolver.lookup_many(domains, [dns.rdatatype.ANY], expired=timeout,
+                                                    concurrency=self.concurrency, nameservers=nameservers):
             self.update(results)
 
-            latch.countDown()
+    def queryAuthoritativeNameservers(self, resolver, timeout):
+        cursor = self.db.domains.find({
+            'domain': {'$exists': True},
+            'ns': {'$exists': False},
+        })
 
-        for record in cursor:
-            self.lock.acquire()
+        self.logger.info("query %d domain from the authoritative nameservers", cursor.count())
 
-            try:
-                resolver.lookupAllRecords(record['domain'], expired=timeout,
-                                          callback=onfinish, nameservers=nameservers)
-            except Exception, e:
-                self.logger.warn("fail to query domain: %s, %s", record['domain'], e)
+        domains = (record['domain'] for record in cursor)
 
-        latch.await()
+        for domain, results in resolver.lookup_many(domains, [dns.rdatatype.NS], expired=timeout,
+                                                    concurrency=self.concurrency, iterative=True):
+            self.update(results)
 
-    def queryAuthoritativeNameservers(self, resolver, timeout):
-        self.logger.info("query")
+        self.logger.info("delegation cache: %s", resolver.delegations.stats())
 
+    def walkDelegations(self, resolver, timeout):
+        """
+        walk the delegations with a scene per domain, keeping the zone cuts in mongodb instead of the delegation cache
+        """
         cursor = self.db.domains.find({
             'domain': {'$exists': True},
             'ns': {'$exists': False},
         })
 
-        self.logger.info("query %d domain from the authoritative nameservers", cursor.count())
+        self.logger.info("walk the delegations of %d domain", cursor.count())
 
         latch = asyncdns.CountDownLatch(cursor.count())
 
-        def onfinish():
+        def onfinish(result):
+            if isinstance(result, Exception):
+                self.logger.warn("fail to walk the delegations, %s", result)
+
             self.lock.release()
 
             latch.countDown()
@@ -254,15 +262,18 @@ class Updater(object):
             self.lock.acquire()
 
             try:
-                resolver.lookupScene(self.queryAuthoritativeNameserver(record['domain']),
-                                     callback=onfinish)
+                resolver.lookupScene(self.walkDelegation(record['domain']),
+                                     callback=onfinish, expired=timeout)
             except Exception, e:
                 self.logger.warn("fail to query domain: %s, %s", record['domain'], e)
 
+                self.lock.release()
+                latch.countDown()
+
         latch.await()
 
     @asyncdns.Scene()
-    def queryAuthoritativeNameserver(self, domain):
+    def walkDelegation(self, domain):
         qname = dns.name.from_text(domain)
 
         domains = ['.'.join(qname[i:]) for i in range(len(qname))]
@@ -273,15 +284,15 @@ class Updater(object):
             domain = domains.pop()
             domain = '.' if domain == '' else domain.strip('.')
 
-            record = self.db.domains.find({'domain': domain}, ['ns'])
+            record = self.db.domains.find_one({'domain': domain}, ['ns'])
 
             if record is None:
-                nameserver, results = yield async.scene.Query(domain, dns.rdatatype.NS,
-                                                              nameservers=nameservers)
+                nameserver, results = yield asyncdns.Query(domain, dns.rdatatype.NS,
+                                                           nameservers=nameservers)
 
                 record = {
                     'domain': domain,
-                    'ns' : results[domain][dns.rdatatype.NS]
+                    'ns' : results[domain]['NS']
                 }
 
                 record['_id'] = self.db.domains.insert(record)
@@ -289,7 +300,7 @@ class Updater(object):
             nameservers = record['ns']
             nameservers = nameservers[:min(3, len(nameservers))]
 
-        yield async.scene.Finished
+        yield asyncdns.Finished
 
     DNS_FIELDNAME_MAPPING = {
         'A': 'ip',
@@ -4,18 +4,307 @@ from __future__ import with_statement
 import threading
 import logging
 import unittest
+import socket
+import struct
 
+import os
 import time
+import shutil
+import asyncore
+import tempfile
 import datetime
 
 import dns.rcode
 import dns.opcode
+import dns.flags
+import dns.rrset
+import dns.message
 
 from asyncdns.timewheel import *
 from asyncdns.pipeline import *
 from asyncdns.proxy import *
 from asyncdns.utils import *
 from asyncdns.scene import *
+from asyncdns.names import *
+from asyncdns.executor import *
+from asyncdns.cache import *
+from asyncdns.resolver import *
+from asyncdns.shard import *
+from asyncdns.snapshot import *
+from asyncdns.server import *
+from asyncdns.stream import *
+from asyncdns.trace import *
+from asyncdns.metrics import *
+from asyncdns.profiler import *
+
+class LocalNameserver(threading.Thread):
+    def __init__(self, zone, host='127.0.0.1', port=0):
+        threading.Thread.__init__(self, name="tests.nameserver")
+
+        self.zone = zone
+        self.sock = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((host, port))
+        self.host, self.port = self.sock.getsockname()[:2]
+        self.requests = []
+        self.truncate = False
+        self.edns = True
+        self.ttl = 300
+        self.delay = 0
+
+        self.setDaemon(True)
+        self.start()
+
+    def close(self):
+        self.sock.close()
+
+    def respond(self, request):
+        response = dns.message.make_response(request)
+        question = request.question[0]
+
+        addresses = self.zone.get(question.name.to_text(True))
+
+        if addresses is None:
+            response.set_rcode(dns.rcode.NXDOMAIN)
+        elif question.rdtype == dns.rdatatype.A:
+            response.answer.append(dns.rrset.from_text(question.name, self.ttl, 'IN', 'A', *addresses))
+
+        return response
+
+    def run(self):
+        while True:
+            try:
+                packet, addr = self.sock.recvfrom(65535)
+            except socket.error:
+                break
+
+            request = dns.message.from_wire(packet)
+
+            self.requests.append(request)
+
+            if request.edns >= 0 and not self.edns:
+                response = dns.message.make_response(request)
+                response.use_edns(False)
+                response.set_rcode(dns.rcode.FORMERR)
+            else:
+                response = self.respond(request)
+
+            if self.truncate:
+                response.flags |= dns.flags.TC
+                response.answer = []
+
+            if self.delay:
+                time.sleep(self.delay)
+
+            try:
+                self.sock.sendto(response.to_wire(), addr)
+            except socket.error:
+                break
+
+class LocalTcpNameserver(threading.Thread):
+    def __init__(self, nameserver):
+        threading.Thread.__init__(self, name="tests.tcp")
+
+        self.nameserver = nameserver
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((nameserver.host, nameserver.port))
+        self.sock.listen(5)
+        self.accepted = 0
+        self.requests = []
+
+        self.setDaemon(True)
+        self.start()
+
+    def close(self):
+        self.sock.close()
+
+    def serve(self, conn):
+        buf = ''
+
+        while True:
+            data = conn.recv(65535)
+
+            if not data:
+                break
+
+            buf += data
+            requests = []
+
+            while len(buf) >= 2 and len(buf) >= struct.unpack(">H", buf[:2])[0] + 2:
+                size = struct.unpack(">H", buf[:2])[0]
+                requests.append(dns.message.from_wire(buf[2:size+2]))
+                buf = buf[size+2:]
+
+            self.requests.extend(requests)
+
+            for request in reversed(requests):
+                packet = self.nameserver.respond(request).to_wire(max_size=65535)
+
+                conn.sendall(struct.pack(">H", len(packet)) + packet)
+
+        conn.close()
+
+    def run(self):
+        while True:
+            try:
+                conn, addr = self.sock.accept()
+            except socket.error:
+                break
+
+            self.accepted += 1
+
+            threading.Thread(target=self.serve, args=(conn,)).start()
+
+class LocalAuthority(LocalNameserver):
+    def __init__(self, records, referrals, host, port=0, chase=True):
+        self.records = records
+        self.referrals = referrals
+        self.chase = chase
+
+        LocalNameserver.__init__(self, {}, host, port)
+
+    def respond(self, request):
+        response = dns.message.make_response(request)
+        question = request.question[0]
+
+        for zone, nameservers in self.referrals.items():
+            if question.name.is_subdomain(dns.name.from_text(zone)):
+                response.authority.append(dns.rrset.from_text(zone, 3600, 'IN', 'NS', *nameservers.keys()))
+
+                for nameserver, address in nameservers.items():
+                    if address:
+                        response.additional.append(dns.rrset.from_text(nameserver, 3600, 'IN', 'A', address))
+
+                return response
+
+        name = question.name
+        rdtype = dns.rdatatype.to_text(question.rdtype)
+        records = self.records.get(name.to_text())
+
+        if records is None:
+            response.set_rcode(dns.rcode.NXDOMAIN)
+
+        while records:
+            if rdtype in records:
+                response.answer.append(dns.rrset.from_text(name, 300, 'IN', rdtype, *records[rdtype]))
+            elif 'CNAME' in records:
+                response.answer.append(dns.rrset.from_text(name, 300, 'IN', 'CNAME', *records['CNAME']))
+
+                if self.chase and len(response.answer) < 8:
+                    name = dns.name.from_text(records['CNAME'][0])
+                    records = self.records.get(name.to_text())
+
+                    continue
+
+            break
+
+        return response
+
+class LocalSocksProxy(threading.Thread):
+    def __init__(self, username='', passwd='', delay=0):
+        threading.Thread.__init__(self, name="tests.socks")
+
+        self.username = username
+        self.passwd = passwd
+        self.delay = delay
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(5)
+        self.host, self.port = self.sock.getsockname()
+        self.relay = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.relay.bind(('127.0.0.1', 0))
+        self.proto = SocksProtocol(None)
+        self.conns = []
+        self.associations = 0
+        self.client = None
+        self.targets = set()
+
+        forwarder = threading.Thread(target=self.forward, name="tests.socks")
+        forwarder.setDaemon(True)
+        forwarder.start()
+
+        self.setDaemon(True)
+        self.start()
+
+    def close(self):
+        self.sock.close()
+        self.relay.close()
+        self.drop()
+
+    def drop(self):
+        for conn in self.conns:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    def serve(self, conn):
+        proto = SocksProtocol(conn)
+
+        try:
+            version, nmethods = struct.unpack("2B", proto.recvall(2))
+            proto.recvall(nmethods)
+
+            if self.username:
+                conn.sendall("\x05\x02")
+
+                version, size = struct.unpack("2B", proto.recvall(2))
+                username = proto.recvall(size)
+                passwd = proto.recvall(ord(proto.recvall(1)))
+
+                if (username, passwd) != (self.username, self.passwd):
+                    conn.sendall("\x01\x01")
+
+                    return
+
+                conn.sendall("\x01\x00")
+            else:
+                conn.sendall("\x05\x00")
+
+            proto.recvall(4 + 4 + 2)
+
+            time.sleep(self.delay)
+
+            self.associations += 1
+
+            conn.sendall("\x05\x00\x00\x01" + socket.inet_aton('0.0.0.0') + struct.pack(">H", self.relay.getsockname()[1]))
+
+            # the association lasts as long as the control connection
+            conn.recv(1)
+        except (socket.error, SocksProtocolError):
+            pass
+        finally:
+            conn.close()
+
+    def forward(self):
+        while True:
+            try:
+                packet, addr = self.relay.recvfrom(65535)
+
+                if addr in self.targets:
+                    self.relay.sendto(self.proto.make_packet(addr[0], addr[1], packet), self.client)
+                else:
+                    self.client = addr
+
+                    host, port, data = self.proto.parse_packet(packet)
+
+                    self.targets.add((host, port))
+                    self.relay.sendto(data, (host, port))
+            except socket.error:
+                break
+
+    def run(self):
+        while True:
+            try:
+                conn, addr = self.sock.accept()
+            except socket.error:
+                break
+
+            self.conns.append(conn)
+
+            serving = threading.Thread(target=self.serve, args=(conn,))
+            serving.setDaemon(True)
+            serving.start()
 
 class TestTimeWheel(unittest.TestCase):
     def testTimer(self):
@@ -108,21 +397,30 @@ class TestTimeWheel(unittest.TestCase):
 
 class TestPipeline(unittest.TestCase):
     def setUp(self):
+        self.nameserver = LocalNameserver({"www.baidu.com": ["10.0.1.1"], "www.google.com": ["10.0.2.1"]})
         self.wheel = TimeWheel()
         self.pipeline = Pipeline(self.wheel)
 
     def tearDown(self):
         self.pipeline.close()
         self.wheel.terminate()
+        self.nameserver.close()
 
     def testLifecycle(self):
         self.assertFalse(self.pipeline.isTerminated())
 
+        # the pipeline polls its own dispatchers only
+        self.assert_(self.pipeline in self.pipeline.map.values())
+        self.assert_(self.pipeline.waker in self.pipeline.map.values())
+        self.assertFalse(self.pipeline in asyncore.socket_map.values())
+
         finished = {}
 
-        system_nameservers = self.pipeline.system_nameservers()
+        nameservers = [self.nameserver.host]
 
-        for nameserver in system_nameservers:
+        self.nameserver.delay = 0.5
+
+        for nameserver in nameservers:
             finished[nameserver] = threading.Event()
 
         def onfinish(nameserver, response):
@@ -131,112 +429,1638 @@ class TestPipeline(unittest.TestCase):
             self.assert_(len(response.answer) > 0)
             finished[nameserver[0]].set()
 
-        self.pipeline.query("www.baidu.com.", callback=onfinish, expired=5)
+        self.pipeline.query("www.baidu.com.", callback=onfinish, expired=5,
+                            nameservers=nameservers, port=self.nameserver.port)
+
+        # the pipeline is woken up to send the query at once
+        time.sleep(0.1)
 
         self.assertEquals(len(finished), len(self.pipeline))
-        self.assertEquals(len(finished), self.pipeline.queued)
-        self.assertEquals(0, self.pipeline.pending)
+        self.assertEquals(0, self.pipeline.queued)
+        self.assertEquals(len(finished), self.pipeline.pending)
 
         [lock.wait(5) for lock in finished.values()]
 
         self.assertEquals(0, len(self.pipeline))
 
-        self.assertEquals(0, len(self.pipeline))
+        self.nameserver.delay = 0
 
-        nameserver, response = self.pipeline.query("www.google.com.", expired=5)
+        nameserver, response = self.pipeline.query("www.google.com.", expired=5,
+                                                   nameservers=nameservers, port=self.nameserver.port)
 
         self.assertEqual(dns.rcode.NOERROR, response.rcode())
         self.assertEqual(dns.opcode.QUERY, response.opcode())
         self.assert_(len(response.answer) > 0)
 
-        self.assert_(len(self.pipeline) < len(system_nameservers))
+        self.assert_(len(self.pipeline) < len(nameservers))
 
-class TestSocksProtocol(unittest.TestCase):
-    class FakeSocks(object):
-        def __init__(self, buf=None):
-            self.buf = buf
-            self.sent = ""
+class TestResolver(unittest.TestCase):
+    def setUp(self):
+        self.nameserver = LocalNameserver(dict([("www.site%d.com" % i, ["10.0.0.%d" % i]) for i in range(10)]))
+        self.wheel = TimeWheel()
+        self.resolver = Resolver(self.wheel, executor=ThreadPoolExecutor())
 
-        def getpeername(self):
-            return ('127.0.0.1', '1234')
+    def tearDown(self):
+        self.resolver.close()
+        self.resolver.executor.shutdown()
+        self.wheel.terminate()
+        self.nameserver.close()
 
-        def recv(self, bytes):
-            data = self.buf[:bytes]
-            self.buf = self.buf[bytes:]
+    def testLookupMany(self):
+        domains = ["www.site%d.com\n" % i for i in range(10)] + ["\n", "www.unknown.com\n"]
 
-            return data
+        results = dict(self.resolver.lookup_many(iter(domains), [dns.rdatatype.A, dns.rdatatype.MX],
+                                                 expired=5, concurrency=4,
+                                                 nameservers=[self.nameserver.host],
+                                                 port=self.nameserver.port))
 
-        def sendall(self, buf):
-            self.sent += buf
+        self.assertEquals(11, len(results))
+        self.assertEquals({"www.site3.com": {"A": ["10.0.0.3"]}}, results["www.site3.com"])
+        self.assertEquals({}, results["www.unknown.com"])
+        self.assertEquals(22, len(self.nameserver.requests))
 
-        def close(self):
-            pass
+    def testLookupManyFailures(self):
+        query = self.resolver.query
+
+        def lossy(qname, rdtype, *args):
+            if str(qname).startswith("www.site1."):
+                return # the callback is lost
+
+            if rdtype == dns.rdatatype.MX:
+                raise ValueError("broken query")
+
+            return query(qname, rdtype, *args)
+
+        self.resolver.query = lossy
+        self.resolver.LOOKUP_MARGIN = 0
+
+        started = time.time()
+
+        results = dict(self.resolver.lookup_many(["www.site%d.com" % i for i in range(4)],
+                                                 [dns.rdatatype.A, dns.rdatatype.MX],
+                                                 expired=1, concurrency=4,
+                                                 nameservers=[self.nameserver.host],
+                                                 port=self.nameserver.port))
+
+        self.assert_(time.time() - started < 3)
+        self.assertEquals(4, len(results))
+        self.assert_(isinstance(results["www.site1.com"], socket.timeout))
+        self.assertEquals({"www.site3.com": {"A": ["10.0.0.3"]}}, results["www.site3.com"])
+        self.assertEquals(3, len(self.nameserver.requests))
+
+    def testLookupAsync(self):
+        future = self.resolver.lookup_async("www.site1.com", dns.rdatatype.A, dns.rdataclass.IN, expired=5,
+                                            nameservers=[self.nameserver.host], port=self.nameserver.port)
+
+        nameserver, results = future.result(5)
+
+        self.assertEquals((self.nameserver.host, self.nameserver.port), nameserver)
+        self.assertEquals({"www.site1.com": {"A": ["10.0.0.1"]}}, results)
+
+        nameserver, response = self.resolver.query("www.site2.com", expired=5,
+                                                   nameservers=[self.nameserver.host], port=self.nameserver.port)
+
+        self.assertEqual(dns.rcode.NOERROR, response.rcode())
+
+    def testLookupScene(self):
+        nameservers = [self.nameserver.host]
+
+        def scene():
+            addresses = []
+
+            for i in range(3):
+                nameserver, results = yield Query("www.site%d.com" % i, nameservers=nameservers,
+                                                  port=self.nameserver.port)
+
+                addresses.extend(results["www.site%d.com" % i]['A'])
+
+            yield Result(addresses)
+
+        finished = []
+
+        future = self.resolver.lookupScene(scene(), callback=finished.append, expired=5)
+
+        self.assertEquals(["10.0.0.0", "10.0.0.1", "10.0.0.2"], future.result(5))
+        self.assertEquals([future.result()], finished)
+
+class TestExecutor(unittest.TestCase):
+    def testInline(self):
+        executor = InlineExecutor()
+        results = []
+
+        executor.submit(results.append, 1)
+        executor.submit(lambda: 1/0)
+
+        self.assertEquals([1], results)
+        self.assertFalse(executor.busy)
+
+        stats = executor.stats()
+
+        self.assertEquals(0, stats['queued'])
+        self.assertEquals(2, stats['submitted'])
+        self.assertEquals(2, stats['completed'])
+
+    def testThreadPool(self):
+        executor = BoundedExecutor(workers=1, maxsize=2)
+        blocked = threading.Event()
+        latch = CountDownLatch(3)
+        woken = []
+
+        executor.watch(lambda: woken.append(executor.queued))
+
+        def callback():
+            blocked.wait(5)
+            latch.countDown()
+
+        for i in range(3):
+            executor.submit(callback)
+
+        time.sleep(0.1)
+
+        self.assert_(executor.busy)
+        self.assertEquals(2, executor.queued)
+
+        self.assertEquals([], woken)
+
+        blocked.set()
+        latch.await()
+
+        self.assertFalse(executor.busy)
+        self.assertEquals([1], woken)
+
+        executor.shutdown()
+
+        stats = executor.stats()
+
+        self.assertEquals(3, stats['completed'])
+        self.assert_(stats['max_wait'] > 0)
+
+class TestUtils(unittest.TestCase):
+    def testLatch(self):
+        latch = CountDownLatch(2)
+
+        self.assertFalse(latch.await(0.01))
+
+        threading.Timer(0.01, latch.countDown).start()
+        threading.Timer(0.02, latch.countDown).start()
+
+        start = time.time()
+
+        self.assert_(latch.await())
+        self.assert_(time.time() - start < 0.5)
+
+    def testResultCollector(self):
+        collector = ResultCollector(2)
 
+        collector.onfinish(('127.0.0.1', 53), 'www.google.com', {'www.google.com': {}})
+
+        self.assertEquals([], collector.streams)
+
+        results = collector.results(0.01)
+
+        self.assertEquals((('127.0.0.1', 53), 'www.google.com', {'www.google.com': {}}), results.next())
+        self.assertRaises(socket.timeout, results.next)
+        self.assertFalse(collector.await(0.01))
+
+        error = socket.timeout()
+
+        collector.onfinish(('127.0.0.1', 53), 'www.baidu.com', error)
+
+        self.assert_(collector.await(0.01))
+        self.assertEquals([(('127.0.0.1', 53), 'www.baidu.com', error)], collector['errors'])
+
+        # every call streams all the results again
+        self.assertEquals(2, len(list(collector.results(0.01))))
+        self.assertEquals(2, len(list(collector.results(0.01))))
+        self.assertEquals([], collector.streams)
+
+    def testBatch(self):
+        futures = [Future() for i in range(3)]
+        batch = Batch(futures)
+
+        self.assertEquals(3, len(batch))
+        self.assertFalse(batch.wait(0.01))
+
+        futures[2].set_result(2)
+        futures[0].set_result(0)
+
+        completed = batch.as_completed(0.1)
+
+        self.assertEquals([futures[2], futures[0]], [completed.next(), completed.next()])
+        self.assertRaises(socket.timeout, completed.next)
+        self.assertFalse(batch.done())
+
+        futures[1].set_exception(ValueError())
+
+        self.assert_(batch.wait())
+        self.assert_(batch.done())
+
+class TestFuture(unittest.TestCase):
+    def testResult(self):
+        future = Future()
+        done = []
+
+        future.add_done_callback(done.append)
+
+        self.assertFalse(future.done())
+        self.assertRaises(socket.timeout, future.result, 0.01)
+
+        self.assert_(future.set_result(1))
+        self.assertFalse(future.set_exception(ValueError()))
+
+        self.assert_(future.done())
+        self.assertEquals(1, future.result())
+        self.assertEquals(None, future.exception())
+        self.assertEquals([future], done)
+
+        future.add_done_callback(done.append)
+
+        self.assertEquals([future, future], done)
+
+    def testException(self):
+        future = Future()
+
+        threading.Timer(0.01, future.set_exception, [socket.timeout("test")]).start()
+
+        self.assertRaises(socket.timeout, future.result, 5)
+        self.assert_(isinstance(future.exception(), socket.timeout))
+
+class TestIterativeResolver(unittest.TestCase):
     def setUp(self):
-        self.proto = SocksProtocol(TestSocksProtocol.FakeSocks())
+        self.root = LocalAuthority({}, {
+            'com.': {'ns.gtld.test.': '127.0.0.3'},
+            'net.': {'ns.gtld.test.': '127.0.0.3'},
+        }, '127.0.0.2')
+        self.gtld = LocalAuthority({}, {
+            'example.com.': {'ns1.dns.net.': None},
+            'dns.net.': {'ns1.dns.net.': '127.0.0.4'},
+        }, '127.0.0.3', self.root.port)
+        self.authority = LocalAuthority({
+            'ns1.dns.net.': {'A': ['127.0.0.4']},
+            'www.example.com.': {'A': ['10.0.0.1']},
+            'mail.example.com.': {'A': ['10.0.0.2'], 'MX': ['10 mx.example.com.']},
+        }, {}, '127.0.0.4', self.root.port)
 
-    def testConnect(self):
-        self.assertEqual(SocksProtocol.VER_SOCKS_5, self.proto.version)
+        self.wheel = TimeWheel()
+        self.resolver = Resolver(self.wheel, delegations=DelegationCache([('root.test.', '127.0.0.2')]))
 
-        self.assertEqual("\x05\x02\x00\x02", self.proto.make_connect())
-        self.assertEqual("\x05\x01\x02", self.proto.make_connect([SocksProtocol.METHOD_SIMPLE]))
-        self.assertEqual("\x05\x01\x00", self.proto.make_connect([]))
+    def tearDown(self):
+        self.resolver.close()
+        self.wheel.terminate()
 
-        self.proto.sock.buf = "\x05\x00"
-        self.assertEqual(SocksProtocol.METHOD_NO_AUTH, self.proto.parse_connect())
+        for server in [self.root, self.gtld, self.authority]:
+            server.close()
 
-        self.proto.sock.buf = "\x04\x02"
-        self.assertRaises(InvalidSocksVersion, self.proto.parse_connect)
+    def testDelegationCache(self):
+        cache = DelegationCache([('root.test.', '127.0.0.2')])
 
-        self.proto.sock.buf = "\x05\xff"
-        self.assertRaises(NoAcceptableAuthMethod, self.proto.parse_connect)
+        self.assertEquals((dns.name.root, [dns.name.from_text('root.test.')], ['127.0.0.2']),
+                          cache.find(dns.name.from_text('www.example.com.')))
 
-        self.proto.sock.buf = "\x05\x00"
-        self.assert_(self.proto.connect())
+        cache.add_zone(dns.name.from_text('com.'), [dns.name.from_text('ns.gtld.test.')], 3600)
 
-        self.assertEqual("\x05\x02\x00\x02", self.proto.sock.sent)
+        self.assertEquals((dns.name.from_text('com.'), [dns.name.from_text('ns.gtld.test.')], []),
+                          cache.find(dns.name.from_text('www.example.com.')))
 
-    def testAuth(self):
-        self.assertEqual("\x01\x04user\x04pass", self.proto.make_simple_auth('user', 'pass'))
+        cache.add_address(dns.name.from_text('ns.gtld.test.'), ['127.0.0.3'], 3600)
+        cache.add_zone(dns.name.from_text('example.com.'), [dns.name.from_text('ns1.dns.net.')], -1)
 
-        self.proto.sock.buf = "\x01\x00"
-        self.assert_(self.proto.parse_simple_auth())
+        self.assertEquals((dns.name.from_text('com.'), [dns.name.from_text('ns.gtld.test.')], ['127.0.0.3']),
+                          cache.find(dns.name.from_text('www.example.com.')))
 
-        self.proto.sock.buf = "\x04\x02"
-        self.assertRaises(InvalidSocksVersion, self.proto.parse_simple_auth)
+        self.assertEquals({'zones': 2, 'addresses': 2, 'cold': 0, 'hits': 2, 'misses': 1}, cache.stats())
 
-        self.proto.sock.buf = "\x01\x01"
-        self.assertRaises(AuthenticationError, self.proto.parse_simple_auth)
+    def testLookup(self):
+        results = self.resolver.lookupAddress('www.example.com', expired=5, port=self.root.port, iterative=True)
 
-    def testRequest(self):
-        self.assertEqual("\x05\x01\x00\x01\x7f\x00\x00\x01\x1f\x90", self.proto.make_request(SocksProtocol.CMD_CONNECT, '127.0.0.1', 8080))
-        self.assertEqual("\x05\x03\x00\x03\tlocalhost\x1f\x90", self.proto.make_request(SocksProtocol.CMD_UDP_ASSOCIATE, 'localhost', 8080))
+        self.assertEquals({'www.example.com': {'A': ['10.0.0.1']}}, results)
+        self.assertEquals(2, len(self.root.requests))
 
-        self.proto.sock.buf = "\x05\x00\x00\x01\x7f\x00\x00\x01\x1f\x91"
+        finished = threading.Event()
+        responses = []
 
-        addr, port = self.proto.parse_request()
+        def onfinish(nameserver, qname, response):
+            responses.append((nameserver, qname, response))
+            finished.set()
 
-        self.assertEqual("127.0.0.1", addr)
-        self.assertEqual(8081, port)
+        self.resolver.lookupMailExchange('mail.example.com', expired=5, port=self.root.port,
+                                         iterative=True, callback=onfinish)
 
-        self.proto.sock.buf = "\x05\x00\x00\x03\tlocalhost\x1f\x91"
+        finished.wait(5)
 
-        addr, port = self.proto.parse_request()
+        self.assertEquals([(('127.0.0.4', self.root.port), 'mail.example.com',
+                           {'mail.example.com': {'MX': [('mx.example.com.', 10)]}})], responses)
+        self.assertEquals(2, len(self.root.requests))
+        self.assertEquals(2, len(self.gtld.requests))
 
-        self.assertEqual("localhost", addr)
-        self.assertEqual(8081, port)
+    def testTimeout(self):
+        self.root.close()
 
-        self.proto.sock.buf = "\x05\x00\x00\x01\x7f\x00\x00\x01\x1f\x90"
-        self.assertEqual(('127.0.0.1', 8080), self.proto.associate())
+        started = time.time()
 
-        self.assertEqual("\x05\x03\x00\x01\x00\x00\x00\x00\x00\x00", self.proto.sock.sent)
+        self.assertRaises(socket.timeout, self.resolver.lookupAddress, 'www.example.com', expired=1,
+                          port=self.root.port, iterative=True)
+        self.assert_(time.time() - started < 4)
 
-    def testPacket(self):
-        self.assertEqual("\x00\x00\x00\x01\x7f\x00\x00\x01\x005test", self.proto.make_packet('127.0.0.1', 53, 'test'))
-        self.assertEqual("\x00\x00\x00\x03\tlocalhost\x005test", self.proto.make_packet('localhost', 53, 'test'))
+        # the plain lookups time out the same way
+        self.assertRaises(socket.timeout, self.resolver.lookupAddress, 'www.example.com', expired=1,
+                          nameservers=['127.0.0.2'], port=self.root.port)
 
-        self.assertEqual(("127.0.0.1", 53, "test"), self.proto.parse_packet("\x00\x00\x00\x01\x7f\x00\x00\x01\x005test"))
-        self.assertEqual(("localhost", 53, "test"), self.proto.parse_packet("\x00\x00\x00\x03\tlocalhost\x005test"))
+    def testReferralFallback(self):
+        self.resolver.FANOUT = 1
+        self.resolver.delegations = DelegationCache([('root.test.', '127.0.0.2'), ('dead.test.', '127.0.0.9')])
+        # the dead root is chosen first, since it was never asked
+        self.resolver.servers.update(('127.0.0.2', self.root.port), 0.5)
+
+        future = self.resolver.lookup_async('www.example.com', dns.rdatatype.A, dns.rdataclass.IN, expired=1,
+                                            port=self.root.port, iterative=True)
+
+        self.assertEquals({'www.example.com': {'A': ['10.0.0.1']}}, future.result(5)[1])
+        self.assert_(('127.0.0.9', self.root.port) in self.resolver.servers.dump())
+
+class TestCnameResolver(unittest.TestCase):
+    RECORDS = {
+        'www.a.com.': {'CNAME': ['a.cdn.net.']},
+        'www.b.com.': {'CNAME': ['a.cdn.net.']},
+        'a.cdn.net.': {'CNAME': ['edge.cdn.net.']},
+        'edge.cdn.net.': {'A': ['10.0.0.1']},
+        'loop1.a.com.': {'CNAME': ['loop2.a.com.']},
+        'loop2.a.com.': {'CNAME': ['loop1.a.com.']},
+    }
+
+    def setUp(self):
+        self.wheel = TimeWheel()
+        self.resolver = Resolver(self.wheel)
+        self.nameserver = None
+
+    def tearDown(self):
+        self.resolver.close()
+        self.wheel.terminate()
+        self.nameserver.close()
+
+    def lookup(self, qname, rdtype=dns.rdatatype.A, follow_cname=8):
+        return self.resolver.lookup(qname, rdtype, dns.rdataclass.IN, expired=5, follow_cname=follow_cname,
+                                    nameservers=[self.nameserver.host], port=self.nameserver.port)
+
+    def testChase(self):
+        self.nameserver = LocalAuthority(self.RECORDS, {}, '127.0.0.1', chase=False)
+
+        results = self.lookup('www.a.com')
+
+        self.assertEquals({
+            'www.a.com': {'CNAME': ['a.cdn.net']},
+            'a.cdn.net': {'CNAME': ['edge.cdn.net']},
+            'edge.cdn.net': {'A': ['10.0.0.1']},
+        }, results)
+        self.assertEquals(3, len(self.nameserver.requests))
+
+        results = self.lookup('www.b.com')
+
+        self.assertEquals(['10.0.0.1'], results['edge.cdn.net']['A'])
+        self.assertEquals(5, len(self.nameserver.requests))
+        self.assertEquals(1, self.resolver.cnames.hits)
+
+        self.assertEquals({'www.a.com': {'CNAME': ['a.cdn.net']}}, self.lookup('www.a.com', follow_cname=0))
+        self.assertEquals(['a.cdn.net'], self.lookup('www.a.com', follow_cname=1)['www.a.com']['CNAME'])
+        self.assertFalse('edge.cdn.net' in self.lookup('www.a.com', follow_cname=1))
+
+        results = self.lookup('loop1.a.com')
+
+        self.assertEquals({
+            'loop1.a.com': {'CNAME': ['loop2.a.com']},
+            'loop2.a.com': {'CNAME': ['loop1.a.com']},
+        }, results)
+
+    def testInResponse(self):
+        self.nameserver = LocalAuthority(self.RECORDS, {}, '127.0.0.1')
+
+        results = self.lookup('www.a.com')
+
+        self.assertEquals(['10.0.0.1'], results['edge.cdn.net']['A'])
+        self.assertEquals(1, len(self.nameserver.requests))
+        self.assertEquals(2, len(self.resolver.cnames))
+
+    def testCapacity(self):
+        self.nameserver = LocalAuthority(self.RECORDS, {}, '127.0.0.1')
+
+        cnames = CnameCache(capacity=2)
+
+        for name, target in [('www.a.com.', 'a.cdn.net.'), ('www.b.com.', 'a.cdn.net.')]:
+            cnames.add(dns.rrset.from_text(name, 300, 'IN', 'CNAME', target))
+
+        self.assert_(cnames.get(dns.name.from_text('www.a.com.')) is not None)
+
+        cnames.add(dns.rrset.from_text('a.cdn.net.', 300, 'IN', 'CNAME', 'edge.cdn.net.'))
+
+        self.assertEquals(2, len(cnames))
+        self.assert_(cnames.get(dns.name.from_text('www.a.com.')) is not None)
+        self.assertEquals(None, cnames.get(dns.name.from_text('www.b.com.')))
+
+class TestTcpFallback(unittest.TestCase):
+    def setUp(self):
+        self.nameserver = LocalAuthority(dict([("www.site%d.com." % i, {
+            'TXT': ['"%d%s"' % (j, "site%d" % i * 40) for j in range(8)]
+        }) for i in range(3)]), {}, '127.0.0.1')
+        self.nameserver.truncate = True
+        self.tcp = LocalTcpNameserver(self.nameserver)
+
+        self.wheel = TimeWheel()
+        self.resolver = Resolver(self.wheel)
+
+    def tearDown(self):
+        self.resolver.close()
+        self.wheel.terminate()
+        self.nameserver.close()
+        self.tcp.close()
+
+    def testTruncated(self):
+        batch = Batch([self.resolver.lookup_async("www.site%d.com" % i, dns.rdatatype.TXT, dns.rdataclass.IN, 5,
+                                                  [self.nameserver.host], self.nameserver.port) for i in range(3)])
+
+        self.assert_(batch.wait(5))
+
+        for i in range(3):
+            nameserver, results = batch.futures[i].result()
+
+            self.assertEquals(8, len(results["www.site%d.com" % i]['TXT']))
+
+        self.assertEquals(3, len(self.nameserver.requests))
+        self.assertEquals(3, len(self.tcp.requests))
+        self.assertEquals(1, self.tcp.accepted)
+        self.assertEquals({'connections': 1, 'pending': 0, 'queries': 3, 'connects': 1}, self.resolver.tcp.stats())
+
+        self.resolver.tcp.close()
+
+        self.assertEquals(0, len(self.resolver.tcp))
+
+class TestEdns(unittest.TestCase):
+    def setUp(self):
+        self.nameserver = LocalNameserver({'www.google.com': ['1.2.3.4']})
+        self.wheel = TimeWheel()
+        self.resolver = Resolver(self.wheel, payload=4096)
+
+    def tearDown(self):
+        self.resolver.close()
+        self.wheel.terminate()
+        self.nameserver.close()
+
+    def lookup(self):
+        return self.resolver.lookup("www.google.com", dns.rdatatype.A, dns.rdataclass.IN, 5,
+                                    nameservers=[self.nameserver.host], port=self.nameserver.port)
+
+    def testPayload(self):
+        self.assertEquals(['1.2.3.4'], self.lookup()['www.google.com']['A'])
+
+        request = self.nameserver.requests[0]
+
+        self.assertEquals(0, request.edns)
+        self.assertEquals(4096, request.payload)
+
+    def testFormErr(self):
+        self.nameserver.edns = False
+
+        self.assertEquals(['1.2.3.4'], self.lookup()['www.google.com']['A'])
+        self.assertEquals([0, -1], [r.edns for r in self.nameserver.requests])
+
+        nameserver = (self.nameserver.host, self.nameserver.port)
+
+        self.assert_(nameserver in self.resolver.no_edns)
+
+        self.assertEquals(['1.2.3.4'], self.lookup()['www.google.com']['A'])
+        self.assertEquals([0, -1, -1], [r.edns for r in self.nameserver.requests])
+
+        # EDNS is tried again once the FORMERR expires
+        self.resolver.no_edns[nameserver] -= self.resolver.NO_EDNS_TTL
+
+        self.assertEquals(['1.2.3.4'], self.lookup()['www.google.com']['A'])
+        self.assertEquals([0, -1, -1, 0, -1], [r.edns for r in self.nameserver.requests])
+
+class TestDualStack(unittest.TestCase):
+    def setUp(self):
+        self.wheel = TimeWheel()
+        self.resolver = Resolver(self.wheel)
+
+        if self.resolver.inet6 is None:
+            # the tear down is skipped with the test
+            self.resolver.close()
+            self.wheel.terminate()
+
+            self.skipTest("no IPv6")
+
+        self.nameserver = LocalNameserver({'www.google.com': ['1.2.3.4']})
+        self.nameserver6 = LocalNameserver({'www.google.com': ['1.2.3.4']}, '::1', self.nameserver.port)
+
+    def tearDown(self):
+        self.resolver.close()
+        self.wheel.terminate()
+        self.nameserver.close()
+        self.nameserver6.close()
+
+    def testRoute(self):
+        self.assertEquals([self.resolver, self.resolver.inet6], self.resolver.channels)
+        self.assertEquals(self.resolver.inet6, self.resolver.channel(('::1', 53)))
+        self.assertEquals(self.resolver, self.resolver.channel(('127.0.0.1', 53)))
+
+        future = self.resolver.query_async("www.google.com", dns.rdatatype.A, dns.rdataclass.IN, 5,
+                                           ['::1'], self.nameserver.port)
+
+        nameserver, response = future.result(5)
+
+        self.assertEquals(('::1', self.nameserver.port), nameserver)
+        self.assertEquals(0, len(self.nameserver.requests))
+        self.assertEquals(1, len(self.nameserver6.requests))
+
+        batch = Batch([self.resolver.query_async("www.google.com", dns.rdatatype.A, dns.rdataclass.IN, 5,
+                                                 [ns], self.nameserver.port) for ns in ['127.0.0.1', '::1']])
+
+        self.assert_(batch.wait(5))
+        self.assertEquals(1, len(self.nameserver.requests))
+        self.assertEquals(2, len(self.nameserver6.requests))
+        self.assertEquals(0, len(self.resolver))
+
+class TestShardedResolver(unittest.TestCase):
+    def setUp(self):
+        self.nameserver = LocalNameserver(dict([("www.site%d.com" % i, ["10.0.0.%d" % i]) for i in range(20)]))
+        self.resolver = ShardedResolver(2)
+
+    def tearDown(self):
+        self.resolver.close()
+        self.nameserver.close()
+
+    def testShard(self):
+        self.assertEquals(self.resolver.shard("www.Site1.com."), self.resolver.shard("www.site1.com"))
+
+    def testThreads(self):
+        # the workers would be forked along with the running threads of the time wheel
+        wheel = TimeWheel()
+
+        try:
+            self.assertRaises(RuntimeError, ShardedResolver, 1)
+        finally:
+            wheel.terminate()
+
+    def testLookupMany(self):
+        domains = ["www.site%d.com\n" % i for i in range(20)] + ["www.unknown.com"]
+
+        results = dict(self.resolver.lookup_many(domains, [dns.rdatatype.A, dns.rdatatype.MX], expired=5,
+                                                 concurrency=8, nameservers=[self.nameserver.host],
+                                                 port=self.nameserver.port))
+
+        self.assertEquals(21, len(results))
+        self.assertEquals({"www.site3.com": {"A": ["10.0.0.3"]}}, results["www.site3.com"])
+        self.assertEquals({}, results["www.unknown.com"])
+
+        self.assertEquals({"www.site4.com": {"A": ["10.0.0.4"]}},
+                          self.resolver.lookup("www.site4.com", expired=5, nameservers=[self.nameserver.host],
+                                               port=self.nameserver.port))
+
+        stats = self.resolver.stats()
+
+        self.assertEquals(22, sum([shard['completed'] for shard in stats]))
+        self.assert_(all([shard['submitted'] > 0 for shard in stats]))
+        self.assertEquals(0, len(self.resolver))
+
+class TestSharedCache(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix="asyncdns")
+        self.path = os.path.join(self.dir, "cache")
+        self.cache = SharedCache(self.path, slots=64, slot_size=512)
+
+    def tearDown(self):
+        self.cache.close()
+
+        shutil.rmtree(self.dir)
+
+    def testUntrustedFile(self):
+        os.chmod(self.path, 0666)
+
+        self.assertRaises(ValueError, SharedCache, self.path)
+
+        link = os.path.join(self.dir, "link")
+        os.symlink(self.path, link)
+
+        os.chmod(self.path, 0600)
+
+        self.assertRaises(OSError, SharedCache, link)
+
+    def response(self, qname, ttl=300, *addresses):
+        qname = dns.name.from_text(qname)
+        request = dns.message.make_query(qname, dns.rdatatype.A)
+        response = dns.message.make_response(request)
+        response.answer.append(dns.rrset.from_text(qname, ttl, 'IN', 'A', *addresses))
+
+        return response
+
+    def testCache(self):
+        name = dns.name.from_text("www.google.com")
+
+        self.assertEquals(None, self.cache.get(name, dns.rdatatype.A, dns.rdataclass.IN))
+        self.assert_(self.cache.put(self.response("www.google.com", 300, "1.2.3.4")))
+        self.assertFalse(self.cache.put(self.response("www.expired.com", 0, "1.2.3.4")))
+        self.assertFalse(self.cache.put(self.response("www.big.com", 300, *["10.0.0.%d" % i for i in range(64)])))
+
+        other = SharedCache(self.path)
+
+        self.assertEquals((64, 512), (other.slots, other.slot_size))
+        self.assertEquals(0600, os.stat(self.path).st_mode & 0777)
+
+        response = other.get(dns.name.from_text("WWW.Google.com"), dns.rdatatype.A, dns.rdataclass.IN)
+
+        self.assertEquals("1.2.3.4", response.answer[0][0].address)
+        self.assert_(response.answer[0].ttl <= 300)
+        self.assertEquals(None, other.get(name, dns.rdatatype.MX, dns.rdataclass.IN))
+
+        self.assert_(other.put(self.response("www.google.com", 300, "5.6.7.8")))
+        self.assertEquals("5.6.7.8", self.cache.get(name, dns.rdatatype.A, dns.rdataclass.IN).answer[0][0].address)
+
+        for i in range(200):
+            self.cache.put(self.response("www.site%d.com" % i, 300, "10.0.0.1"))
+
+        self.assertEquals({'slots': 64, 'hits': 1, 'misses': 1, 'stale_hits': 0, 'stores': 201}, self.cache.stats())
+
+        other.close()
+
+    def testResolver(self):
+        nameserver = LocalNameserver({'www.google.com': ['1.2.3.4']})
+        wheel = TimeWheel()
+        resolver = Resolver(wheel, cache=self.cache)
+
+        try:
+            for i in range(2):
+                self.assertEquals({'www.google.com': {'A': ['1.2.3.4']}},
+                                  resolver.lookup("www.google.com", dns.rdatatype.A, dns.rdataclass.IN, 5,
+                                                  nameservers=[nameserver.host], port=nameserver.port))
+
+            self.assertEquals(1, len(nameserver.requests))
+        finally:
+            resolver.close()
+            wheel.terminate()
+            nameserver.close()
+
+    def testServeStale(self):
+        nameserver = LocalNameserver({'www.google.com': ['1.2.3.4']})
+        nameserver.ttl = 1
+        wheel = TimeWheel()
+        resolver = Resolver(wheel, cache=self.cache, stale=1)
+
+        def lookup():
+            return resolver.lookup_async("www.google.com", dns.rdatatype.A, dns.rdataclass.IN, 5,
+                                         nameservers=[nameserver.host], port=nameserver.port)
+
+        try:
+            self.assertEquals({'www.google.com': {'A': ['1.2.3.4']}}, lookup().result(5)[1])
+
+            time.sleep(1.5)
+
+            self.assertEquals({'www.google.com': {'A': ['1.2.3.4']}}, lookup().result(5)[1])
+            self.assertEquals(2, len(nameserver.requests))
+            self.assertEquals(0, resolver.stale_served)
+
+            nameserver.close()
+
+            time.sleep(1.5)
+
+            started = time.time()
+
+            self.assertEquals((None, {'www.google.com': {'A': ['1.2.3.4']}}), lookup().result(5))
+            self.assert_(time.time() - started < 3)
+            self.assertEquals(1, resolver.stale_served)
+            self.assertEquals(2, self.cache.stats()['stale_hits'])
+        finally:
+            resolver.close()
+            wheel.terminate()
+
+    def testServeStaleOnServfail(self):
+        nameserver = LocalNameserver({'www.google.com': ['1.2.3.4']})
+        nameserver.ttl = 1
+        wheel = TimeWheel()
+        resolver = Resolver(wheel, cache=self.cache, stale=3)
+
+        def lookup():
+            return resolver.lookup_async("www.google.com", dns.rdatatype.A, dns.rdataclass.IN, 5,
+                                         nameservers=[nameserver.host], port=nameserver.port)
+
+        def servfail(request):
+            response = dns.message.make_response(request)
+            response.set_rcode(dns.rcode.SERVFAIL)
+
+            return response
+
+        try:
+            self.assertEquals({'www.google.com': {'A': ['1.2.3.4']}}, lookup().result(5)[1])
+
+            nameserver.respond = servfail
+
+            time.sleep(1.5)
+
+            started = time.time()
+
+            self.assertEquals((None, {'www.google.com': {'A': ['1.2.3.4']}}), lookup().result(5))
+            self.assert_(time.time() - started < 1)
+            self.assertEquals(1, resolver.stale_served)
+        finally:
+            resolver.close()
+            wheel.terminate()
+            nameserver.close()
+
+    def testStaleDelay(self):
+        self.assertRaises(ValueError, Resolver, cache=self.cache, stale=0.5, start=False)
+
+    def testPrefetch(self):
+        nameserver = LocalNameserver({'www.google.com': ['1.2.3.4']})
+        nameserver.ttl = 4
+        wheel = TimeWheel()
+        resolver = Resolver(wheel, cache=self.cache, prefetch=0.5)
+
+        def lookup():
+            return resolver.lookup("www.google.com", dns.rdatatype.A, dns.rdataclass.IN, 5,
+                                   nameservers=[nameserver.host], port=nameserver.port)
+
+        try:
+            started = time.time()
+
+            for i in range(3):
+                self.assertEquals({'www.google.com': {'A': ['1.2.3.4']}}, lookup())
+
+            self.assertEquals(1, len(resolver.prefetcher))
+
+            while resolver.prefetcher.stats()['prefetched'] == 0 and time.time() - started < 5:
+                time.sleep(0.1)
+
+            self.assertEquals(2, len(nameserver.requests))
+
+            time.sleep(max(0, started + 4.5 - time.time()))
+
+            self.assertEquals({'www.google.com': {'A': ['1.2.3.4']}}, lookup())
+            self.assertEquals(2, len(nameserver.requests))
+            self.assertEquals({'tracked': 1, 'scheduled': 0, 'prefetched': 1, 'failed': 0, 'useful': 1},
+                              resolver.prefetcher.stats())
+        finally:
+            resolver.close()
+            wheel.terminate()
+            nameserver.close()
+
+    def testPrefetchRecentHits(self):
+        from asyncdns.prefetch import Prefetcher
+
+        prefetcher = Prefetcher(None, min_hits=2, window=0.2, max_tracked=2)
+
+        prefetcher.touch('a', 10, 10, None)
+        time.sleep(0.3)
+        prefetcher.touch('a', 10, 10, None)
+
+        self.assertEquals(0, len(prefetcher))
+        self.assertEquals(1, prefetcher.popular['a'][1])
+
+        prefetcher.touch('b', 10, 10, None)
+        prefetcher.touch('c', 10, 10, None)
+
+        self.assertEquals(['b', 'c'], list(prefetcher.popular))
+        self.assertEquals(2, prefetcher.stats()['tracked'])
+
+class TestSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix="asyncdns")
+        self.path = os.path.join(self.dir, "snapshot")
+        self.wheel = TimeWheel()
+
+    def tearDown(self):
+        self.wheel.terminate()
+
+        shutil.rmtree(self.dir)
+
+    def testServerStats(self):
+        servers = ServerStats()
+
+        servers.update(('1.1.1.1', 53), 0.2)
+        servers.update(('1.1.1.1', 53), 0.1)
+        servers.update(('2.2.2.2', 53), 0.05)
+        servers.timeout(('3.3.3.3', 53))
+
+        self.assertAlmostEquals(0.1875, servers.rtt(('1.1.1.1', 53)))
+        self.assertEquals(1.0, servers.rtt(('3.3.3.3', 53)))
+        self.assertEquals(['4.4.4.4', '2.2.2.2'], servers.choose(['1.1.1.1', '2.2.2.2', '3.3.3.3', '4.4.4.4'], 2))
+
+    def testSaveAndLoad(self):
+        resolver = Resolver(self.wheel, start=False)
+
+        resolver.delegations.add_zone(dns.name.from_text("google.com"), [dns.name.from_text("ns1.google.com")], 300)
+        resolver.delegations.add_zone(dns.name.from_text("expired.com"), [dns.name.from_text("ns1.expired.com")], -1)
+        resolver.delegations.add_address(dns.name.from_text("ns1.google.com"), ["1.2.3.4"], 300)
+        resolver.cnames.add(dns.rrset.from_text(dns.name.from_text("www.google.com"), 300, 'IN', 'CNAME', "www.l.google.com."))
+        resolver.servers.update(("1.2.3.4", 53), 0.1)
+
+        snapshot = Snapshot(resolver, self.path)
+
+        self.assertFalse(snapshot.load())
+
+        snapshot.save()
+        resolver.close()
+
+        resolver = Resolver(self.wheel, start=False)
+
+        self.assert_(Snapshot(resolver, self.path).load())
+        self.assertEquals(3, resolver.delegations.stats()['cold'])
+        self.assertEquals(0.1, resolver.servers.rtt(("1.2.3.4", 53)))
+
+        zone, nsnames, addresses = resolver.delegations.find(dns.name.from_text("www.google.com"))
+
+        self.assertEquals(dns.name.from_text("google.com"), zone)
+        self.assertEquals([dns.name.from_text("ns1.google.com")], nsnames)
+        self.assertEquals(["1.2.3.4"], addresses)
+
+        self.assertEquals(dns.name.root, resolver.delegations.find(dns.name.from_text("www.expired.com"))[0])
+        self.assertEquals(0, resolver.delegations.stats()['cold'])
+
+        rrset = resolver.cnames.get(dns.name.from_text("WWW.Google.com"))
+
+        self.assertEquals(dns.name.from_text("www.l.google.com"), rrset[0].target)
+
+        resolver.close()
+
+    def testTick(self):
+        resolver = Resolver(self.wheel, start=False)
+        snapshot = Snapshot(resolver, self.path)
+        saving = []
+
+        def save():
+            saving.append(threading.currentThread().name)
+
+            time.sleep(0.5)
+
+        snapshot.save = save
+
+        try:
+            started = time.time()
+
+            snapshot._tick()
+            snapshot._tick()
+
+            self.assert_(time.time() - started < 0.2)
+
+            snapshot.saver.join()
+
+            self.assertEquals(["asyncdns.snapshot"], saving)
+        finally:
+            resolver.close()
+
+class TestForwarder(unittest.TestCase):
+    class SlowNameserver(LocalNameserver):
+        def respond(self, request):
+            time.sleep(0.5)
+
+            return LocalNameserver.respond(self, request)
+
+    def setUp(self):
+        self.nameserver = self.SlowNameserver({'www.google.com': ['1.2.3.4']})
+        self.wheel = TimeWheel()
+        self.resolver = Resolver(self.wheel)
+        self.forwarder = Forwarder(self.resolver, port=0, nameservers=[self.nameserver.host],
+                                   upstream_port=self.nameserver.port)
+
+    def tearDown(self):
+        self.forwarder.close()
+        self.resolver.close()
+        self.wheel.terminate()
+        self.nameserver.close()
+
+    def testUdp(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.settimeout(5)
+
+        requests = [dns.message.make_query("www.google.com", dns.rdatatype.A),
+                    dns.message.make_query("WWW.Google.com", dns.rdatatype.A, use_edns=0, payload=1232),
+                    dns.message.make_query("www.google.com", dns.rdatatype.A)]
+        requests[2].flags |= dns.flags.CD
+
+        for request in requests:
+            sock.sendto(request.to_wire(), (self.forwarder.host, self.forwarder.port))
+
+        responses = dict([(response.id, response) for response in
+                          [dns.message.from_wire(sock.recv(65535)) for request in requests]])
+
+        sock.close()
+
+        for request in requests:
+            self.assert_(request.is_response(responses[request.id]))
+            self.assertEquals("1.2.3.4", responses[request.id].answer[0][0].address)
+            self.assertEquals(request.question[0].name.labels, responses[request.id].question[0].name.labels)
+            self.assertEquals(request.edns, responses[request.id].edns)
+            self.assertEquals(request.flags & dns.flags.CD, responses[request.id].flags & dns.flags.CD)
+            self.assert_(responses[request.id].flags & dns.flags.RA)
+
+        self.assertEquals(1, len(self.nameserver.requests))
+        self.assertEquals({'queries': 3, 'coalesced': 2, 'answered': 3, 'failed': 0,
+                           'inflight': 0, 'clients': 0}, self.forwarder.stats())
+
+    def testTcp(self):
+        sock = socket.create_connection((self.forwarder.host, self.forwarder.port), 5)
+
+        for qname in ["www.google.com", "www.unknown.com"]:
+            packet = dns.message.make_query(qname, dns.rdatatype.A).to_wire()
+
+            sock.sendall(struct.pack(">H", len(packet)) + packet)
+
+        responses = []
+
+        for i in range(2):
+            size = struct.unpack(">H", sock.recv(2, socket.MSG_WAITALL))[0]
+
+            responses.append(dns.message.from_wire(sock.recv(size, socket.MSG_WAITALL)))
+
+        # the client is polled by the loop of the resolver
+        self.assertEquals(1, len(self.forwarder.clients))
+        self.assert_(list(self.forwarder.clients)[0] in self.resolver.map.values())
+
+        sock.close()
+
+        self.assertEquals([dns.rcode.NOERROR, dns.rcode.NXDOMAIN],
+                          sorted([response.rcode() for response in responses]))
+
+class TestScene(unittest.TestCase):
+    class FakeResolver(object):
+        def __init__(self):
+            self.queries = []
+            self.pending = []
+
+        def lookup_async(self, qname, rdtype, rdclass, expired, nameservers, port):
+            self.queries.append(qname)
+
+            future = Future()
+
+            if qname == 'pending':
+                self.pending.append(future)
+            elif qname == 'error':
+                future.set_exception(socket.timeout())
+            else:
+                future.set_result((('127.0.0.1', port), {qname: {'A': ['127.0.0.1']}}))
+
+            return future
+
+    def setUp(self):
+        self.resolver = TestScene.FakeResolver()
+
+    def testScene(self):
+        @Scene()
+        def walk(domains):
+            addresses = []
+
+            for domain in domains:
+                try:
+                    nameserver, results = yield Query(domain)
+
+                    addresses.extend(results[domain]['A'])
+                except socket.timeout:
+                    addresses.append(None)
+
+            yield Result(addresses)
+
+        scenario = walk(['www.google.com', 'error', 'pending'])
+
+        self.assert_(isinstance(scenario, Scenario))
+
+        future = scenario.play(self.resolver)
+
+        self.assertFalse(future.done())
+        self.assertEquals(['www.google.com', 'error', 'pending'], self.resolver.queries)
+
+        self.resolver.pending.pop().set_result((('127.0.0.1', 53), {'pending': {'A': ['127.0.0.2']}}))
+
+        self.assertEquals(['127.0.0.1', None, '127.0.0.2'], future.result(0))
+
+    def testNested(self):
+        def child(domain):
+            nameserver, results = yield Query(domain)
+
+            yield Result(results[domain]['A'][0])
+
+        def parent():
+            first = yield child('www.google.com')
+            others = yield [child('www.baidu.com'), Query('error'), 'invalid']
+
+            yield Result([first] + others)
+
+        future = Scenario(parent()).play(self.resolver)
+
+        self.assertRaises(TypeError, future.result, 0)
+
+        def parallel():
+            results = yield [child('www.baidu.com'), Query('error')]
+
+            yield Result(results)
+
+        future = Scenario(parallel()).play(self.resolver)
+
+        address, error = future.result(0)
+
+        self.assertEquals('127.0.0.1', address)
+        self.assert_(isinstance(error, socket.timeout))
+
+class TestNameCache(unittest.TestCase):
+    def setUp(self):
+        self.names = NameCache(capacity=2)
+
+    def testFromText(self):
+        name = self.names.from_text("www.google.com")
+
+        self.assert_(name.is_absolute())
+        self.assertEquals(dns.name.from_text("www.google.com."), name)
+        self.assert_(name is self.names.from_text("www.google.com"))
+
+        self.assertEquals(1, self.names.hits)
+        self.assertEquals(1, self.names.misses)
+        self.assertEquals(0.5, self.names.hit_rate)
+
+        self.names.from_text("www.baidu.com")
+        self.names.from_text("www.sina.com")
+
+        self.assertEquals(2, len(self.names.names))
+        self.assertFalse("www.google.com" in self.names.names)
+
+    def testToText(self):
+        name = dns.name.from_text("mail.google.com.")
+
+        self.assertEquals("mail.google.com", self.names.to_text(name))
+        self.assertEquals("mail.google.com.", self.names.to_text(name, False))
+        self.assertEquals("mail.google.com", self.names.to_text(dns.name.from_text("mail.google.com.")))
+
+        self.assertEquals({'names': 0, 'texts': 2, 'hits': 1, 'misses': 2, 'hit_rate': 1/3.0}, self.names.stats())
+
+    def testResolver(self):
+        self.assertEquals("ns1.google.com", Resolver._to_relativity(dns.name.from_text("ns1.google.com."), self.names))
+        self.assertEquals(1, self.names.misses)
+
+class TestSocksProxy(unittest.TestCase):
+    def setUp(self):
+        self.nameserver = LocalNameserver({'www.google.com': ['1.2.3.4']})
+        self.wheel = TimeWheel()
+        self.socks = None
+        self.pipeline = None
+
+    def tearDown(self):
+        if self.pipeline is not None:
+            self.pipeline.close()
+
+        self.wheel.terminate()
+        self.nameserver.close()
+
+        if self.socks is not None:
+            self.socks.close()
+
+    def connect(self, username='', passwd='', delay=0, proxy_passwd=None):
+        self.socks = LocalSocksProxy(username, passwd if proxy_passwd is None else proxy_passwd, delay)
+        self.pipeline = Pipeline(self.wheel, SocksProxy(self.socks.host, self.socks.port, username, passwd))
+
+    def query(self):
+        return self.pipeline.query_async("www.google.com", expired=5,
+                                         nameservers=[self.nameserver.host], port=self.nameserver.port)
+
+    def wait(self, condition, timeout=5):
+        deadline = time.time() + timeout
+
+        while not condition() and time.time() < deadline:
+            time.sleep(0.05)
+
+        return condition()
+
+    def testQueued(self):
+        self.connect(delay=0.5)
+
+        future = self.query()
+
+        self.assertEquals(1, self.pipeline.queued)
+        self.assertFalse(self.pipeline.relays.ready)
+
+        nameserver, response = future.result(5)
+
+        self.assertEquals((self.nameserver.host, self.nameserver.port), nameserver)
+        self.assertEquals('1.2.3.4', response.answer[0][0].address)
+        self.assertEquals(('127.0.0.1', self.socks.relay.getsockname()[1]), self.pipeline.relays.relays[0].address)
+
+    def testAuth(self):
+        self.connect('user', 'pass')
+
+        self.assertEquals('1.2.3.4', self.query().result(5)[1].answer[0][0].address)
+
+    def testAuthFailed(self):
+        self.connect('user', 'pass', proxy_passwd='secret')
+
+        self.assertRaises(socket.error, self.query().result, 5)
+        self.assertEquals(0, self.socks.associations)
+
+        # the proxy which rejected the authentication is not tried again
+        relay = self.pipeline.relays.relays[0]
+
+        self.assert_(relay.rejected)
+        self.assertEquals(None, relay.timer)
+        self.assert_(self.pipeline.relays.rejected)
+        self.assertRaises(socket.error, self.query().result, 1)
+
+    def testReassociate(self):
+        self.connect()
+
+        self.assertEquals('1.2.3.4', self.query().result(5)[1].answer[0][0].address)
+
+        self.socks.drop()
+
+        self.assert_(self.wait(lambda: self.socks.associations == 2 and self.pipeline.relays.ready))
+        self.assertEquals('1.2.3.4', self.query().result(5)[1].answer[0][0].address)
+        self.assertEquals(None, self.pipeline.relays.relays[0].delay)
+
+    def testSpoofed(self):
+        self.connect()
+
+        self.assertEquals('127.0.0.1', self.pipeline.socket.getsockname()[0])
+        self.assert_(self.wait(lambda: self.pipeline.relays.ready))
+
+        self.nameserver.delay = 0.5
+
+        future = self.query()
+
+        self.assert_(self.wait(lambda: self.nameserver.requests))
+
+        # a datagram from anywhere but the relay is dropped, even when it carries a matching response
+        response = dns.message.make_response(self.nameserver.requests[0])
+        response.answer.append(dns.rrset.from_text(response.question[0].name, 300, 'IN', 'A', '6.6.6.6'))
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.sendto(self.socks.proto.make_packet(self.nameserver.host, self.nameserver.port, response.to_wire()),
+                    self.pipeline.socket.getsockname())
+        sock.close()
+
+        self.assertEquals('1.2.3.4', future.result(5)[1].answer[0][0].address)
+
+    def testPool(self):
+        self.socks = LocalSocksProxy()
+        self.other = LocalSocksProxy()
+
+        try:
+            proxies = [SocksProxy(self.socks.host, self.socks.port), SocksProxy(self.other.host, self.other.port)]
+
+            self.assertEquals([None, None], [proxy.sock for proxy in proxies])
+
+            self.pipeline = Pipeline(self.wheel, proxies)
+
+            self.assert_(self.wait(lambda: len(self.pipeline.relays) == 2))
+
+            batch = Batch([self.query() for i in range(20)])
+
+            self.assert_(batch.wait(5))
+
+            stats = self.pipeline.relays.stats()
+
+            self.assertEquals(20, sum([relay['responses'] for relay in stats]))
+            self.assert_(all([relay['sent'] > 0 for relay in stats]))
+            self.assertEquals([1, 1], [relay['associations'] for relay in stats])
+
+            self.other.close()
+
+            self.assert_(self.wait(lambda: len(self.pipeline.relays) == 1))
+
+            batch = Batch([self.query() for i in range(5)])
+
+            self.assert_(batch.wait(5))
+            self.assertEquals(['1.2.3.4'] * 5, [future.result()[1].answer[0][0].address for future in batch.futures])
+        finally:
+            self.other.close()
+
+class TestStreamReader(unittest.TestCase):
+    class FakeStream(object):
+        def __init__(self, segments):
+            self.segments = list(segments)
+
+        def recv_into(self, buf, nbytes):
+            if not self.segments:
+                return 0
+
+            data = self.segments.pop(0)
+
+            if len(data) > nbytes:
+                data, rest = data[:nbytes], data[nbytes:]
+
+                self.segments.insert(0, rest)
+
+            buf[:len(data)] = data
+
+            return len(data)
+
+    def testRead(self):
+        reader = StreamReader(TestStreamReader.FakeStream(["\x05", "\x00\x05\x01", "\x00"]), 4)
+
+        self.assertEquals("\x05\x00", reader.read(2))
+        self.assertEquals(2, len(reader))
+        self.assertEquals("\x05\x01\x00", reader.read(3))
+        self.assertEquals(0, len(reader))
+        self.assertRaises(EOFError, reader.read, 1)
+
+    def testFrames(self):
+        messages = ["a" * 10, "b" * 3000, "", "c" * 100]
+        stream = ''.join([struct.pack(">H", len(message)) + message for message in messages])
+
+        reader = StreamReader(TestStreamReader.FakeStream([stream[i:i+700] for i in range(0, len(stream), 700)]), 64)
+
+        frames = []
+
+        while reader.fill():
+            frames.extend(reader.frames())
+
+        self.assertEquals(messages, frames)
+        self.assertEquals(0, len(reader))
+
+class TestTrace(unittest.TestCase):
+    class RecordingTracer(Tracer):
+        def __init__(self, sample=1.0):
+            Tracer.__init__(self, sample)
+
+            self.traces = []
+            self.finished = threading.Event()
+
+        def finish(self, trace):
+            self.traces.append(trace)
+            self.finished.set()
+
+    def setUp(self):
+        self.nameserver = LocalNameserver({"www.google.com": ["1.2.3.4"]})
+        self.tracer = TestTrace.RecordingTracer()
+        self.wheel = TimeWheel()
+        self.pipeline = Pipeline(self.wheel, tracer=self.tracer)
+
+    def tearDown(self):
+        self.pipeline.close()
+        self.wheel.terminate()
+        self.nameserver.close()
+
+    def testStages(self):
+        self.pipeline.query_async("www.google.com", nameservers=[self.nameserver.host],
+                                  port=self.nameserver.port).result(5)
+
+        self.assert_(self.tracer.finished.wait(5))
+        self.assertEquals(1, len(self.tracer.traces))
+
+        trace = self.tracer.traces[0]
+
+        self.assertEquals((self.nameserver.host, self.nameserver.port), trace.nameserver)
+        self.assertEquals("www.google.com.", trace.qname.to_text())
+
+        stages = [ENQUEUE, SEND, RECEIVE, PARSE, MATCH, CALLBACK_START, CALLBACK_END]
+
+        self.assertEquals(sorted(stages), sorted(trace.stamps.keys()))
+        self.assertEquals(stages, sorted(stages, key=trace.stamps.get))
+
+        durations = trace.durations()
+
+        self.assertEquals(sorted(['queue', 'wire', 'parse', 'match', 'dispatch', 'callback', 'total']), sorted(durations.keys()))
+        self.assert_(all([duration >= 0 for duration in durations.values()]))
+
+    def testTimeout(self):
+        silent = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        silent.bind(('127.0.0.1', 0))
+
+        try:
+            future = self.pipeline.query_async("www.google.com", expired=1, nameservers=['127.0.0.1'],
+                                               port=silent.getsockname()[1])
+
+            self.assertRaises(socket.timeout, future.result, 5)
+            self.assert_(self.tracer.finished.wait(5))
+
+            trace = self.tracer.traces[0]
+
+            self.assert_(TIMEOUT in trace.stamps)
+            self.assert_(RECEIVE not in trace.stamps)
+            self.assert_(trace.durations()['wait'] >= 0.5)
+        finally:
+            silent.close()
+
+    def testSample(self):
+        self.assertEquals(None, Tracer(0).start(dns.message.make_query("www.google.com", "A"), ('127.0.0.1', 53)))
+
+        tracer = HistogramTracer()
+        pipeline = Pipeline(self.wheel, tracer=tracer)
+
+        try:
+            for i in range(3):
+                pipeline.query_async("www.google.com", nameservers=[self.nameserver.host],
+                                     port=self.nameserver.port).result(5)
+
+            time.sleep(0.1)
+
+            stats = tracer.stats()
+
+            self.assertEquals(3, stats['total']['count'])
+            self.assert_(stats['wire']['p99'] <= stats['total']['p99'])
+        finally:
+            pipeline.close()
+
+    def testHistogram(self):
+        histogram = Histogram([0.1, 1, 10])
+
+        self.assertEquals(None, histogram.percentile(0.5))
+
+        for value in [0.05, 0.1, 0.5, 2, 20]:
+            histogram.observe(value)
+
+        self.assertEquals(5, histogram.count)
+        self.assertEquals(1, histogram.percentile(0.5))
+        self.assertEquals(float('inf'), histogram.percentile(0.99))
+        self.assertEquals([(0.1, 2), (1, 3), (10, 4), (float('inf'), 5)], histogram.cumulative())
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.nameserver = LocalNameserver({"www.google.com": ["1.2.3.4"]})
+        self.metrics = Metrics()
+        self.wheel = TimeWheel()
+        self.pipeline = Pipeline(self.wheel, metrics=self.metrics)
+
+    def tearDown(self):
+        self.pipeline.close()
+        self.wheel.terminate()
+        self.nameserver.close()
+
+    def testCounters(self):
+        nameserver = (self.nameserver.host, self.nameserver.port)
+
+        for i in range(3):
+            self.pipeline.query_async("www.google.com", nameservers=[self.nameserver.host],
+                                      port=self.nameserver.port).result(5)
+
+        silent = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        silent.bind(('127.0.0.1', 0))
+        silent_address = silent.getsockname()
+
+        try:
+            future = self.pipeline.query_async("www.google.com", expired=1, nameservers=['127.0.0.1'],
+                                               port=silent_address[1])
+
+            time.sleep(0.1)
+
+            self.assertEquals(1, self.pipeline.pending)
+
+            self.assertRaises(socket.timeout, future.result, 5)
+
+            # a response nobody asked for, and garbage
+            response = dns.message.make_response(dns.message.make_query("www.google.com", "A"))
+
+            address = ('127.0.0.1', self.pipeline.socket.getsockname()[1])
+
+            silent.sendto(response.to_wire(), address)
+            silent.sendto("\x00", address)
+
+            time.sleep(0.5)
+        finally:
+            silent.close()
+
+        self.assertRaises(socket.error, self.pipeline.query_async("www.google.com", nameservers=['127.0.0.1'],
+                                                                  port=0).result, 5)
+
+        server = self.metrics.servers[('127.0.0.1', 0)]
+
+        self.assertEquals((1, 1), (server.sent, server.send_errors))
+
+        server = self.metrics.servers[nameserver]
+
+        self.assertEquals(3, server.sent)
+        self.assertEquals(0, server.send_errors)
+        self.assertEquals(3, server.received)
+        self.assertEquals(3, server.matched)
+        self.assertEquals(3, server.rtt.count)
+        self.assertEquals(0, self.pipeline.pending)
+
+        server = self.metrics.servers[silent_address]
+
+        self.assertEquals(1, server.sent)
+        self.assertEquals(1, server.timeouts)
+        self.assertEquals(2, server.received)
+        self.assertEquals(1, server.unexpected)
+        self.assertEquals(1, server.invalid)
+
+    def testRender(self):
+        self.pipeline.query_async("www.google.com", nameservers=[self.nameserver.host],
+                                  port=self.nameserver.port).result(5)
+
+        text = self.metrics.render()
+        labels = 'nameserver="%s",port="%d"' % (self.nameserver.host, self.nameserver.port)
+
+        self.assert_("# TYPE asyncdns_queries_sent_total counter\n" in text)
+        self.assert_("asyncdns_queries_sent_total{%s} 1\n" % labels in text)
+        self.assert_("asyncdns_rtt_seconds_bucket{%s,le=\"+Inf\"} 1\n" % labels in text)
+        self.assert_("asyncdns_rtt_seconds_count{%s} 1\n" % labels in text)
+        self.assert_("# TYPE asyncdns_pending gauge\nasyncdns_pending{pipeline=\"0\"} 0\n" in text)
+
+        other = Pipeline(self.wheel, metrics=self.metrics)
+
+        try:
+            text = self.metrics.render()
+
+            self.assertEquals(1, text.count("# TYPE asyncdns_pending gauge\n"))
+            self.assert_("asyncdns_pending{pipeline=\"0\"} 0\nasyncdns_pending{pipeline=\"1\"} 0\n" in text)
+        finally:
+            other.close()
+
+        # the gauges of the closed pipeline are gone
+        text = self.metrics.render()
+
+        self.assertFalse('pipeline="1"' in text)
+        self.assert_("asyncdns_pending{pipeline=\"0\"} 0\n" in text)
+
+        import urllib2
+
+        exporter = MetricsServer(self.metrics)
+
+        try:
+            url = "http://%s:%d" % (exporter.host, exporter.port)
+
+            self.assertEquals(text, urllib2.urlopen(url + "/metrics").read())
+            self.assertRaises(urllib2.HTTPError, urllib2.urlopen, url + "/")
+        finally:
+            exporter.close()
+
+class TestProfiler(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.wheel = TimeWheel()
+        self.pipeline = Pipeline(self.wheel)
+
+    def tearDown(self):
+        self.pipeline.close()
+        self.wheel.terminate()
+
+        for filename in os.listdir(self.directory):
+            os.remove(os.path.join(self.directory, filename))
+
+        os.rmdir(self.directory)
+
+    def testCollapsed(self):
+        path = os.path.join(self.directory, "profile.collapsed")
+        profiler = profile(path, duration=0.2, interval=0.01)
+
+        self.assert_(profiler.wait(5))
+        self.assert_(profiler.count > 0)
+
+        lines = open(path).read().splitlines()
+        threads = set([line.split(';')[0] for line in lines])
+
+        self.assert_(set(['asyncdns.pipeline', 'asyncdns.timewheel']).issubset(threads))
+        self.assert_(threads.issubset(Profiler.THREADS))
+        self.assert_(sum([int(line.rsplit(' ', 1)[1]) for line in lines]) >= profiler.count * 2)
+        self.assert_([line for line in lines if "run (pipeline.py:" in line])
+        self.assertEquals(0600, os.stat(path).st_mode & 0777)
+
+    def testExisting(self):
+        target = os.path.join(self.directory, "target")
+        path = os.path.join(self.directory, "profile.collapsed")
+
+        with open(target, 'w') as f:
+            f.write("untouched")
+
+        os.symlink(target, path)
+
+        profiler = profile(path, duration=0.1, interval=0.01)
+
+        self.assert_(profiler.wait(5))
+        self.assertEquals("untouched", open(target).read())
+
+    def testPstats(self):
+        import pstats
+        import signal
+
+        previous = install(duration=0.2, format='pstats', directory=self.directory)
+
+        try:
+            os.kill(os.getpid(), signal.SIGUSR2)
+
+            deadline = time.time() + 5
+
+            while not os.listdir(self.directory) and time.time() < deadline:
+                time.sleep(0.1)
+        finally:
+            signal.signal(signal.SIGUSR2, previous)
+
+        time.sleep(0.5)
+
+        filenames = os.listdir(self.directory)
+
+        self.assertEquals(1, len(filenames))
+        self.assert_(filenames[0].endswith(".pstats"))
+
+        stats = pstats.Stats(os.path.join(self.directory, filenames[0])).stats
+
+        self.assert_([func for func in stats if func[2] == 'run' and func[0].endswith('pipeline.py')])
+
+class TestSocksProtocol(unittest.TestCase):
+    class FakeSocks(object):
+        def __init__(self, buf=None):
+            self.buf = buf
+            self.sent = ""
+
+        def getpeername(self):
+            return ('127.0.0.1', '1234')
+
+        def recv(self, bytes):
+            data = self.buf[:bytes]
+            self.buf = self.buf[bytes:]
+
+            return data
+
+        def recv_into(self, buf, nbytes):
+            data = self.recv(nbytes)
+
+            buf[:len(data)] = data
+
+            return len(data)
+
+        def sendall(self, buf):
+            self.sent += buf
+
+        def close(self):
+            pass
+
+    def setUp(self):
+        self.proto = SocksProtocol(TestSocksProtocol.FakeSocks())
+
+    def testConnect(self):
+        self.assertEqual(SocksProtocol.VER_SOCKS_5, self.proto.version)
+
+        self.assertEqual("\x05\x02\x00\x02", self.proto.make_connect())
+        self.assertEqual("\x05\x01\x02", self.proto.make_connect([SocksProtocol.METHOD_SIMPLE]))
+        self.assertEqual("\x05\x01\x00", self.proto.make_connect([]))
+
+        self.proto.sock.buf = "\x05\x00"
+        self.assertEqual(SocksProtocol.METHOD_NO_AUTH, self.proto.parse_connect())
+
+        self.proto.sock.buf = "\x04\x02"
+        self.assertRaises(InvalidSocksVersion, self.proto.parse_connect)
+
+        self.proto.sock.buf = "\x05\xff"
+        self.assertRaises(NoAcceptableAuthMethod, self.proto.parse_connect)
+
+        self.proto.sock.buf = "\x05\x00"
+        self.assert_(self.proto.connect())
+
+        self.assertEqual("\x05\x02\x00\x02", self.proto.sock.sent)
+
+    def testAuth(self):
+        self.assertEqual("\x01\x04user\x04pass", self.proto.make_simple_auth('user', 'pass'))
+
+        self.proto.sock.buf = "\x01\x00"
+        self.assert_(self.proto.parse_simple_auth())
+
+        self.proto.sock.buf = "\x04\x02"
+        self.assertRaises(InvalidSocksVersion, self.proto.parse_simple_auth)
+
+        self.proto.sock.buf = "\x01\x01"
+        self.assertRaises(AuthenticationError, self.proto.parse_simple_auth)
+
+    def testRequest(self):
+        self.assertEqual("\x05\x01\x00\x01\x7f\x00\x00\x01\x1f\x90", self.proto.make_request(SocksProtocol.CMD_CONNECT, '127.0.0.1', 8080))
+        self.assertEqual("\x05\x03\x00\x03\tlocalhost\x1f\x90", self.proto.make_request(SocksProtocol.CMD_UDP_ASSOCIATE, 'localhost', 8080))
+
+        self.proto.sock.buf = "\x05\x00\x00\x01\x7f\x00\x00\x01\x1f\x91"
+
+        addr, port = self.proto.parse_request()
+
+        self.assertEqual("127.0.0.1", addr)
+        self.assertEqual(8081, port)
+
+        self.proto.sock.buf = "\x05\x00\x00\x03\tlocalhost\x1f\x91"
+
+        addr, port = self.proto.parse_request()
+
+        self.assertEqual("localhost", addr)
+        self.assertEqual(8081, port)
+
+        self.proto.sock.buf = "\x05\x00\x00\x01\x7f\x00\x00\x01\x1f\x90"
+        self.assertEqual(('127.0.0.1', 8080), self.proto.associate())
+
+        self.assertEqual("\x05\x03\x00\x01\x00\x00\x00\x00\x00\x00", self.proto.sock.sent)
+
+    def testPacket(self):
+        self.assertEqual("\x00\x00\x00\x01\x7f\x00\x00\x01\x005test", self.proto.make_packet('127.0.0.1', 53, 'test'))
+        self.assertEqual("\x00\x00\x00\x03\tlocalhost\x005test", self.proto.make_packet('localhost', 53, 'test'))
+
+        self.assertEqual(("127.0.0.1", 53, "test"), self.proto.parse_packet("\x00\x00\x00\x01\x7f\x00\x00\x01\x005test"))
+        self.assertEqual(("localhost", 53, "test"), self.proto.parse_packet("\x00\x00\x00\x03\tlocalhost\x005test"))
+
+        self.assert_(self.proto.make_header('127.0.0.1', 53) is self.proto.make_header('127.0.0.1', 53))
+
+        self.proto.MAX_HEADERS = 2
+
+        for host in ['127.0.0.2', '127.0.0.1', '127.0.0.3']:
+            self.proto.make_header(host, 53)
+
+        self.assertEqual([('127.0.0.1', 53), ('127.0.0.3', 53)], list(self.proto.headers))
+
+        buf = bytearray(16)
+
+        self.assertEqual(14, self.proto.pack_packet(memoryview(buf), '127.0.0.1', 53, 'test'))
+        self.assertEqual("\x00\x00\x00\x01\x7f\x00\x00\x01\x005test", str(buf[:14]))
+        self.assertRaises(ValueError, self.proto.pack_packet, memoryview(buf), 'localhost', 53, 'test')
+        self.assertEqual(16, len(buf))
+
+        buf = memoryview(bytearray("\x00\x00\x00\x01\x7f\x00\x00\x01\x005test"))
+
+        self.assertEqual(("127.0.0.1", 53, 10), self.proto.unpack_header(buf))
+        self.assertEqual(("::1", 53, 22), self.proto.unpack_header("\x00\x00\x00\x04" + "\x00" * 15 + "\x01\x005test"))
+        self.assertRaises(SocksProtocolError, self.proto.unpack_header, "\x00\x00\x01\x01\x7f\x00\x00\x01\x005test")
 
 if __name__=='__main__':
     logging.basicConfig(level=logging.DEBUG if "-v" in sys.argv else logging.WARN,